@@ -0,0 +1,161 @@
+import heapq
+import time
+
+import pylru
+
+from twisted.names import dns
+
+import metrics
+from blocked_response import BlockingDNSServerFactory
+
+ACTIONS = ['refused', 'drop']
+
+class ClientRateLimiter(object):
+    """
+    Token bucket per client address: a client may send `burst` queries at
+    once and `rate_per_sec` queries per second on average. Buckets of the
+    `max_clients` most recently seen clients are kept, as are the counts of
+    rejected queries of the clients that went over their rate.
+    """
+    def __init__(self, rate_per_sec: float, burst: int, max_clients: int=10000):
+        if rate_per_sec <= 0:
+            raise ValueError(f"Invalid client rate {rate_per_sec}, should be greater than zero")
+
+        self.rate_per_sec = rate_per_sec
+        self.burst = max(1, burst)
+
+        # key: client address. Value: [tokens, last refill time].
+        self._buckets = pylru.lrucache(max_clients)
+
+        # key: client address. Value: number of rejected queries.
+        self.offenders = pylru.lrucache(max_clients)
+
+    def allow(self, client):
+        now = time.monotonic()
+
+        bucket = self._buckets.get(client)
+
+        if bucket is None:
+            bucket = self._buckets[client] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate_per_sec)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            self.offenders[client] = self.offenders.get(client, 0) + 1
+
+            return False
+
+        bucket[0] -= 1
+
+        return True
+
+    def get_top_offenders(self, count=10):
+        """
+        Returns (client, rejected queries) of the clients with the most
+        rejected queries, most first.
+        """
+        return heapq.nlargest(count, self.offenders.items(), key=lambda item: item[1])
+
+class AdmissionControlDNSServerFactory(BlockingDNSServerFactory):
+    """
+    BlockingDNSServerFactory that turns away queries before they reach the
+    caches and resolvers:
+
+    * Queries of a client (by source address) beyond its ClientRateLimiter
+      budget, unless the client is in `exempt_clients`.
+    * Queries that are not in the answer cache of their resolver while
+      `max_outstanding` lookups are already waiting for an answer.
+
+    Rejected queries are answered with REFUSED, or not at all if `action` is
+    'drop'. Either limit is disabled by setting it to 0.
+    """
+    def __init__(self, *args, rate_per_sec: float=0, burst: int=0, action: str='refused', max_outstanding: int=0, exempt_clients=(), max_clients: int=10000, **kwargs):
+        BlockingDNSServerFactory.__init__(self, *args, **kwargs)
+
+        if action not in ACTIONS:
+            raise ValueError(f"Invalid admission control action '{action}', should be one of {', '.join(ACTIONS)}")
+
+        self.rate_limiter = ClientRateLimiter(rate_per_sec, burst or int(rate_per_sec), max_clients) if rate_per_sec > 0 else None
+        self.action = action
+        self.max_outstanding = max_outstanding
+        self.exempt_clients = frozenset(exempt_clients)
+
+        self.outstanding = 0
+
+        self.stats = {
+            'rate_limited': 0,
+            'overloaded': 0,
+            'outstanding': 0,
+            'outstanding_high_water': 0,
+        }
+
+    def _reject(self, message, protocol, address, reason):
+        self.stats[reason] += 1
+
+        if self.action == 'drop':
+            return
+
+        self.sendReply(protocol, self._responseFromMessage(message=message, rCode=dns.EREFUSED), address)
+
+    def _is_cached(self, query, resolver):
+        cache = self.get_cache(resolver)
+
+        return cache is not None and query in cache.cache
+
+    def messageReceived(self, message, proto, address=None):
+        if self.rate_limiter is not None and message.opCode == dns.OP_QUERY:
+            client = address[0] if address is not None else proto.transport.getPeer().host
+
+            if client not in self.exempt_clients and not self.rate_limiter.allow(client):
+                self._reject(message, proto, address, 'rate_limited')
+                return
+
+        BlockingDNSServerFactory.messageReceived(self, message, proto, address)
+
+    def handleQuery(self, message, protocol, address):
+        resolver = self.get_resolver(message, protocol, address)
+
+        if self.max_outstanding and self.outstanding >= self.max_outstanding and message.queries and not self._is_cached(message.queries[0], resolver):
+            self._reject(message, protocol, address, 'overloaded')
+            return
+
+        # Answers from the caches are sent right away, so they are no longer
+        # counted when handleQuery returns.
+        self.outstanding += 1
+
+        d = self.resolve_query(message, protocol, address, resolver)
+        d.addBoth(self._lookup_done)
+
+        self.stats['outstanding_high_water'] = max(self.stats['outstanding_high_water'], self.outstanding)
+
+        return d
+
+    def _lookup_done(self, result):
+        self.outstanding -= 1
+
+        return result
+
+    def get_stats(self):
+        self.stats['outstanding'] = self.outstanding
+
+        stats = {f"admission_{key}": value for key, value in self.stats.items()}
+
+        if self.rate_limiter is not None:
+            stats['admission_offending_clients'] = len(self.rate_limiter.offenders)
+
+            for client, count in self.rate_limiter.get_top_offenders():
+                stats[f"admission_client_{client}_rate_limited"] = count
+
+        return stats
+
+    def get_metrics(self):
+        families = BlockingDNSServerFactory.get_metrics(self) + [
+            metrics.counter('interceptor_admission_rejected_total', 'Queries turned away by admission control by reason.', [({'reason': reason}, self.stats[reason]) for reason in ['rate_limited', 'overloaded']]),
+            metrics.gauge('interceptor_outstanding_lookups', 'Queries waiting for a lookup that was not answered from the caches.', [({}, self.outstanding)]),
+        ]
+
+        if self.rate_limiter is not None:
+            families.append(metrics.counter('interceptor_client_rate_limited_total', 'Queries rejected by the per-client rate limit, for the clients with the most rejections.', [({'client': client}, count) for client, count in self.rate_limiter.get_top_offenders()]))
+
+        return families
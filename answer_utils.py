@@ -0,0 +1,104 @@
+import socket
+
+from twisted.names import dns
+
+def get_address_values(value, type=dns.A):
+    """
+    Returns the numeric values of the addresses of all A (or AAAA) records in
+    a resolver result (a tuple of answer, authority and additional record
+    lists), read straight from the packed network-order address of each
+    Record_A (or Record_AAAA).
+    """
+    address_values = []
+
+    if value:
+        for records in value:
+            if records:
+                for record in records:
+                    if record and record.type == type:
+                        address_values.append(int.from_bytes(record.payload.address, 'big'))
+
+    return address_values
+
+def get_a_address_values(value):
+    return get_address_values(value, dns.A)
+
+def get_aaaa_address_values(value):
+    return get_address_values(value, dns.AAAA)
+
+def get_min_ttl(value):
+    """
+    Returns the smallest TTL of all records in a resolver result, or None if
+    it has no records.
+    """
+    min_ttl = None
+
+    if value:
+        for records in value:
+            if records:
+                for record in records:
+                    if record and (min_ttl is None or record.ttl < min_ttl):
+                        min_ttl = record.ttl
+
+    return min_ttl
+
+def address_value_to_ip(address_value):
+    """
+    Converts numeric value of an IPv4 address to its dotted quad.
+    """
+    return socket.inet_ntoa(address_value.to_bytes(4, 'big'))
+
+def address_value_to_ipv6(address_value):
+    """
+    Converts numeric value of an IPv6 address to its text form.
+    """
+    return socket.inet_ntop(socket.AF_INET6, address_value.to_bytes(16, 'big'))
+
+def _benchmark_answer():
+    answers = [dns.RRHeader(b'www.example.com', dns.CNAME, dns.IN, 300, dns.Record_CNAME(b'www.example.com.cdn.net', 300))]
+
+    for i in range(4):
+        answers.append(dns.RRHeader(b'www.example.com.cdn.net', dns.A, dns.IN, 60, dns.Record_A(f"93.184.216.{i + 30}", 60)))
+
+    return (answers, [], [])
+
+def _get_addresses_with_regex(value):
+    # How interceptor.py used to find addresses in a resolver result.
+    import re
+
+    addresses = []
+
+    for v in value:
+        if v:
+            for v1 in v:
+                if v1:
+                    payload = v1.__dict__.get("payload")
+                    if payload:
+                        record = str(payload)
+
+                        result = re.findall(r"<A address=(\d+\.\d+\.\d+\.\d+) ttl=\d+>", record)
+
+                        if result:
+                            addresses.append(result[0])
+
+    return addresses
+
+def main():
+    import timeit
+
+    value = _benchmark_answer()
+
+    if [address_value_to_ip(v) for v in get_a_address_values(value)] != _get_addresses_with_regex(value):
+        raise AssertionError("Structured and regex parsing found different addresses")
+
+    iterations = 100000
+
+    regex_us = timeit.timeit(lambda: _get_addresses_with_regex(value), number=iterations) * 1e6 / iterations
+    structured_us = timeit.timeit(lambda: get_a_address_values(value), number=iterations) * 1e6 / iterations
+
+    print(f"str(payload) + regex: {regex_us:.2f} us/answer")
+    print(f"Record_A address bytes: {structured_us:.2f} us/answer")
+    print(f"Speedup: {regex_us / structured_us:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+import pylru
+
+from twisted.application import service
+
+import metrics
+
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `burst` records per key at once and `rate_per_sec`
+    per key on average, and only a `sample_rate` fraction of the records
+    below WARNING. The key is the `key` extra of the record if given, or else
+    its unformatted message, so records are never formatted just to be
+    dropped. The first record let through after some were suppressed says
+    how many.
+    """
+    def __init__(self, stats, rate_per_sec: float=1.0, burst: int=10, sample_rate: float=1.0, max_keys: int=1000):
+        logging.Filter.__init__(self)
+
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"Invalid log sample rate {sample_rate}, should be between 0 and 1")
+
+        self.stats = stats
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.sample_rate = sample_rate
+
+        # key: message key. Value: [tokens, last refill time, suppressed].
+        self._buckets = pylru.lrucache(max_keys)
+
+    def filter(self, record):
+        if self.sample_rate < 1 and record.levelno < logging.WARNING and random.random() >= self.sample_rate:
+            self.stats['sampled_out'] += 1
+            return False
+
+        key = getattr(record, 'key', record.msg)
+        now = time.monotonic()
+
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now, 0]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate_per_sec)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            bucket[2] += 1
+
+            self.stats['rate_limited'] += 1
+            return False
+
+        bucket[0] -= 1
+
+        if bucket[2]:
+            record.msg = f"{record.msg} ({bucket[2]} similar messages suppressed)"
+            bucket[2] = 0
+
+        return True
+
+class _BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records when `max_queue_size` are waiting instead
+    of growing without bound, and leaves formatting to the listener thread.
+    """
+    def __init__(self, log_queue, stats, max_queue_size):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+
+        self.stats = stats
+        self.max_queue_size = max_queue_size
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.max_queue_size:
+            self.stats['dropped'] += 1
+            return
+
+        self.stats['queued'] += 1
+
+        self.queue.put_nowait(record)
+
+class AsyncLog(service.Service):
+    """
+    Sets up the `logger_name` logger for the DNS hot path. Records below
+    `level` cost one isEnabledFor() check. The others are rate limited and
+    sampled by RateLimitFilter on the calling thread, then handed over
+    through a queue to a QueueListener thread that formats and writes them to
+    `stream`, so the reactor thread never blocks on the log file. At most
+    `max_queue_size` records wait to be written, newer ones are dropped.
+    """
+    def __init__(self, logger_name: str='interceptor', level: str='WARNING', rate_per_sec: float=1.0, burst: int=10, sample_rate: float=1.0, max_queue_size: int=10000, stream=None):
+        if level.upper() not in LEVELS:
+            raise ValueError(f"Invalid log level '{level}', should be one of {', '.join(LEVELS)}")
+
+        self.stats = {
+            'queued': 0,
+            'rate_limited': 0,
+            'sampled_out': 0,
+            'dropped': 0,
+        }
+
+        # twistd replaces sys.stdout with its own logger, which must only be
+        # written to from the reactor thread.
+        handler = logging.StreamHandler(stream if stream is not None else sys.__stdout__)
+        handler.setFormatter(logging.Formatter(FORMAT))
+
+        log_queue = queue.Queue()
+
+        self.listener = logging.handlers.QueueListener(log_queue, handler)
+
+        self.logger = logging.getLogger(logger_name)
+        self.logger.setLevel(level.upper())
+        self.logger.propagate = False
+        self.logger.addFilter(RateLimitFilter(self.stats, rate_per_sec=rate_per_sec, burst=burst, sample_rate=sample_rate))
+        self.logger.addHandler(_BoundedQueueHandler(log_queue, self.stats, max_queue_size))
+
+    def startService(self):
+        service.Service.startService(self)
+
+        self.listener.start()
+
+    def stopService(self):
+        # Writes out the records still queued.
+        if self.running:
+            self.listener.stop()
+
+        return service.Service.stopService(self)
+
+    def get_metrics(self):
+        return [
+            metrics.counter('interceptor_log_records_total', 'Log records at or above the log level by what happened to them.', [({'result': result}, self.stats[result]) for result in ['queued', 'rate_limited', 'sampled_out', 'dropped']]),
+        ]
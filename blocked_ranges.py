@@ -0,0 +1,216 @@
+import array
+import bisect
+
+import ip_address_utils
+from geo_index import MAX_IPV4_VALUE, MAX_IPV6_VALUE, CountryIndex, Uint128Array, _CHECK_ADDRESSES, _get_check_index
+
+def _get_blocked_value_ranges(country_index, blocked_countries):
+    """
+    Returns the merged (min, max) value ranges of a CountryIndex or
+    Ipv6CountryIndex whose country code is one of `blocked_countries`.
+    """
+    blocked_indices = {index for index, country_code in enumerate(country_index.country_codes) if country_code in blocked_countries}
+
+    starts = country_index.starts
+
+    value_ranges = [(starts[i], starts[i + 1] - 1) for i, country_index_value in enumerate(country_index.country_indices) if country_index_value in blocked_indices and starts[i + 1] > starts[i]]
+
+    return ip_address_utils.consolidate_ip_value_ranges(value_ranges, merge_adjacent=True)
+
+class BlockedRanges(object):
+    """
+    The IPv4 ranges of a CountryIndex whose country is blocked, merged with
+    ip_address_utils.consolidate_ip_value_ranges into sorted, disjoint
+    ranges, so that whether an address is blocked is one bisect and one
+    comparison. The country code is only looked up for the reason string.
+    """
+    def __init__(self, value_ranges):
+        self.starts = array.array('I', [min_value for min_value, max_value in value_ranges])
+        self.ends = array.array('I', [max_value for min_value, max_value in value_ranges])
+
+    @classmethod
+    def compile(cls, country_index: CountryIndex, blocked_countries):
+        """
+        Compiles the ranges of `country_index` whose country code is one of
+        `blocked_countries`.
+        """
+        return cls(_get_blocked_value_ranges(country_index, blocked_countries))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def is_blocked(self, address_value):
+        # Looked up like CountryIndex.get_country_short.
+        if address_value == MAX_IPV4_VALUE:
+            address_value -= 1
+
+        index = bisect.bisect_right(self.starts, address_value) - 1
+
+        return index >= 0 and address_value <= self.ends[index]
+
+    def get_first_blocked(self, address_values):
+        """
+        Returns the first of `address_values` that is blocked, or None.
+        """
+        for address_value in address_values:
+            if self.is_blocked(address_value):
+                return address_value
+
+        return None
+
+class Ipv6BlockedRanges(object):
+    """
+    BlockedRanges for IPv6 addresses, with the range bounds in Uint128Arrays.
+    Addresses that carry an IPv4 address are checked against the IPv4
+    BlockedRanges, like CountryIndex.get_ipv6_country_short looks them up.
+    """
+    def __init__(self, value_ranges, ipv4_blocked_ranges: BlockedRanges):
+        self.starts = Uint128Array([min_value for min_value, max_value in value_ranges])
+        self.ends = Uint128Array([max_value for min_value, max_value in value_ranges])
+        self.ipv4_blocked_ranges = ipv4_blocked_ranges
+
+    @classmethod
+    def compile(cls, country_index: CountryIndex, blocked_countries, ipv4_blocked_ranges: BlockedRanges):
+        """
+        Compiles the IPv6 ranges of `country_index` whose country code is one
+        of `blocked_countries`. There are none if it has no IPv6 data.
+        """
+        if country_index.ipv6 is None:
+            return cls([], ipv4_blocked_ranges)
+
+        return cls(_get_blocked_value_ranges(country_index.ipv6, blocked_countries), ipv4_blocked_ranges)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def is_blocked(self, address_value):
+        ipv4_value = ip_address_utils.ipv6_value_to_ipv4_value(address_value)
+
+        if ipv4_value is not None:
+            return self.ipv4_blocked_ranges.is_blocked(ipv4_value)
+
+        if address_value == MAX_IPV6_VALUE:
+            address_value -= 1
+
+        index = self.starts.bisect_right(address_value) - 1
+
+        return index >= 0 and address_value <= self.ends[index]
+
+    def get_first_blocked(self, address_values):
+        """
+        Returns the first of `address_values` that is blocked, or None.
+        """
+        for address_value in address_values:
+            if self.is_blocked(address_value):
+                return address_value
+
+        return None
+
+def _check_blocked_ranges():
+    """
+    Checks the blocked ranges of the geo_index check index, for a few lists
+    of blocked countries, against the expected country codes of its check
+    addresses and the ranges next to each blocked range.
+    """
+    country_index = _get_check_index()
+
+    for blocked_countries in (['RU', 'CN'], ['FR'], ['DE', 'US'], ['JP'], ['-'], []):
+        blocked_ranges = BlockedRanges.compile(country_index, blocked_countries)
+        ipv6_blocked_ranges = Ipv6BlockedRanges.compile(country_index, blocked_countries, blocked_ranges)
+
+        checks = [(ip, country_code in blocked_countries) for ip, country_code in _CHECK_ADDRESSES]
+
+        # The edges of every blocked range, blocked or not like the country
+        # index says.
+        for i in range(len(blocked_ranges)):
+            for value in (blocked_ranges.starts[i] - 1, blocked_ranges.starts[i], blocked_ranges.ends[i], blocked_ranges.ends[i] + 1):
+                if 0 <= value <= MAX_IPV4_VALUE:
+                    checks.append((ip_address_utils.value_to_ip(value), country_index.get_country_short(value) in blocked_countries))
+
+        for i in range(len(ipv6_blocked_ranges)):
+            for value in (ipv6_blocked_ranges.starts[i] - 1, ipv6_blocked_ranges.starts[i], ipv6_blocked_ranges.ends[i], ipv6_blocked_ranges.ends[i] + 1):
+                if 0 <= value <= MAX_IPV6_VALUE:
+                    checks.append((ip_address_utils.value_to_ipv6(value), country_index.get_ipv6_country_short(value) in blocked_countries))
+
+        for ip, expected_blocked in checks:
+            if ':' in ip:
+                actual_blocked = ipv6_blocked_ranges.is_blocked(ip_address_utils.get_ipv6_value(ip))
+            else:
+                actual_blocked = blocked_ranges.is_blocked(ip_address_utils.get_value(ip))
+
+            if actual_blocked != expected_blocked:
+                raise AssertionError(f"Mismatch for {ip} with {blocked_countries} blocked: expected {expected_blocked}, blocked ranges say {actual_blocked}")
+
+    print("Blocked ranges of the check index agree")
+
+def main():
+    """
+    Checks the blocked ranges of an index of a few ranges, then compiles the
+    blocked ranges of the BIN file given as argument (or in
+    IP2LOCATION_BIN_FILE_PATH), if there is one, for BLOCKED_COUNTRIES_LIST,
+    checks them against country lookups of random IPv4 and IPv6 addresses
+    and compares their speed.
+    """
+    import os
+    import random
+    import sys
+    import time
+
+    _check_blocked_ranges()
+
+    bin_file_path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('IP2LOCATION_BIN_FILE_PATH', 'IP2LOCATION-LITE-DB1.BIN')
+    blocked_countries = [_.upper() for _ in os.environ.get('BLOCKED_COUNTRIES_LIST', 'ru,ir,cn,kp').split(',')]
+
+    if not os.path.exists(bin_file_path):
+        print(f"No BIN file at {bin_file_path}, skipped the comparison with country lookups")
+        return
+
+    country_index = CountryIndex.from_bin(bin_file_path)
+
+    start = time.perf_counter()
+    blocked_ranges = BlockedRanges.compile(country_index, blocked_countries)
+    compile_ms = (time.perf_counter() - start) * 1000
+
+    print(f"Compiled {len(blocked_ranges)} blocked ranges out of {len(country_index)} ranges in {compile_ms:.0f} ms")
+
+    rng = random.Random(19)
+
+    address_values = [rng.randrange(MAX_IPV4_VALUE + 1) for _ in range(200000)] + [0, MAX_IPV4_VALUE - 1, MAX_IPV4_VALUE]
+    address_values += [max(0, blocked_ranges.starts[i] + delta) for i in range(0, len(blocked_ranges), max(1, len(blocked_ranges) // 10000)) for delta in (-1, 0, 1)]
+
+    start = time.perf_counter()
+    expected = [country_index.get_country_short(value) in blocked_countries for value in address_values]
+    country_us = (time.perf_counter() - start) * 1e6 / len(address_values)
+
+    start = time.perf_counter()
+    actual = [blocked_ranges.is_blocked(value) for value in address_values]
+    blocked_us = (time.perf_counter() - start) * 1e6 / len(address_values)
+
+    for value, expected_blocked, actual_blocked in zip(address_values, expected, actual):
+        if expected_blocked != actual_blocked:
+            raise AssertionError(f"Mismatch for {ip_address_utils.value_to_ip(value)}: country lookup says {expected_blocked}, blocked ranges say {actual_blocked}")
+
+    print(f"{len(address_values)} addresses agree. Country code and list check: {country_us:.2f} us/address, blocked ranges: {blocked_us:.2f} us/address")
+
+    ipv6_blocked_ranges = Ipv6BlockedRanges.compile(country_index, blocked_countries, blocked_ranges)
+
+    address_values = [rng.randrange(MAX_IPV6_VALUE + 1) for _ in range(100000)] + [0, MAX_IPV6_VALUE - 1, MAX_IPV6_VALUE]
+    address_values += [max(0, ipv6_blocked_ranges.starts[i] + delta) for i in range(0, len(ipv6_blocked_ranges), max(1, len(ipv6_blocked_ranges) // 10000)) for delta in (-1, 0, 1)]
+    address_values += [ip_address_utils.get_ipv6_value(prefix) | rng.randrange(1 << 32) << shift for prefix, shift in [('::ffff:0:0', 0), ('2002::', 80), ('2001::', 0)] for _ in range(1000)]
+
+    start = time.perf_counter()
+    expected = [country_index.get_ipv6_country_short(value) in blocked_countries for value in address_values]
+    country_us = (time.perf_counter() - start) * 1e6 / len(address_values)
+
+    start = time.perf_counter()
+    actual = [ipv6_blocked_ranges.is_blocked(value) for value in address_values]
+    blocked_us = (time.perf_counter() - start) * 1e6 / len(address_values)
+
+    for value, expected_blocked, actual_blocked in zip(address_values, expected, actual):
+        if expected_blocked != actual_blocked:
+            raise AssertionError(f"Mismatch for {ip_address_utils.value_to_ipv6(value)}: country lookup says {expected_blocked}, blocked ranges say {actual_blocked}")
+
+    print(f"{len(ipv6_blocked_ranges)} blocked IPv6 ranges, {len(address_values)} IPv6 addresses agree. Country code and list check: {country_us:.2f} us/address, blocked ranges: {blocked_us:.2f} us/address")
+
+if __name__ == "__main__":
+    main()
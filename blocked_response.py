@@ -0,0 +1,228 @@
+import time
+
+import pylru
+
+from twisted.internet import defer
+from twisted.names import dns, server
+from twisted.python import failure
+
+import metrics
+
+MODES = ['nxdomain', 'refused', 'sinkhole']
+
+RCODE_NAMES = {
+    dns.OK: 'NOERROR',
+    dns.EFORMAT: 'FORMERR',
+    dns.ESERVER: 'SERVFAIL',
+    dns.ENAME: 'NXDOMAIN',
+    dns.ENOTIMP: 'NOTIMP',
+    dns.EREFUSED: 'REFUSED',
+}
+
+class BlockedQueryError(dns.DomainError):
+    """
+    Raised for a query that was blocked. `rcode` and `authority` are sent to
+    the client by BlockingDNSServerFactory. A plain DNSServerFactory answers
+    NXDOMAIN, like for any other DomainError.
+    """
+    def __init__(self, name, rcode, authority):
+        dns.DomainError.__init__(self, name)
+
+        self.name = name
+        self.rcode = rcode
+        self.authority = authority
+
+class BlockedResponse(object):
+    """
+    Builds the response for a blocked query, depending on `mode`:
+
+    * nxdomain: NXDOMAIN with an SOA record whose TTL and minimum are `ttl`,
+      so that resolvers cache the negative answer for `ttl` seconds (RFC
+      2308).
+    * refused: REFUSED.
+    * sinkhole: 0.0.0.0 for A queries and :: for AAAA queries, with TTL `ttl`.
+    """
+    def __init__(self, mode: str='nxdomain', ttl: int=300):
+        if mode not in MODES:
+            raise ValueError(f"Invalid blocked response mode '{mode}', should be one of {', '.join(MODES)}")
+
+        self.mode = mode
+        self.ttl = ttl
+
+    def get_soa(self, name):
+        return dns.RRHeader(name, dns.SOA, dns.IN, self.ttl, dns.Record_SOA(mname=b'blocked.invalid', rname=b'hostmaster.blocked.invalid', serial=1, refresh=self.ttl, retry=self.ttl, expire=self.ttl, minimum=self.ttl, ttl=self.ttl), auth=True)
+
+    def get(self, name, type):
+        """
+        Returns a deferred firing with the (answers, authority, additional)
+        response, or failing with BlockedQueryError, for a blocked query.
+        """
+        if self.mode == 'sinkhole':
+            if type == dns.A:
+                answers = [dns.RRHeader(name, dns.A, dns.IN, self.ttl, dns.Record_A('0.0.0.0', self.ttl))]
+            elif type == dns.AAAA:
+                answers = [dns.RRHeader(name, dns.AAAA, dns.IN, self.ttl, dns.Record_AAAA('::', self.ttl))]
+            else:
+                answers = []
+
+            return defer.succeed((answers, [], []))
+
+        if self.mode == 'refused':
+            return defer.fail(failure.Failure(BlockedQueryError(name, dns.EREFUSED, [])))
+
+        return defer.fail(failure.Failure(BlockedQueryError(name, dns.ENAME, [self.get_soa(name)])))
+
+class BlockedNameCache(object):
+    """
+    Names that were recently blocked, so that repeated queries for them are
+    answered without an upstream lookup. An entry lives for `ttl` seconds,
+    the same time clients are told to cache the blocked response, and all
+    entries are dropped when the policy key passed to `get` changes.
+    """
+    def __init__(self, ttl: int=300, max_size: int=10000):
+        self.ttl = ttl
+
+        # key: fqdn. Value: (Verdict, expiration time)
+        self._names = pylru.lrucache(max_size)
+
+        self._policy_key = None
+
+        self.stats = {
+            'short_circuits': 0,
+            'invalidations': 0,
+            'discards': 0,
+        }
+
+    def __len__(self):
+        return len(self._names)
+
+    def get(self, name, policy_key):
+        """
+        Returns the Verdict that blocked `name`, or None.
+        """
+        if policy_key != self._policy_key:
+            if self._policy_key is not None:
+                self._names.clear()
+
+                self.stats['invalidations'] += 1
+
+            self._policy_key = policy_key
+
+        entry = self._names.get(name)
+
+        if entry is None:
+            return None
+
+        verdict, expires_at = entry
+
+        if expires_at <= time.monotonic():
+            del self._names[name]
+            return None
+
+        self.stats['short_circuits'] += 1
+
+        return verdict
+
+    def items(self):
+        """
+        Returns a list of (name, Verdict) for every blocked name.
+        """
+        return [(name, verdict) for name, (verdict, expires_at) in self._names.items()]
+
+    def discard(self, name, verdict):
+        """
+        Removes `name` if it is still blocked by `verdict`.
+        """
+        entry = self._names.get(name)
+
+        if entry is not None and entry[0] is verdict:
+            del self._names[name]
+
+            self.stats['discards'] += 1
+
+    def put(self, name, verdict):
+        if self.ttl > 0:
+            self._names[name] = (verdict, time.monotonic() + self.ttl)
+
+class BlockingDNSServerFactory(server.DNSServerFactory):
+    """
+    DNSServerFactory that answers blocked queries with the response code and
+    authority records of their BlockedQueryError instead of SERVFAIL or a
+    bare NXDOMAIN. Also counts responses by response code and measures the
+    time from receiving each query to answering it.
+
+    Subclasses may resolve the queries of some clients with another resolver
+    by overriding get_resolver, and get_cache to return the cache that
+    resolver answers from. Its answers are not put in `cache`.
+    """
+    def __init__(self, *args, **kwargs):
+        server.DNSServerFactory.__init__(self, *args, **kwargs)
+
+        # key: response code. Value: number of responses.
+        self.responses = {rcode: 0 for rcode in RCODE_NAMES}
+
+        self.latency = metrics.Histogram(metrics.LATENCY_BUCKETS)
+
+    def get_resolver(self, message, protocol, address):
+        """
+        Returns the resolver for query `message`, received on `protocol` from
+        `address`.
+        """
+        return self.resolver
+
+    def get_cache(self, resolver):
+        """
+        Returns the CacheResolver that `resolver`, as returned by
+        get_resolver, answers from without a lookup, or None.
+        """
+        return self.cache if resolver is self.resolver else None
+
+    def handleQuery(self, message, protocol, address):
+        return self.resolve_query(message, protocol, address, self.get_resolver(message, protocol, address))
+
+    def resolve_query(self, message, protocol, address, resolver):
+        """
+        Answers query `message` with `resolver`, as returned by get_resolver.
+        """
+        start = time.monotonic()
+
+        if resolver is self.resolver:
+            d = server.DNSServerFactory.handleQuery(self, message, protocol, address)
+        else:
+            d = resolver.query(message.queries[0])
+            d.addCallback(self._got_uncached_response, protocol, message, address)
+            d.addErrback(self.gotResolverError, protocol, message, address)
+
+        d.addBoth(self._answered, start)
+
+        return d
+
+    def _got_uncached_response(self, response, protocol, message, address):
+        answers, authority, additional = response
+
+        self.sendReply(protocol, self._responseFromMessage(message=message, rCode=dns.OK, answers=answers, authority=authority, additional=additional), address)
+
+    def _answered(self, result, start):
+        self.latency.observe(time.monotonic() - start)
+
+        return result
+
+    def sendReply(self, protocol, message, address):
+        if message.rCode in self.responses:
+            self.responses[message.rCode] += 1
+
+        return server.DNSServerFactory.sendReply(self, protocol, message, address)
+
+    def get_metrics(self):
+        return [
+            metrics.counter('interceptor_responses_total', 'DNS responses sent to clients by response code.', [({'rcode': RCODE_NAMES[rcode]}, count) for rcode, count in self.responses.items()]),
+            metrics.histogram('interceptor_query_duration_seconds', 'Time from receiving a query to answering it, including cache hits.', self.latency),
+        ]
+
+    def gotResolverError(self, failure, protocol, message, address):
+        if not failure.check(BlockedQueryError):
+            return server.DNSServerFactory.gotResolverError(self, failure, protocol, message, address)
+
+        response = self._responseFromMessage(message=message, rCode=failure.value.rcode, authority=failure.value.authority)
+
+        self.sendReply(protocol, response, address)
@@ -0,0 +1,292 @@
+import socket
+import struct
+
+import pylru
+
+from twisted.application import service
+from twisted.names import common, dns, resolve
+
+import metrics
+from admission_control import AdmissionControlDNSServerFactory
+from blocked_response import BlockedNameCache
+from ip_address_utils import CidrSet
+from prefetcher import TrackingCacheResolver
+from verdict_cache import VerdictCache
+from whitelist_refresher import WhitelistRefresher
+
+# EDNS option code of Client Subnet (RFC 7871).
+CLIENT_SUBNET_OPTION_CODE = 8
+
+# key: address family of a Client Subnet option. Value: (socket address
+# family, address length in bytes).
+CLIENT_SUBNET_FAMILIES = {1: (socket.AF_INET, 4), 2: (socket.AF_INET6, 16)}
+
+def get_client_subnet_address(message):
+    """
+    Returns the address in the EDNS Client Subnet option of DNS message
+    `message`, as added by forwarders like dnsmasq (add-subnet) to pass on
+    the address of their client, or None if it has none. The bits beyond the
+    source prefix length are zero, and a source prefix length of 0 means
+    that the client is not disclosed.
+    """
+    for record in message.additional:
+        if not isinstance(record, dns.RRHeader) or record.type != dns.OPT:
+            continue
+
+        # Options are (code, length, data), with 16-bit codes and lengths.
+        data = getattr(record.payload, 'data', b'')
+        offset = 0
+
+        while offset + 4 <= len(data):
+            code, length = struct.unpack_from('!HH', data, offset)
+            option = data[offset + 4 : offset + 4 + length]
+            offset += 4 + length
+
+            if code != CLIENT_SUBNET_OPTION_CODE or len(option) < 4:
+                continue
+
+            family, source_prefix_length = struct.unpack_from('!HB', option)
+
+            if family not in CLIENT_SUBNET_FAMILIES or source_prefix_length == 0:
+                return None
+
+            socket_family, address_length = CLIENT_SUBNET_FAMILIES[family]
+
+            return socket.inet_ntop(socket_family, option[4:].ljust(address_length, b'\0')[:address_length])
+
+    return None
+
+def read_client_policies(policy_file_path):
+    """
+    Returns (name, client CIDRs, blocked countries, group ids) of the client
+    policies in the file at `policy_file_path`, one per line:
+
+        <name> <client CIDRs> <blocked countries> [<group ids>]
+
+    Lists are comma separated, '-' is an empty list of blocked countries and
+    everything after a '#' on a line is ignored. Group ids are None if not
+    given, for the whitelist of the default policy.
+    """
+    with open(policy_file_path) as f:
+        lines = f.read().splitlines()
+
+    policies = []
+
+    for line in lines:
+        fields = line.split('#', 1)[0].split()
+
+        if not fields:
+            continue
+
+        if len(fields) not in (3, 4):
+            raise ValueError(f"Invalid client policy '{line}', should be '<name> <client CIDRs> <blocked countries> [<group ids>]'")
+
+        name, client_cidrs, blocked_countries = fields[:3]
+
+        group_ids = fields[3].split(',') if len(fields) == 4 else None
+
+        policies.append((name, client_cidrs.split(','), [code.upper() for code in blocked_countries.split(',') if code and code != '-'], group_ids))
+
+    return policies
+
+class ClientPolicy(object):
+    """
+    Blocked countries and whitelist of the clients in `client_cidrs`. Has the
+    attributes of MapResolver that verdicts depend on (geo_policy,
+    whitelist_refresher, policy_generation) and its own verdict, blocked name
+    and answer caches, so that its verdicts and answers never reach other
+    clients.
+    """
+    def __init__(self, name, client_cidrs, geo_policy, whitelist_refresher, verdict_cache, blocked_names, dns_cache):
+        self.name = name
+        self.client_cidrs = client_cidrs
+        self.geo_policy = geo_policy
+        self.whitelist_refresher = whitelist_refresher
+        self.verdict_cache = verdict_cache
+        self.blocked_names = blocked_names
+        self.dns_cache = dns_cache
+
+        # Incremented whenever the country data changes, so that cached
+        # verdicts are invalidated.
+        self.policy_generation = 0
+
+        # Answers the queries of the clients: dns_cache, then a
+        # ClientPolicyResolver.
+        self.resolver = None
+
+class ClientPolicyResolver(common.ResolverBase):
+    """
+    Looks up queries with MapResolver `resolver`, assessing A and AAAA
+    answers under `client_policy`, and caches the answers in its dns_cache.
+    """
+    def __init__(self, resolver, client_policy: ClientPolicy):
+        common.ResolverBase.__init__(self)
+
+        self.resolver = resolver
+        self.client_policy = client_policy
+
+    def query(self, query, timeout=None):
+        if query.type in (dns.A, dns.AAAA) and query.cls == dns.IN:
+            d = self.resolver.lookup_and_assess(query.name.name, query.type, timeout, self.client_policy)
+        else:
+            d = self.resolver.query(query, timeout)
+
+        d.addCallback(self._cache_response, query)
+
+        return d
+
+    def _cache_response(self, response, query):
+        if any(response):
+            self.client_policy.dns_cache.cacheResult(query, response)
+
+        return response
+
+class ClientPolicies(service.MultiService):
+    """
+    Client policies of MapResolver `resolver`, built from `policies` as read
+    by read_client_policies. The policy of a client is the one with the most
+    specific CIDR that includes its address, found in a CidrSet once per
+    client and then remembered for the `max_clients` most recent clients, so
+    that it costs the same however many policies there are. Clients of no
+    policy get the default policy of `resolver`.
+
+    Policies with the same group ids share a WhitelistRefresher, a child of
+    this service like the verdict caches. Answers to policy clients are not
+    prefetched or saved in snapshots.
+    """
+    def __init__(self, resolver, policies, verdict_cache_size: int=10000, max_clients: int=10000):
+        service.MultiService.__init__(self)
+
+        self.resolver = resolver
+
+        self.policies = []
+
+        # key: tuple of group ids. Value: WhitelistRefresher.
+        whitelist_refreshers = dict()
+
+        for name, client_cidrs, blocked_countries_list, group_ids in policies:
+            if group_ids is None:
+                whitelist_refresher = resolver.whitelist_refresher
+            else:
+                whitelist_refresher = whitelist_refreshers.get(tuple(group_ids))
+
+                if whitelist_refresher is None:
+                    whitelist_refresher = whitelist_refreshers[tuple(group_ids)] = WhitelistRefresher(resolver.pi_hole_client, groups=group_ids, refresh_interval_sec=resolver.whitelist_refresher.refresh_interval_sec, max_staleness_sec=resolver.whitelist_refresher.max_staleness_sec)
+                    whitelist_refresher.setServiceParent(self)
+
+            verdict_cache = VerdictCache(resolver.log_reason, max_size=verdict_cache_size)
+            verdict_cache.setServiceParent(self)
+
+            client_policy = ClientPolicy(name, client_cidrs, resolver.geo_policy.with_blocked_countries(blocked_countries_list), whitelist_refresher, verdict_cache, BlockedNameCache(ttl=resolver.blocked_names.ttl, max_size=verdict_cache_size), TrackingCacheResolver())
+            client_policy.resolver = resolve.ResolverChain([client_policy.dns_cache, ClientPolicyResolver(resolver, client_policy)])
+
+            self.policies.append(client_policy)
+
+        # key: True for IPv6. Value: CidrSet of client CIDRs, with their
+        # ClientPolicy as value.
+        self._index = {False: CidrSet(), True: CidrSet(ipv6=True)}
+
+        for client_policy in self.policies:
+            for client_cidr in client_policy.client_cidrs:
+                self._index[':' in client_cidr].add(client_cidr, client_policy)
+
+        # key: client address. Value: ClientPolicy, or None for the default
+        # policy.
+        self._clients = pylru.lrucache(max_clients)
+
+        self.stats = {
+            'policies': len(self.policies),
+            'default_queries': 0,
+        }
+
+        for client_policy in self.policies:
+            self.stats[f"{client_policy.name}_queries"] = 0
+
+    def get(self, client):
+        """
+        Returns the ClientPolicy of client address `client`, or None if the
+        default policy applies.
+        """
+        try:
+            client_policy = self._clients[client]
+        except KeyError:
+            client_policy = self._clients[client] = self._find(client)
+
+        if client_policy is None:
+            self.stats['default_queries'] += 1
+        else:
+            self.stats[f"{client_policy.name}_queries"] += 1
+
+        return client_policy
+
+    def _find(self, client):
+        cidr_set = self._index[':' in client]
+
+        try:
+            match = cidr_set.longest_match_value(cidr_set.get_address_value(client))
+        except (ValueError, OSError):
+            return None
+
+        return match[2] if match is not None else None
+
+    def swap_country_data(self, geo_policy):
+        """
+        Compiles the blocked countries of every policy against the country
+        data of `geo_policy`, and drops their cached verdicts and answers.
+        """
+        for client_policy in self.policies:
+            client_policy.geo_policy = geo_policy.with_blocked_countries(client_policy.geo_policy.blocked_countries_list)
+            client_policy.policy_generation += 1
+
+            for query in list(client_policy.dns_cache.cache):
+                client_policy.dns_cache.remove(query)
+
+    def get_metrics(self):
+        return [
+            metrics.counter('interceptor_client_policy_queries_total', 'Queries by the client policy they were assessed under.', [({'policy': 'default'}, self.stats['default_queries'])] + [({'policy': client_policy.name}, self.stats[f"{client_policy.name}_queries"]) for client_policy in self.policies]),
+        ]
+
+class ClientPolicyDNSServerFactory(AdmissionControlDNSServerFactory):
+    """
+    AdmissionControlDNSServerFactory that resolves the queries of the clients
+    of a policy in ClientPolicies `client_policies` with the resolver of that
+    policy.
+
+    The client of a query is the address in its EDNS Client Subnet option if
+    it has one, since behind a forwarder like Pi-hole every query comes from
+    the forwarder, and otherwise its source address. If `client_subnet_sources`
+    is not empty, the option is only used in queries from those addresses, so
+    that other clients cannot pick their policy.
+    """
+    def __init__(self, *args, client_policies: ClientPolicies=None, client_subnet_sources=(), **kwargs):
+        AdmissionControlDNSServerFactory.__init__(self, *args, **kwargs)
+
+        self.client_policies = client_policies
+        self.client_subnet_sources = frozenset(client_subnet_sources)
+
+    def get_client(self, message, protocol, address):
+        """
+        Returns the address of the client that sent query `message`.
+        """
+        source = address[0] if address is not None else protocol.transport.getPeer().host
+
+        if self.client_subnet_sources and source not in self.client_subnet_sources:
+            return source
+
+        return get_client_subnet_address(message) or source
+
+    def get_resolver(self, message, protocol, address):
+        if self.client_policies is None:
+            return self.resolver
+
+        client_policy = self.client_policies.get(self.get_client(message, protocol, address))
+
+        return self.resolver if client_policy is None else client_policy.resolver
+
+    def get_cache(self, resolver):
+        if resolver is self.resolver:
+            return self.cache
+
+        # The resolver of a ClientPolicy, which answers from its dns_cache
+        # first.
+        return resolver.resolvers[0]
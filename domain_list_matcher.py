@@ -0,0 +1,188 @@
+import re
+
+# Regexes PiHole (and people) commonly use to whitelist or blacklist a domain
+# and all of its subdomains, e.g., "(\.|^)example\.com$".
+SUFFIX_WILDCARD_RE = re.compile(r"^(?:\(\\\.\|\^\)|\(\^\|\\\.\)|\^\(\.\*\\\.\)\?)((?:[A-Za-z0-9_-]+\\\.)*[A-Za-z0-9_-]+)\$$")
+
+# A regex that only matches one exact name, e.g., "^example\.com$".
+ANCHORED_EXACT_RE = re.compile(r"^\^((?:[A-Za-z0-9_-]+\\\.)*[A-Za-z0-9_-]+)\$$")
+
+# Backreferences would refer to the wrong group once patterns are merged.
+BACKREFERENCE_RE = re.compile(r"\\[1-9]|\(\?P=")
+
+# Trie key under which the entry indices for a complete suffix are stored.
+# Labels never contain dots, so this cannot collide with a label.
+TERMINAL = '.'
+
+class DomainListMatcher(object):
+    """
+    Index over the entries of a PiHole whitelist (ltype='white') or blacklist
+    (ltype='black') that answers which entries contain a domain without
+    scanning every entry. It is compiled once per list refresh and returns the
+    same entries, in the same order, as
+    PiHoleAdmin.filter_entries_containing_domain:
+
+    * exact entries (types 0 and 1) are kept in a hash table
+    * regex entries (types 2 and 3) of the form "(\\.|^)example\\.com$" are kept
+      in a trie of reversed labels, so matching costs one step per label
+    * regex entries of the form "^example\\.com$" are kept in a hash table
+    * all other regex entries are merged into one alternation that is used to
+      rule out a match with a single regex call, and are only checked one by
+      one if the alternation matches.
+
+    Regex entries that Python cannot compile never match, except by equality.
+    """
+    def __init__(self, entries: list, ltype: str):
+        if ltype is None or ltype.lower().strip() not in ['white', 'black']:
+            raise ValueError(f"Invalid list type: \"{ltype}\"")
+
+        ltype_clean = ltype.lower().strip()
+
+        exact_type, regex_type = (0, 2) if ltype_clean == 'white' else (1, 3)
+
+        self.entries = entries
+        self.ltype = ltype_clean
+
+        # key: domain. Value: list of entry indices.
+        self._exact = dict()
+        self._regex_equal = dict()
+
+        self._suffix_trie = dict()
+
+        # (entry index, compiled regex) tuples.
+        self._regexes = []
+        self._merged_regex = None
+
+        self.invalid_regex_entries = []
+
+        mergeable_patterns = []
+        has_unmergeable_regex = False
+
+        for index, entry in enumerate(entries or []):
+            if entry["type"] == exact_type:
+                self._exact.setdefault(entry["domain"], []).append(index)
+                continue
+
+            if entry["type"] != regex_type:
+                continue
+
+            pattern = entry["domain"]
+
+            self._regex_equal.setdefault(pattern, []).append(index)
+
+            suffix_match = SUFFIX_WILDCARD_RE.match(pattern)
+
+            if suffix_match:
+                self._add_suffix(suffix_match.group(1).split('\\.'), index)
+                continue
+
+            if ANCHORED_EXACT_RE.match(pattern):
+                # ".*^example\.com$" only matches the name itself.
+                self._regex_equal.setdefault(pattern[1:-1].replace('\\.', '.'), []).append(index)
+                continue
+
+            try:
+                self._regexes.append((index, re.compile(f".*{pattern}")))
+            except re.error:
+                self.invalid_regex_entries.append(entry)
+                continue
+
+            if BACKREFERENCE_RE.search(pattern):
+                has_unmergeable_regex = True
+            else:
+                mergeable_patterns.append(f"(?:.*{pattern})")
+
+        if mergeable_patterns and not has_unmergeable_regex:
+            try:
+                self._merged_regex = re.compile("|".join(mergeable_patterns))
+            except re.error:
+                self._merged_regex = None
+
+    def _add_suffix(self, labels, index):
+        node = self._suffix_trie
+
+        for label in reversed(labels):
+            node = node.setdefault(label, dict())
+
+        node.setdefault(TERMINAL, []).append(index)
+
+    def match(self, domain: str, wildcard: bool=False):
+        """
+        Returns list of all list entries containing `domain`.
+        """
+        if not wildcard:
+            return [self.entries[index] for index in self._exact.get(domain, [])]
+
+        indices = set(self._regex_equal.get(domain, []))
+
+        node = self._suffix_trie
+
+        for label in reversed(domain.split('.')):
+            node = node.get(label)
+
+            if node is None:
+                break
+
+            indices.update(node.get(TERMINAL, []))
+
+        if self._regexes and (self._merged_regex is None or self._merged_regex.match(domain)):
+            for index, regex in self._regexes:
+                if regex.match(domain):
+                    indices.add(index)
+
+        return [self.entries[index] for index in sorted(indices)]
+
+def _benchmark_entries(size, regex_count):
+    entries = []
+
+    for i in range(size - regex_count):
+        if i % 4 == 0:
+            entries.append({"domain": f"host{i}.example{i}.com", "type": 0})
+        elif i % 4 == 1:
+            entries.append({"domain": f"^www\\.site{i}\\.org$", "type": 2})
+        else:
+            entries.append({"domain": f"(\\.|^)site{i}\\.net$", "type": 2})
+
+    for i in range(regex_count):
+        entries.append({"domain": f"ads[0-9]+\\.tracker{i}\\.(com|net)$", "type": 2})
+
+    return entries
+
+def main():
+    import time
+    from pi_hole_admin import PiHoleAdmin
+
+    domains = ["www.google.com", "a.b.site2.net", "www.site1.org", "cdn.ads12.tracker3.net", "host0.example0.com", "unrelated.example.co.uk"]
+
+    print(f"{'entries':>8} {'compile ms':>11} {'indexed us/lookup':>18} {'scan us/lookup':>15}")
+
+    for size in [100, 1000, 10000, 50000]:
+        entries = _benchmark_entries(size, 20)
+
+        start = time.perf_counter()
+        matcher = DomainListMatcher(entries, 'white')
+        compile_ms = (time.perf_counter() - start) * 1000
+
+        for domain in domains:
+            for wildcard in [True, False]:
+                if matcher.match(domain, wildcard) != PiHoleAdmin.filter_entries_containing_domain(entries, domain, 'white', wildcard):
+                    raise AssertionError(f"Mismatch for domain {domain} with wildcard {wildcard}")
+
+        iterations = 20000
+
+        start = time.perf_counter()
+        for i in range(iterations):
+            matcher.match(domains[i % len(domains)], True)
+        indexed_us = (time.perf_counter() - start) * 1e6 / iterations
+
+        iterations = max(3, 20000 // size)
+
+        start = time.perf_counter()
+        for i in range(iterations):
+            PiHoleAdmin.filter_entries_containing_domain(entries, domains[i % len(domains)], 'white', True)
+        scan_us = (time.perf_counter() - start) * 1e6 / iterations
+
+        print(f"{size:>8} {compile_ms:>11.1f} {indexed_us:>18.2f} {scan_us:>15.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+import os
+
+def get_file_signature(path):
+    """
+    Returns (size, modification time in nanoseconds) of the file at `path`,
+    which changes whenever the file is rewritten, or None if it does not
+    exist or cannot be read.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return (st.st_size, st.st_mtime_ns)
@@ -0,0 +1,494 @@
+import array
+import bisect
+import struct
+
+import ip_address_utils
+
+MAX_IPV4_VALUE = 4294967295
+MAX_IPV6_VALUE = (1 << 128) - 1
+
+class Uint128Array(object):
+    """
+    Sorted 128-bit values kept as two array('Q') of their high and low 64
+    bits, 16 bytes per value, searched with two C bisects instead of one
+    Python-level comparison per step.
+    """
+    def __init__(self, values=()):
+        self.highs = array.array('Q')
+        self.lows = array.array('Q')
+
+        for value in values:
+            self.append(value)
+
+    def append(self, value):
+        self.highs.append(value >> 64)
+        self.lows.append(value & 0xFFFFFFFFFFFFFFFF)
+
+    def __len__(self):
+        return len(self.highs)
+
+    def __getitem__(self, index):
+        return (self.highs[index] << 64) | self.lows[index]
+
+    def get_memory_size(self):
+        return 16 * len(self.highs)
+
+    def bisect_right(self, value):
+        """
+        Like bisect.bisect_right on the 128-bit values.
+        """
+        high = value >> 64
+
+        highs = self.highs
+
+        end = bisect.bisect_right(highs, high)
+
+        # Most ranges start on a boundary of /64 or shorter, so no other value
+        # has the same high bits.
+        if end == 0 or highs[end - 1] != high:
+            return end
+
+        # Values with the same high bits are sorted by their low bits.
+        start = bisect.bisect_left(highs, high, 0, end - 1)
+
+        return bisect.bisect_right(self.lows, value & 0xFFFFFFFFFFFFFFFF, start, end)
+
+class Ipv6CountryIndex(object):
+    """
+    IPv6 country data of an IP2Location BIN file, like the IPv4 data of
+    CountryIndex but with the range starts in a Uint128Array.
+    """
+    def __init__(self, starts: Uint128Array, country_indices, country_codes):
+        # One more start than country indices: the end of the last range.
+        self.starts = starts
+        self.country_indices = country_indices
+        self.country_codes = country_codes
+
+    def __len__(self):
+        return len(self.country_indices)
+
+    def get_memory_size(self):
+        return self.starts.get_memory_size() + self.country_indices.itemsize * len(self.country_indices)
+
+    def get_country_short(self, address_value):
+        if address_value == MAX_IPV6_VALUE:
+            address_value -= 1
+
+        index = self.starts.bisect_right(address_value) - 1
+
+        if index < 0 or index >= len(self.country_indices):
+            return None
+
+        return self.country_codes[self.country_indices[index]]
+
+class CountryIndex(object):
+    """
+    IPv4 country data of an IP2Location BIN file compiled into two parallel
+    arrays: the sorted start address of every range and the index of its
+    country code in `country_codes`. Adjacent ranges of the same country are
+    merged, so the LITE DB1 database takes about 1 MB.
+
+    Looking up the numeric value of an address is one bisect, and returns the
+    same country code as IP2Location.get_country_short, including None for
+    addresses the file does not cover. The IPv6 data of the file, if it has
+    any, is compiled into `ipv6`.
+    """
+    def __init__(self, starts, country_indices, country_codes, ipv6: Ipv6CountryIndex=None):
+        # One more start than country indices: the end of the last range.
+        self.starts = starts
+        self.country_indices = country_indices
+        self.country_codes = country_codes
+        self.ipv6 = ipv6
+
+    @classmethod
+    def from_bin(cls, bin_file_path):
+        """
+        Compiles the IPv4 rows of the IP2Location BIN file at `bin_file_path`.
+        """
+        with open(bin_file_path, 'rb') as f:
+            data = f.read()
+
+        column_count, ipv4_count, ipv4_address, ipv6_count, ipv6_address = struct.unpack_from('<xBxxxIIII', data, 0)
+
+        if column_count < 2:
+            raise ValueError(f"Invalid IP2Location BIN file {bin_file_path}, has no country column")
+
+        # Rows hold ip_from followed by one 32-bit column per field, country
+        # first. IP2Location reads ip_to from the next row, so there are
+        # ipv4_count + 1 rows and the ip_from of one more.
+        row_starts, row_pointers = _read_rows(data, ipv4_address, ipv4_count, column_count, 1)
+
+        # IPv6 rows start with a 128-bit ip_from, as four little-endian words.
+        ipv6_rows = _read_rows(data, ipv6_address, ipv6_count, column_count, 4) if ipv6_count else ([], [])
+
+        # key: pointer to a country string. Value: index in country_codes.
+        pointer_indices = dict()
+        country_codes = []
+
+        for pointer in set(row_pointers) | set(ipv6_rows[1]):
+            length = data[pointer]
+            country_code = data[pointer + 1 : pointer + 1 + length].decode('iso-8859-1')
+
+            if country_code not in country_codes:
+                country_codes.append(country_code)
+
+            pointer_indices[pointer] = country_codes.index(country_code)
+
+        typecode = 'B' if len(country_codes) <= 256 else 'H'
+
+        starts, country_indices = _merge_rows(row_starts, row_pointers, pointer_indices, array.array('I'), array.array(typecode))
+
+        ipv6 = None
+
+        if ipv6_count:
+            ipv6 = Ipv6CountryIndex(*_merge_rows(ipv6_rows[0], ipv6_rows[1], pointer_indices, Uint128Array(), array.array(typecode)), country_codes)
+
+        return cls(starts, country_indices, country_codes, ipv6)
+
+    @classmethod
+    def from_value_ranges(cls, value_ranges, ipv6_value_ranges=None):
+        """
+        Compiles sorted, disjoint (min value, max value, country code) ranges
+        of IPv4 and, if given, IPv6 address values. Addresses between them get
+        the country code '-', like in the IP2Location LITE databases.
+        """
+        country_codes = sorted({country_code for min_value, max_value, country_code in list(value_ranges) + list(ipv6_value_ranges or [])} | {'-'})
+
+        # The country codes stand in for the pointers to country strings.
+        pointer_indices = {country_code: index for index, country_code in enumerate(country_codes)}
+
+        typecode = 'B' if len(country_codes) <= 256 else 'H'
+
+        starts, country_indices = _merge_rows(*_fill_value_ranges(value_ranges, MAX_IPV4_VALUE), pointer_indices, array.array('I'), array.array(typecode))
+
+        ipv6 = None
+
+        if ipv6_value_ranges is not None:
+            ipv6 = Ipv6CountryIndex(*_merge_rows(*_fill_value_ranges(ipv6_value_ranges, MAX_IPV6_VALUE), pointer_indices, Uint128Array(), array.array(typecode)), country_codes)
+
+        return cls(starts, country_indices, country_codes, ipv6)
+
+    def __len__(self):
+        return len(self.country_indices)
+
+    def get_memory_size(self):
+        """
+        Returns the size in bytes of the compiled arrays.
+        """
+        return self.starts.itemsize * len(self.starts) + self.country_indices.itemsize * len(self.country_indices) + (self.ipv6.get_memory_size() if self.ipv6 is not None else 0)
+
+    def get_country_short(self, address_value):
+        """
+        Returns the country code for the numeric value of an IPv4 address, or
+        None if the database does not cover it.
+        """
+        # Like IP2Location, which has no range ending after 255.255.255.255.
+        if address_value == MAX_IPV4_VALUE:
+            address_value -= 1
+
+        index = bisect.bisect_right(self.starts, address_value) - 1
+
+        if index < 0 or index >= len(self.country_indices):
+            return None
+
+        return self.country_codes[self.country_indices[index]]
+
+    def get_ipv6_country_short(self, address_value):
+        """
+        Returns the country code for the numeric value of an IPv6 address, or
+        None if the database does not cover it. IPv6 addresses that carry an
+        IPv4 address are looked up by that address, like IP2Location does.
+        """
+        ipv4_value = ip_address_utils.ipv6_value_to_ipv4_value(address_value)
+
+        if ipv4_value is not None:
+            return self.get_country_short(ipv4_value)
+
+        if self.ipv6 is None:
+            return None
+
+        return self.ipv6.get_country_short(address_value)
+
+    def get_country_shorts(self, address_values):
+        """
+        Returns the country codes for many numeric IPv4 address values, in
+        the same order, without the attribute lookups of one call per address.
+        """
+        starts = self.starts
+        country_indices = self.country_indices
+        country_codes = self.country_codes
+        range_count = len(country_indices)
+        bisect_right = bisect.bisect_right
+
+        results = []
+
+        for address_value in address_values:
+            index = bisect_right(starts, MAX_IPV4_VALUE - 1 if address_value == MAX_IPV4_VALUE else address_value) - 1
+
+            results.append(country_codes[country_indices[index]] if 0 <= index < range_count else None)
+
+        return results
+
+def _read_rows(data, address, count, column_count, start_words):
+    """
+    Returns the ip_from of the `count` + 2 rows and the country pointers of
+    the `count` + 1 rows at `address` (1-based, like in the header), whose
+    ip_from is `start_words` 32-bit words long.
+    """
+    row_words = column_count - 1 + start_words
+
+    words = array.array('I')
+    words.frombytes(data[address - 1 : address - 1 + ((count + 1) * row_words + start_words) * 4])
+
+    if struct.pack('=I', 1) != struct.pack('<I', 1):
+        words.byteswap()
+
+    row_starts = words[0::row_words]
+
+    for i in range(1, start_words):
+        row_starts = [start | (word << (32 * i)) for start, word in zip(row_starts, words[i::row_words])]
+
+    return row_starts, words[start_words::row_words]
+
+def _fill_value_ranges(value_ranges, max_address_value):
+    """
+    Returns the row starts and country codes of (min value, max value,
+    country code) ranges as _read_rows would read them, with rows of '-'
+    from 0 to `max_address_value` between the ranges.
+    """
+    row_starts = []
+    row_pointers = []
+
+    next_value = 0
+
+    for min_value, max_value, country_code in value_ranges:
+        if min_value < next_value or max_value < min_value or max_value > max_address_value:
+            raise ValueError(f"Invalid value range ({min_value}, {max_value}), should be sorted, disjoint and at most {max_address_value}")
+
+        if min_value > next_value:
+            row_starts.append(next_value)
+            row_pointers.append('-')
+
+        row_starts.append(min_value)
+        row_pointers.append(country_code)
+
+        next_value = max_value + 1
+
+    if next_value <= max_address_value:
+        row_starts.append(next_value)
+        row_pointers.append('-')
+
+    # The ip_to of the last row.
+    row_starts.append(max_address_value)
+
+    return row_starts, row_pointers
+
+def _merge_rows(row_starts, row_pointers, pointer_indices, starts, country_indices):
+    """
+    Appends the rows to `starts` and `country_indices`, merging adjacent rows
+    of the same country.
+    """
+    for start, pointer in zip(row_starts, row_pointers):
+        country_index = pointer_indices[pointer]
+
+        if country_indices and country_indices[-1] == country_index:
+            continue
+
+        starts.append(start)
+        country_indices.append(country_index)
+
+    # IP2Location reads the end of the last row from whatever follows the
+    # rows. If that is below its start, the last row matches nothing.
+    starts.append(max(row_starts[-1], row_starts[-2]))
+
+    return starts, country_indices
+
+# Ranges of the index built by _get_check_index, as (first address, last
+# address, country code).
+_CHECK_RANGES = [
+    ('1.0.0.0', '1.0.0.255', 'AU'),
+    ('1.0.1.0', '1.0.3.255', 'CN'),
+    ('1.0.4.0', '1.0.7.255', 'AU'),
+    ('5.0.0.0', '5.255.255.255', 'RU'),
+    ('255.255.255.0', '255.255.255.255', 'US'),
+]
+
+# Several ranges share their high 64 bits, and the Teredo and 6to4 prefixes
+# have IPv6 rows that lookups must not use.
+_CHECK_IPV6_RANGES = [
+    ('2001::', '2001:0:ffff:ffff:ffff:ffff:ffff:ffff', 'JP'),
+    ('2001:db8:0:1::', '2001:db8:0:1:7fff:ffff:ffff:ffff', 'DE'),
+    ('2001:db8:0:1:8000::', '2001:db8:0:1:8000::ff', 'FR'),
+    ('2001:db8:0:1:8000::100', '2001:db8:0:1:ffff:ffff:ffff:ffff', 'DE'),
+    ('2001:db8:0:2::', '2001:db8:0:2::ffff', 'NL'),
+    ('2002::', '2002:ffff:ffff:ffff:ffff:ffff:ffff:ffff', 'JP'),
+    ('2a00::', '2a00:ffff:ffff:ffff:ffff:ffff:ffff:ffff', 'GB'),
+]
+
+# Addresses and their expected country codes in the index built by
+# _get_check_index.
+_CHECK_ADDRESSES = [
+    ('0.0.0.0', '-'),
+    ('1.0.0.0', 'AU'),
+    ('1.0.0.255', 'AU'),
+    ('1.0.1.0', 'CN'),
+    ('1.0.3.255', 'CN'),
+    ('1.0.4.0', 'AU'),
+    ('1.0.8.0', '-'),
+    ('4.255.255.255', '-'),
+    ('5.0.0.0', 'RU'),
+    ('5.255.255.255', 'RU'),
+    ('6.0.0.0', '-'),
+    ('255.255.254.255', '-'),
+    ('255.255.255.0', 'US'),
+    ('255.255.255.255', 'US'),
+    ('::', '-'),
+    ('2001:db8::ffff', '-'),
+    ('2001:db8:0:1::', 'DE'),
+    ('2001:db8:0:1:7fff:ffff:ffff:ffff', 'DE'),
+    ('2001:db8:0:1:8000::', 'FR'),
+    ('2001:db8:0:1:8000::ff', 'FR'),
+    ('2001:db8:0:1:8000::100', 'DE'),
+    ('2001:db8:0:1:ffff:ffff:ffff:ffff', 'DE'),
+    ('2001:db8:0:2::', 'NL'),
+    ('2001:db8:0:2::ffff', 'NL'),
+    ('2001:db8:0:2::1:0', '-'),
+    ('2001:db8:0:3::', '-'),
+    ('2a00::1', 'GB'),
+    ('ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff', '-'),
+    # IPv4-mapped addresses.
+    ('::ffff:1.0.1.1', 'CN'),
+    ('::ffff:5.1.2.3', 'RU'),
+    ('::ffff:6.0.0.0', '-'),
+    # 6to4 addresses carry the IPv4 address in bits 80 to 111.
+    ('2002:100:1::1', 'AU'),
+    ('2002:500:1::', 'RU'),
+    ('2002:600::', '-'),
+    # Teredo addresses carry the IPv4 address inverted in the low 32 bits.
+    ('2001:0:4136:e378:8000:63bf:fafe:fefe', 'RU'),
+    ('2001:0:4136:e378:8000:63bf:feff:fefe', 'CN'),
+    ('2001::', 'US'),
+    ('2001::ffff:ffff', '-'),
+]
+
+def _get_check_index():
+    """
+    Returns a CountryIndex of _CHECK_RANGES and _CHECK_IPV6_RANGES.
+    """
+    return CountryIndex.from_value_ranges(
+        [(ip_address_utils.get_value(first), ip_address_utils.get_value(last), country_code) for first, last, country_code in _CHECK_RANGES],
+        [(ip_address_utils.get_ipv6_value(first), ip_address_utils.get_ipv6_value(last), country_code) for first, last, country_code in _CHECK_IPV6_RANGES])
+
+def _check_index():
+    """
+    Checks the lookups of _CHECK_ADDRESSES in the index of _get_check_index.
+    """
+    index = _get_check_index()
+
+    for ip, expected_code in _CHECK_ADDRESSES:
+        if ':' in ip:
+            actual_code = index.get_ipv6_country_short(ip_address_utils.get_ipv6_value(ip))
+        else:
+            actual_code = index.get_country_short(ip_address_utils.get_value(ip))
+
+            batch_code = index.get_country_shorts([ip_address_utils.get_value(ip)])[0]
+
+            if batch_code != actual_code:
+                raise AssertionError(f"Mismatch for {ip}: index {actual_code}, batch {batch_code}")
+
+        if actual_code != expected_code:
+            raise AssertionError(f"Mismatch for {ip}: expected {expected_code}, index {actual_code}")
+
+    print(f"{len(_CHECK_ADDRESSES)} addresses in {len(index)} IPv4 and {len(index.ipv6)} IPv6 check ranges agree")
+
+def main():
+    """
+    Checks lookups in an index of a few ranges, then checks the index of the
+    BIN file given as argument (or in IP2LOCATION_BIN_FILE_PATH), if there is
+    one, against IP2Location.get_country_short on random IPv4 and IPv6
+    addresses and compares their lookup times.
+    """
+    import os
+    import random
+    import socket
+    import sys
+    import time
+
+    _check_index()
+
+    bin_file_path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('IP2LOCATION_BIN_FILE_PATH', 'IP2LOCATION-LITE-DB1.BIN')
+
+    if not os.path.exists(bin_file_path):
+        print(f"No BIN file at {bin_file_path}, skipped the comparison with IP2Location")
+        return
+
+    import IP2Location
+
+    start = time.perf_counter()
+    index = CountryIndex.from_bin(bin_file_path)
+    compile_ms = (time.perf_counter() - start) * 1000
+
+    print(f"Compiled {len(index)} ranges of {len(index.country_codes)} countries in {compile_ms:.0f} ms, {index.get_memory_size() / 1024 / 1024:.2f} MB")
+
+    client = IP2Location.IP2Location(filename=bin_file_path, mode='SHARED_MEMORY')
+
+    rng = random.Random(18)
+
+    # Random addresses, plus the edges of ranges and of the address space.
+    address_values = [rng.randrange(MAX_IPV4_VALUE + 1) for _ in range(100000)]
+    address_values += [0, 1, MAX_IPV4_VALUE - 1, MAX_IPV4_VALUE]
+    address_values += [max(0, index.starts[i] + delta) for i in rng.sample(range(len(index.starts)), min(10000, len(index.starts))) for delta in (-1, 0, 1)]
+    address_values = [min(MAX_IPV4_VALUE, value) for value in address_values]
+
+    ips = [socket.inet_ntoa(struct.pack('!I', value)) for value in address_values]
+
+    start = time.perf_counter()
+    expected = [client.get_country_short(ip) for ip in ips]
+    library_us = (time.perf_counter() - start) * 1e6 / len(ips)
+
+    start = time.perf_counter()
+    actual = [index.get_country_short(value) for value in address_values]
+    index_us = (time.perf_counter() - start) * 1e6 / len(ips)
+
+    start = time.perf_counter()
+    batch = index.get_country_shorts(address_values)
+    batch_us = (time.perf_counter() - start) * 1e6 / len(ips)
+
+    for ip, expected_code, actual_code, batch_code in zip(ips, expected, actual, batch):
+        if not expected_code == actual_code == batch_code:
+            raise AssertionError(f"Mismatch for {ip}: IP2Location {expected_code}, index {actual_code}, batch {batch_code}")
+
+    print(f"{len(ips)} addresses agree. IP2Location: {library_us:.2f} us/address, index: {index_us:.2f} us/address, batch: {batch_us:.2f} us/address")
+
+    if index.ipv6 is None:
+        print("No IPv6 data")
+        return
+
+    # Random addresses, the edges of ranges and addresses carrying an IPv4
+    # address.
+    starts = index.ipv6.starts
+
+    address_values = [rng.randrange(MAX_IPV6_VALUE + 1) for _ in range(20000)]
+    address_values += [0, 1, MAX_IPV6_VALUE - 1, MAX_IPV6_VALUE]
+    address_values += [max(0, starts[i] + delta) for i in rng.sample(range(len(starts)), min(10000, len(starts))) for delta in (-1, 0, 1)]
+    address_values += [ip_address_utils.get_ipv6_value(prefix) | rng.randrange(1 << 32) << shift for prefix, shift in [('::ffff:0:0', 0), ('2002::', 80), ('2001::', 0)] for _ in range(1000)]
+    address_values = [min(MAX_IPV6_VALUE, value) for value in address_values]
+
+    ips = [ip_address_utils.value_to_ipv6(value) for value in address_values]
+
+    start = time.perf_counter()
+    expected = [client.get_country_short(ip) for ip in ips]
+    library_us = (time.perf_counter() - start) * 1e6 / len(ips)
+
+    start = time.perf_counter()
+    actual = [index.get_ipv6_country_short(value) for value in address_values]
+    index_us = (time.perf_counter() - start) * 1e6 / len(ips)
+
+    for ip, expected_code, actual_code in zip(ips, expected, actual):
+        if expected_code != actual_code:
+            raise AssertionError(f"Mismatch for {ip}: IP2Location {expected_code}, index {actual_code}")
+
+    print(f"{len(ips)} IPv6 addresses in {len(index.ipv6)} ranges agree. IP2Location: {library_us:.2f} us/address, index: {index_us:.2f} us/address")
+
+if __name__ == "__main__":
+    main()
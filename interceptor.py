@@ -1,81 +1,463 @@
-import traceback
-from twisted.names import dns, server, client, cache
+import logging
+import time
+from twisted.names import dns, client
 from twisted.application import service, internet
+from twisted.web.server import Site
 
-import tldextract
 import re
 import os
-import IP2Location
 import datetime
 from constants import DB_FILE_NAME
 from pi_hole_admin import PiHoleAdmin
 
 import sqlite_utils
+from verdict_logger import VerdictLogger
+from whitelist_refresher import WhitelistRefresher
+from verdict_cache import VerdictCache
+from single_flight import SingleFlight
+from shared_geo_cache import SharedGeoCache
+from reuse_port import ReusePortServer
+from policy_reloader import GeoPolicy, PolicyReloader, read_blocked_countries
+from upstream_pool import UpstreamPool, parse_upstream_servers
+from upstream_transport import TRANSPORTS, UpstreamConnectionPool
+from warm_start import WarmStartSnapshot
+from blocked_response import BlockedNameCache, BlockedResponse
+from client_policy import ClientPolicies, ClientPolicyDNSServerFactory, read_client_policies
+from prefetcher import Prefetcher, TrackingCacheResolver
+from stage_profiler import NULL_TIMER, StageProfiler
+from async_log import AsyncLog
+import interceptor_supervisor
 
 import pylru
 
+import answer_utils
+import ip_address_utils
+import metrics
+import registrable_domain
+
 INTERCEPTOR_UPSTREAM_DNS_IP = os.environ["INTERCEPTOR_UPSTREAM_DNS_SERVER_IP"]
 INTERCEPTOR_UPSTREAM_DNS_PORT = int(os.environ["INTERCEPTOR_UPSTREAM_DNS_SERVER_PORT"])
 PORT = int(os.environ["INTERCEPTOR_PORT"])
+VERDICT_QUEUE_SIZE = int(os.environ.get("VERDICT_QUEUE_SIZE", 10000))
+VERDICT_BATCH_SIZE = int(os.environ.get("VERDICT_BATCH_SIZE", 500))
+VERDICT_FLUSH_SEC = float(os.environ.get("VERDICT_FLUSH_SEC", 2.0))
+WHITELIST_MAX_STALE_SEC = int(os.environ.get("WHITELIST_MAX_STALE_SEC", 3600))
+VERDICT_CACHE_SIZE = int(os.environ.get("VERDICT_CACHE_SIZE", 10000))
+
+# Set by interceptor_supervisor.py when running as one of several workers.
+REUSE_PORT = int(os.environ.get("INTERCEPTOR_REUSE_PORT", 0)) != 0
+SHARED_GEO_CACHE = os.environ.get("INTERCEPTOR_SHARED_GEO_CACHE")
+STATS_FILE = os.environ.get("INTERCEPTOR_STATS_FILE")
+WORKER_INDEX = os.environ.get("INTERCEPTOR_WORKER_INDEX")
+
+# Comma separated "ip:port" list. Defaults to the single upstream above.
+UPSTREAM_DNS_SERVERS = parse_upstream_servers(os.environ.get("INTERCEPTOR_UPSTREAM_DNS_SERVERS", "")) or [(INTERCEPTOR_UPSTREAM_DNS_IP, INTERCEPTOR_UPSTREAM_DNS_PORT)]
+UPSTREAM_HEDGE_PERCENTILE = float(os.environ.get("INTERCEPTOR_UPSTREAM_HEDGE_PERCENTILE", 0)) or None
+
+# One of udp, tcp or tls (DNS over TLS). TCP and TLS use persistent
+# connections, up to UPSTREAM_CONNECTIONS per upstream server.
+UPSTREAM_TRANSPORT = os.environ.get("INTERCEPTOR_UPSTREAM_TRANSPORT", "udp").lower()
+UPSTREAM_CONNECTIONS = int(os.environ.get("INTERCEPTOR_UPSTREAM_CONNECTIONS", 2))
+UPSTREAM_TLS_HOSTNAME = os.environ.get("INTERCEPTOR_UPSTREAM_TLS_HOSTNAME")
+
+# How blocked queries are answered: nxdomain, refused or sinkhole (0.0.0.0
+# and ::). Clients may cache the answer for BLOCKED_RESPONSE_TTL seconds, and
+# repeated queries for the name are blocked without an upstream lookup for as
+# long.
+BLOCKED_RESPONSE = os.environ.get("BLOCKED_RESPONSE", "nxdomain").lower()
+BLOCKED_RESPONSE_TTL = int(os.environ.get("BLOCKED_RESPONSE_TTL", 300))
+
+# Prometheus metrics are served on this port if set. Each worker serves
+# METRICS_PORT plus its worker index.
+METRICS_PORT = int(os.environ.get("INTERCEPTOR_METRICS_PORT", 0))
+METRICS_INTERFACE = os.environ.get("INTERCEPTOR_METRICS_INTERFACE", "127.0.0.1")
+
+if METRICS_PORT and WORKER_INDEX is not None:
+    METRICS_PORT += int(WORKER_INDEX)
+
+# Caches are saved here every SNAPSHOT_SEC seconds and restored on startup.
+# Each worker keeps its own snapshot, next to this file by default.
+SNAPSHOT_FILE = os.environ.get("INTERCEPTOR_SNAPSHOT_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".interceptor_snapshot.json"))
+SNAPSHOT_SEC = int(os.environ.get("INTERCEPTOR_SNAPSHOT_SEC", 300))
+
+if SNAPSHOT_FILE and WORKER_INDEX is not None:
+    SNAPSHOT_FILE = f"{SNAPSHOT_FILE}.{WORKER_INDEX}"
+
+STARTED_AT = time.monotonic()
+
+# Budget for refreshing popular names before they expire. 0 disables it.
+PREFETCH_QPS = float(os.environ.get("PREFETCH_QPS", 5))
+PREFETCH_TOP_NAMES = int(os.environ.get("PREFETCH_TOP_NAMES", 1000))
+
+# Fraction of queries whose assessment is timed stage by stage. Sending
+# SIGUSR2 profiles the next PROFILE_CAPTURE_QUERIES queries with cProfile and
+# writes the capture to PROFILE_CAPTURE_FILE.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_CAPTURE_QUERIES = int(os.environ.get("PROFILE_CAPTURE_QUERIES", 100))
+PROFILE_CAPTURE_FILE = os.environ.get("PROFILE_CAPTURE_FILE", ".interceptor_profile.pstats")
+
+if WORKER_INDEX is not None:
+    PROFILE_CAPTURE_FILE = f"{PROFILE_CAPTURE_FILE}.{WORKER_INDEX}"
+
+# Per-query messages are logged at INFO (verdicts) and DEBUG (details). At
+# most LOG_BURST messages of each kind are written at once and LOG_RATE_PER_SEC
+# on average, and only a LOG_SAMPLE_RATE fraction of INFO and DEBUG messages.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "WARNING")
+LOG_RATE_PER_SEC = float(os.environ.get("LOG_RATE_PER_SEC", 1))
+LOG_BURST = int(os.environ.get("LOG_BURST", 10))
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+log = logging.getLogger('interceptor')
+
+# Each client (by source address) may send RATE_LIMIT_BURST queries at once
+# and RATE_LIMIT_QPS per second on average, and at most MAX_OUTSTANDING_LOOKUPS
+# queries may wait for an upstream lookup. Queries over either limit are
+# answered with REFUSED or dropped (RATE_LIMIT_ACTION). 0 disables a limit.
+RATE_LIMIT_QPS = float(os.environ.get("RATE_LIMIT_QPS", 0))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 0))
+RATE_LIMIT_ACTION = os.environ.get("RATE_LIMIT_ACTION", "refused").lower()
+RATE_LIMIT_EXEMPT = [_.strip() for _ in os.environ.get("RATE_LIMIT_EXEMPT", "").split(",") if _.strip()]
+MAX_OUTSTANDING_LOOKUPS = int(os.environ.get("MAX_OUTSTANDING_LOOKUPS", 0))
+
+# The blocked countries are read from BLOCKED_COUNTRIES_FILE if it exists,
+# instead of BLOCKED_COUNTRIES_LIST. The file and the IP2Location BIN file are
+# checked for changes every POLICY_CHECK_SEC seconds (0 disables it) and
+# reloaded on SIGHUP, without restarting.
+BLOCKED_COUNTRIES_FILE = os.environ.get("BLOCKED_COUNTRIES_FILE") or None
+POLICY_CHECK_SEC = int(os.environ.get("POLICY_CHECK_SEC", 30))
+
+# Comma separated IPv4 and IPv6 CIDRs (or addresses). Answers with an address
+# in IP_DENY_LIST are blocked, even for whitelisted names, and addresses in
+# IP_ALLOW_LIST are permitted whatever their country.
+IP_ALLOW_LIST = [_.strip() for _ in os.environ.get("IP_ALLOW_LIST", "").split(",") if _.strip()]
+IP_DENY_LIST = [_.strip() for _ in os.environ.get("IP_DENY_LIST", "").split(",") if _.strip()]
+
+# Clients in the subnets of a policy in CLIENT_POLICIES_FILE are assessed with
+# its blocked countries and whitelist groups instead of BLOCKED_COUNTRIES_LIST
+# and GROUP_IDS. Read on startup. The client of a query is the address in its
+# EDNS Client Subnet option, which Pi-hole adds with the dnsmasq option
+# add-subnet, or else its source address. If CLIENT_SUBNET_SOURCES (comma
+# separated addresses) is set, the option is only used from those sources.
+CLIENT_POLICIES_FILE = os.environ.get("CLIENT_POLICIES_FILE") or None
+CLIENT_SUBNET_SOURCES = [_.strip() for _ in os.environ.get("CLIENT_SUBNET_SOURCES", "").split(",") if _.strip()]
+
+if BLOCKED_COUNTRIES_FILE and os.path.exists(BLOCKED_COUNTRIES_FILE):
+    BLOCKED_COUNTRIES = read_blocked_countries(BLOCKED_COUNTRIES_FILE)
+else:
+    BLOCKED_COUNTRIES = [_.upper() for _ in os.environ["BLOCKED_COUNTRIES_LIST"].split(",")]
 
 class MapResolver(client.Resolver):
-    def __init__(self, servers, blocked_countries_list, ip2location_bin_file_path='IP2LOCATION-LITE-DB1.BIN', ip2location_mode='SHARED_MEMORY', domain_data_db_file=DB_FILE_NAME, whitelist_cache_sec=180):
+    def __init__(self, servers, blocked_countries_list, ip2location_bin_file_path='IP2LOCATION-LITE-DB1.BIN', ip2location_mode='SHARED_MEMORY', domain_data_db_file=DB_FILE_NAME, whitelist_cache_sec=180, whitelist_max_stale_sec=3600, group_ids=None, verdict_logger=None, verdict_cache_size=10000, shared_geo_cache_name=None, hedge_percentile=None, upstream_transport='udp', upstream_connections=2, tls_hostname=None, blocked_response_mode='nxdomain', blocked_response_ttl=300, stage_profiler=None, ip_allow_list=None, ip_deny_list=None):
         client.Resolver.__init__(self, servers=servers)
-        self.extractor = tldextract.TLDExtract(cache_dir=os.environ['TLDEXTRACT_CACHE'])
+
+        if upstream_transport not in TRANSPORTS:
+            raise ValueError(f"Invalid upstream transport '{upstream_transport}', should be one of {', '.join(TRANSPORTS)}")
+
+        # Orders upstream servers by health and latency for every query.
+        self.upstream_pool = UpstreamPool(servers, hedge_percentile=hedge_percentile)
+
+        # Persistent connections per upstream server, used for every query
+        # with the tcp and tls transports and for truncated UDP answers.
+        self.upstream_transport = upstream_transport
+        self.upstream_connections = upstream_connections
+        self.tls_hostname = tls_hostname
+        self.upstream_connection_pools = dict()
+
+        # Compiled public suffix list, shared with anything else in this
+        # process that needs registrable domains.
+        self.domain_extractor = registrable_domain.get_extractor(os.environ['TLDEXTRACT_CACHE'])
 
         self.pi_hole_client = PiHoleAdmin(os.environ['PI_HOLE_URL'], pi_hole_password_env_var="PI_HOLE_PW")
 
-        self.last_whitelist_refresh_time = None
+        if group_ids is None:
+            group_ids = re.split(r',', os.environ['GROUP_IDS'])
+
+        # Refreshed in the background, queries only read the last snapshot.
+        self.whitelist_refresher = WhitelistRefresher(self.pi_hole_client, groups=group_ids, refresh_interval_sec=whitelist_cache_sec, max_staleness_sec=whitelist_max_stale_sec)
 
-        self.whitelist_cache_sec = whitelist_cache_sec
+        # Incremented whenever the blocked countries change, so that cached
+        # verdicts are invalidated.
+        self.policy_generation = 0
 
-        self.blocked_countries_list = list(blocked_countries_list)
+        self.ip2location_bin_file_path = ip2location_bin_file_path
+        self.ip2location_mode = ip2location_mode
 
-        self.ip2location_client = IP2Location.IP2Location(filename=ip2location_bin_file_path, mode=ip2location_mode)
+        # Country data and blocked countries. In COMPILED mode the country
+        # data is compiled into memory once and looked up without IP2Location.
+        # Replaced as a whole when reloaded.
+        self.geo_policy = GeoPolicy.load(blocked_countries_list, ip2location_bin_file_path, ip2location_mode)
+
+        # key: query type. Value: CidrSet of the IP CIDRs whose addresses are
+        # always permitted or blocked.
+        self.ip_allow_lists = self.compile_ip_list(ip_allow_list or [])
+        self.ip_deny_lists = self.compile_ip_list(ip_deny_list or [])
 
         self.ttl = 10
 
-        # key: ip address. Value: country code
-        self.cached_ip_lookups = pylru.lrucache(10000)
+        # key: numeric value of ip address. Value: country code. Shared with
+        # the other workers if running under interceptor_supervisor.py
+        if shared_geo_cache_name is not None:
+            self.cached_ip_lookups = SharedGeoCache(shared_geo_cache_name)
+        else:
+            self.cached_ip_lookups = pylru.lrucache(10000)
+
+        # key: numeric value of ipv6 address. Value: country code. Not shared,
+        # SharedGeoCache only holds IPv4 addresses.
+        self.cached_ipv6_lookups = pylru.lrucache(10000)
 
         self.domain_data_db_file = domain_data_db_file
 
+        # Write-behind logger for verdicts. Verdicts are written synchronously
+        # if no logger is provided.
+        self.verdict_logger = verdict_logger
+
+        # Verdicts for recently seen (name, answer) pairs.
+        self.verdict_cache = VerdictCache(self.log_reason, max_size=verdict_cache_size)
+
+        # Concurrent lookups for the same (name, class, type) share one
+        # assessment. Identical upstream queries in flight are already merged
+        # by client.Resolver.
+        self.single_flight = SingleFlight()
+
+        self.blocked_response = BlockedResponse(blocked_response_mode, blocked_response_ttl)
+
+        # Recently blocked names are answered without an upstream lookup.
+        self.blocked_names = BlockedNameCache(ttl=blocked_response_ttl, max_size=verdict_cache_size)
+
+        self.stats = {
+            'permitted_assessed': 0,
+            'blocked_assessed': 0,
+            'permitted_verdict_cache': 0,
+            'blocked_verdict_cache': 0,
+            'blocked_short_circuit': 0,
+            'ip_lookup_hits': 0,
+            'ip_lookup_misses': 0,
+            'ip_allow_list_matches': 0,
+            'ip_deny_list_matches': 0,
+        }
+
+        # Times the stages of assessing a sample of the queries.
+        self.stage_profiler = stage_profiler if stage_profiler is not None else StageProfiler()
+
+        # Set if the caches are saved across restarts.
+        self.warm_start_snapshot = None
+
+        # Set if popular names are refreshed before they expire.
+        self.prefetcher = None
+
+        # Set if log messages are written by a background thread.
+        self.async_log = None
+
+        # Set if the country data and blocked countries are reloaded when they
+        # change.
+        self.policy_reloader = None
+
+        # Set if some clients are assessed under their own policy.
+        self.client_policies = None
+
+    @staticmethod
+    def compile_ip_list(ip_cidrs):
+        """
+        Splits IPv4 and IPv6 CIDRs `ip_cidrs` into a CidrSet for A and one for
+        AAAA answers.
+        """
+        return {dns.A: ip_address_utils.CidrSet([ip_cidr for ip_cidr in ip_cidrs if ':' not in ip_cidr]), dns.AAAA: ip_address_utils.CidrSet([ip_cidr for ip_cidr in ip_cidrs if ':' in ip_cidr], ipv6=True)}
+
+    def set_blocked_countries(self, blocked_countries_list):
+        self.geo_policy = self.geo_policy.with_blocked_countries(blocked_countries_list)
+
+        self.policy_generation += 1
+
+    def swap_geo_policy(self, geo_policy, country_data_changed):
+        """
+        Assesses queries with `geo_policy` from now on. Unlike
+        set_blocked_countries, cached verdicts are kept, and it is up to the
+        caller to discard the ones that `geo_policy` changes.
+        """
+        self.geo_policy = geo_policy
+
+        if country_data_changed:
+            self.cached_ip_lookups.clear()
+            self.cached_ipv6_lookups.clear()
+
+            if self.client_policies is not None:
+                self.client_policies.swap_country_data(geo_policy)
+
+    def get_policy_key(self, client_policy=None):
+        """
+        Key that changes whenever something that verdicts (of the clients of
+        `client_policy`, if given) depend on changes.
+        """
+        policy = self if client_policy is None else client_policy
+
+        return (policy.policy_generation, policy.whitelist_refresher.generation, policy.whitelist_refresher.is_serving_snapshot())
+
+    def get_stats(self):
+        """
+        Statistics of this resolver's components, flattened into one dict.
+        """
+        stats = dict()
+
+        for prefix, component in [('resolver', self), ('verdict_logger', self.verdict_logger), ('whitelist', self.whitelist_refresher), ('verdict_cache', self.verdict_cache), ('single_flight', self.single_flight), ('upstream', self.upstream_pool), ('snapshot', self.warm_start_snapshot), ('prefetch', self.prefetcher), ('blocked_names', self.blocked_names), ('profiler', self.stage_profiler), ('log', self.async_log), ('domain', self.domain_extractor), ('reload', self.policy_reloader), ('client_policy', self.client_policies)]:
+            if component is not None:
+                for key, value in component.stats.items():
+                    stats[f"{prefix}_{key}"] = value
+
+        for stage, summary in self.stage_profiler.get_summary().items():
+            stats[f"profiler_{stage}_p99_sec"] = summary['p99']
+
+        for address, server_stats in self.upstream_pool.get_server_stats().items():
+            for key in ['queries', 'responses', 'failures']:
+                stats[f"upstream_{address}_{key}"] = server_stats[key]
+
+        for connection_pool in self.upstream_connection_pools.values():
+            for key, value in connection_pool.stats.items():
+                stats[f"upstream_stream_{key}"] = stats.get(f"upstream_stream_{key}", 0) + value
+
+        return stats
+
+    def get_metrics(self):
+        """
+        Metric families of this resolver and its components.
+        """
+        families = [
+            metrics.counter('interceptor_verdicts_total', 'Allow/block verdicts by where they came from.', [({'verdict': verdict, 'source': source}, self.stats[f"{verdict}_{source}"]) for verdict, source in [('permitted', 'assessed'), ('blocked', 'assessed'), ('permitted', 'verdict_cache'), ('blocked', 'verdict_cache'), ('blocked', 'short_circuit')]]),
+            metrics.counter('interceptor_ip_lookups_total', 'IP to country lookups by whether cached_ip_lookups had the address.', [({'result': 'hit'}, self.stats['ip_lookup_hits']), ({'result': 'miss'}, self.stats['ip_lookup_misses'])]),
+            metrics.counter('interceptor_ip_list_matches_total', 'Answers decided by the IP allow or deny list.', [({'list': 'allow'}, self.stats['ip_allow_list_matches']), ({'list': 'deny'}, self.stats['ip_deny_list_matches'])]),
+        ]
+
+        for component in [self.verdict_logger, self.whitelist_refresher, self.upstream_pool, self.stage_profiler, self.async_log, self.policy_reloader, self.client_policies]:
+            if component is not None:
+                families.extend(component.get_metrics())
+
+        return families
+
+    def get_upstream_connection_pool(self, address):
+        connection_pool = self.upstream_connection_pools.get(address)
+
+        if connection_pool is None:
+            connection_pool = UpstreamConnectionPool(address, size=self.upstream_connections, tls=self.upstream_transport == 'tls', tls_hostname=self.tls_hostname)
+
+            self.upstream_connection_pools[address] = connection_pool
+
+        return connection_pool
+
+    def _query_connection_pool(self, address, queries, timeout):
+        return self.get_upstream_connection_pool(address).query(queries, timeout)
+
+    def pickServer(self):
+        return self.upstream_pool.pick_address()
+
+    def queryUDP(self, queries, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        if self.upstream_transport == 'udp':
+            return self.upstream_pool.query(self._query, queries, timeout)
+
+        return self.upstream_pool.query(self._query_connection_pool, queries, timeout)
+
+    def queryTCP(self, queries, timeout=10):
+        return self.get_upstream_connection_pool(self.pickServer()).query(queries, timeout)
+
     def get_domain_from_fqdn(self, fqdn):
-        result = self.extractor(fqdn)
+        return self.domain_extractor.get_domain(fqdn)
+
+    def get_blocked_verdict(self, name, client_policy=None):
+        """
+        Returns the Verdict if `name` was recently blocked (for the clients of
+        `client_policy`, if given), or None.
+        """
+        policy = self if client_policy is None else client_policy
+
+        verdict = policy.blocked_names.get(name.decode('utf-8'), self.get_policy_key(client_policy))
+
+        if verdict is not None:
+            policy.verdict_cache.mark_seen(name.decode('utf-8'), verdict)
 
-        if result.suffix is not None and result.suffix.strip() != '':
-            return f"{result.domain}.{result.suffix}"
+        return verdict
 
-        return None
+    def lookupIPV6Address(self, name, timeout=None):
+        return self.lookup_and_assess(name, dns.AAAA, timeout)
 
     def lookupAddress(self, name, timeout=None):
-        lookup_result = self._lookup(name, dns.IN, dns.A, timeout)
-        lookup_result.addCallback(lambda value: self.assess_and_log_reason(value, name))
-        return lookup_result
+        return self.lookup_and_assess(name, dns.A, timeout)
+
+    def lookup_and_assess(self, name, type, timeout=None, client_policy=None):
+        """
+        Looks up the `type` (A or AAAA) records of `name` and assesses the
+        answer, under `client_policy` if given.
+        """
+        if self.get_blocked_verdict(name, client_policy) is not None:
+            self.stats['blocked_short_circuit'] += 1
+
+            return self.blocked_response.get(name, type)
+
+        key = (name, dns.IN, type) if client_policy is None else (name, dns.IN, type, client_policy.name)
 
-    def log_reason(self, name, domain, reason, permitted):
-        right_now = datetime.datetime.now(tz=datetime.timezone.utc)
+        return self.single_flight.run(key, self._lookup_and_assess, name, dns.IN, type, timeout, client_policy)
 
-        sqlite_utils.log_reason(self.domain_data_db_file, [{'name': name, 'domain': domain, 'reason': reason, 'permitted': permitted, 'first_time_seen': right_now, 'last_time_seen': right_now}], ['permitted', 'reason', 'last_time_seen'])
+    def _lookup_and_assess(self, name, cls, type, timeout, client_policy=None):
+        lookup_result = self._lookup(name, cls, type, timeout)
+        lookup_result.addCallback(lambda value: self.assess_and_log_reason(value, name, type, client_policy))
+        return lookup_result
 
-    def assess_and_log_reason(self, value, name):
-        right_now = datetime.datetime.now(tz=datetime.timezone.utc)
+    def log_reason(self, name, domain, reason, permitted, right_now=None):
+        if right_now is None:
+            right_now = datetime.datetime.now(tz=datetime.timezone.utc)
 
-        if self.last_whitelist_refresh_time is None or right_now - self.last_whitelist_refresh_time > datetime.timedelta(seconds=self.whitelist_cache_sec):
-            print(f"Doing refresh. Current time is {right_now}, last time was {self.last_whitelist_refresh_time}")
-            do_refresh = True
-            self.last_whitelist_refresh_time = right_now
+        if self.verdict_logger is not None:
+            self.verdict_logger.log(name, domain, reason, permitted, right_now)
         else:
-            do_refresh = False
+            sqlite_utils.log_reason(self.domain_data_db_file, [{'name': name, 'domain': domain, 'reason': reason, 'permitted': permitted, 'first_time_seen': right_now, 'last_time_seen': right_now}], ['permitted', 'reason', 'last_time_seen'])
+
+    def assess_and_log_reason(self, value, name, type=dns.A, client_policy=None):
+        timer = self.stage_profiler.start()
+
+        try:
+            return self._assess_and_log_reason(value, name, timer, type, client_policy)
+        finally:
+            timer.finish()
+
+    def _assess_and_log_reason(self, value, name, timer, type, client_policy):
+        # The verdicts and whitelist of the clients of `client_policy`, or
+        # the default ones.
+        policy = self if client_policy is None else client_policy
+
+        address_values = answer_utils.get_address_values(value, type)
+
+        timer.mark('answer_parsing')
+
+        verdict = policy.verdict_cache.get(name.decode('utf-8'), frozenset(address_values), self.get_policy_key(client_policy), type)
 
-        applicable_whitelist_entries = self.pi_hole_client.get_whitelist_or_blacklist_entries_containing_domain(name.decode('utf-8'), ltype='white', bust_cache=do_refresh, wildcard=True, only_enabled=True, groups=re.split(r',', os.environ['GROUP_IDS']))
+        timer.mark('verdict_cache')
+
+        if verdict is not None:
+            if verdict.permitted:
+                self.stats['permitted_verdict_cache'] += 1
+
+                return value
+
+            self.stats['blocked_verdict_cache'] += 1
+
+            policy.blocked_names.put(name.decode('utf-8'), verdict)
+
+            return self.blocked_response.get(name, type)
+
+        applicable_whitelist_entries = policy.whitelist_refresher.get_entries_containing_domain(name.decode('utf-8'))
 
         has_whitelist_entry = applicable_whitelist_entries is not None and applicable_whitelist_entries != []
 
-        if do_refresh or has_whitelist_entry:
-            print(f"Applicable whitelist entries for domain {name} are {applicable_whitelist_entries}")
+        if has_whitelist_entry:
+            log.debug("Applicable whitelist entries for domain %s are %s", name, applicable_whitelist_entries)
+
+        timer.mark('whitelist')
+
+        reason, response = self.assess_found_ips(value, has_whitelist_entry, address_values, timer, type, policy.geo_policy)
 
-        reason, response = self.assess_found_ips(value, has_whitelist_entry)
+        domain_name = None
+        logged = False
 
         # We want to log the domain name only (e.g., the 'example.com' in
         # 'my.example.com' or 'www.example.com') if the domain is permitted.
@@ -85,84 +467,267 @@ class MapResolver(client.Resolver):
             if not response:
                 domain_name = self.get_domain_from_fqdn(name.decode('utf-8'))
 
+                timer.mark('registrable_domain')
+
                 self.log_reason(name.decode('utf-8'), domain_name, reason, False)
+                logged = True
 
-                print(f"Saving domain name \"{domain_name}\" that corresponds to FQDN \"{name}\" that was not permitted")
+                log.debug("Saving domain name \"%s\" that corresponds to FQDN \"%s\" that was not permitted", domain_name, name)
             else:
                 domain_name = self.get_domain_from_fqdn(name.decode('utf-8'))
 
+                timer.mark('registrable_domain')
+
                 if domain_name is not None:
-                    print(f"Saving domain name \"{domain_name}\" that corresponds to FQDN \"{name}\" that was permitted")
+                    log.debug("Saving domain name \"%s\" that corresponds to FQDN \"%s\" that was permitted", domain_name, name)
 
                     self.log_reason(name.decode('utf-8'), domain_name, reason, True)
+                    logged = True
                 else:
                     raise ValueError(f"Could not get domain name from \"{name}\"")
 
         except BaseException as be:
-            traceback.print_exc()
-            print(f"Could not log reason '{reason}' for name '{name}' due to exception '{be}'")
+            log.error("Could not log reason '%s' for name '%s' due to exception '%s'", reason, name, be, exc_info=True)
+
+        timer.mark('sqlite')
+
+        verdict = policy.verdict_cache.put(name.decode('utf-8'), frozenset(address_values), answer_utils.get_min_ttl(value), domain_name, reason, bool(response), logged, type)
+
+        timer.mark('verdict_cache')
+
+        if not response:
+            self.stats['blocked_assessed'] += 1
+
+            policy.blocked_names.put(name.decode('utf-8'), verdict)
+
+            return self.blocked_response.get(name, type)
+
+        self.stats['permitted_assessed'] += 1
 
         return response
 
-    def assess_found_ips(self, value, skip_country_validation):
-        print(value)
+    def get_country_code(self, address_value, type=dns.A):
+        """
+        Gets country code for the numeric value of an IPv4 (or, for AAAA,
+        IPv6) address.
+        """
+        cached_lookups = self.cached_ipv6_lookups if type == dns.AAAA else self.cached_ip_lookups
+
+        country_code = cached_lookups.get(address_value)
+
+        if country_code is not None:
+            self.stats['ip_lookup_hits'] += 1
+
+            return country_code
+
+        self.stats['ip_lookup_misses'] += 1
+
+        country_code = self.geo_policy.get_country_short(address_value, type == dns.AAAA)
+
+        cached_lookups[address_value] = country_code
+
+        return country_code
 
+    def assess_found_ips(self, value, skip_country_validation, address_values=None, timer=NULL_TIMER, type=dns.A, geo_policy=None):
         reason = None
 
-        if value:
-            for v in value:
-                if v:
-                    for v1 in v:
-                        if v1:
-                            payload = v1.__dict__.get("payload")
-                            if payload:
-                                record = str(payload)
+        if address_values is None:
+            address_values = answer_utils.get_address_values(value, type)
 
-                                result = re.findall("<A address=(\d+\.\d+\.\d+\.\d+) ttl=\d+>", record)
+        if not address_values:
+            return f"No {dns.QUERY_TYPES[type]} records found in answer.", value
 
-                                if result:
-                                    print(f"Match: '{result}' '{record}'")
-                                    if skip_country_validation:
-                                        reason = "Skipping country validation due to applicable whitelist entries."
+        reason, address_values = self.assess_ip_lists(address_values, type)
 
-                                        print(reason)
-                                    else:
-                                        if result[0] not in self.cached_ip_lookups:
-                                            self.cached_ip_lookups[result[0]] = self.ip2location_client.get_country_short(result[0])
+        if reason is not None:
+            return reason, (value if address_values else [])
 
-                                        country_code = self.cached_ip_lookups[result[0]]
+        if skip_country_validation:
+            reason = "Skipping country validation due to applicable whitelist entries."
 
-                                        if country_code in self.blocked_countries_list:
-                                            reason = f"Blocked IP '{result[0]}' with country code '{country_code}'. Blocked country codes were {', '.join(self.blocked_countries_list)}"
+            log.info(reason)
 
-                                            print(reason)
+            return reason, value
 
-                                            return reason, []
-                                        else:
-                                            reason = f"Permitted IP '{result[0]}' with country code '{country_code}'. Blocked country codes were {', '.join(self.blocked_countries_list)}"
+        if geo_policy is None:
+            geo_policy = self.geo_policy
 
-                                            print(reason)
-                                else:
-                                    reason = f"No match: '{result}' '{record}'"
+        if geo_policy.blocked_ranges is not None:
+            return self.assess_found_ips_by_range(value, address_values, timer, type, geo_policy)
+
+        address_value_to_ip = answer_utils.address_value_to_ipv6 if type == dns.AAAA else answer_utils.address_value_to_ip
+
+        for address_value in address_values:
+            country_code = self.get_country_code(address_value, type)
+
+            timer.mark('ip2location')
+
+            if country_code in geo_policy.blocked_countries_list:
+                reason = f"Blocked IP '{address_value_to_ip(address_value)}' with country code '{country_code}'. Blocked country codes were {geo_policy.blocked_countries_text}"
+
+                timer.mark('reason')
+
+                log.info("%s", reason, extra={'key': 'blocked'})
+
+                return reason, []
+            else:
+                reason = f"Permitted IP '{address_value_to_ip(address_value)}' with country code '{country_code}'. Blocked country codes were {geo_policy.blocked_countries_text}"
+
+                timer.mark('reason')
+
+        log.info("%s", reason, extra={'key': 'permitted'})
+
+        return reason, value
+
+    def assess_ip_lists(self, address_values, type=dns.A):
+        """
+        Checks `address_values` against the IP deny and allow lists. Returns
+        the reason and no addresses if one is denied, the reason and all of
+        them if all are allowed, or no reason and the addresses whose country
+        still needs to be checked.
+        """
+        ip_deny_list = self.ip_deny_lists[type]
+
+        if len(ip_deny_list):
+            for address_value in address_values:
+                match = ip_deny_list.longest_match_value(address_value)
+
+                if match is not None:
+                    self.stats['ip_deny_list_matches'] += 1
+
+                    reason = f"Blocked IP '{answer_utils.address_value_to_ipv6(address_value) if type == dns.AAAA else answer_utils.address_value_to_ip(address_value)}' in IP deny list entry '{ip_deny_list.format_ip_cidr(*match[:2])}'."
+
+                    log.info("%s", reason, extra={'key': 'blocked'})
+
+                    return reason, []
+
+        ip_allow_list = self.ip_allow_lists[type]
+
+        if len(ip_allow_list):
+            remaining_address_values = [address_value for address_value, allowed in zip(address_values, ip_allow_list.contains_values(address_values)) if not allowed]
+
+            if not remaining_address_values:
+                self.stats['ip_allow_list_matches'] += 1
+
+                reason = "Permitted IPs in IP allow list."
+
+                log.info("%s", reason, extra={'key': 'permitted'})
+
+                return reason, address_values
+
+            return None, remaining_address_values
+
+        return None, address_values
+
+    def assess_found_ips_by_range(self, value, address_values, timer=NULL_TIMER, type=dns.A, geo_policy=None):
+        """
+        Same verdict and reason as assess_found_ips, but checks the addresses
+        against the compiled blocked ranges and only looks up the country of
+        the address named in the reason.
+        """
+        if geo_policy is None:
+            geo_policy = self.geo_policy
+
+        blocked_address_value = geo_policy.get_first_blocked(address_values, type == dns.AAAA)
+
+        timer.mark('blocked_ranges')
+
+        address_value = blocked_address_value if blocked_address_value is not None else address_values[-1]
+
+        country_code = self.get_country_code(address_value, type)
+
+        timer.mark('ip2location')
+
+        address_text = answer_utils.address_value_to_ipv6(address_value) if type == dns.AAAA else answer_utils.address_value_to_ip(address_value)
+
+        if blocked_address_value is not None:
+            reason = f"Blocked IP '{address_text}' with country code '{country_code}'. Blocked country codes were {geo_policy.blocked_countries_text}"
+
+            timer.mark('reason')
+
+            log.info("%s", reason, extra={'key': 'blocked'})
+
+            return reason, []
+
+        reason = f"Permitted IP '{address_text}' with country code '{country_code}'. Blocked country codes were {geo_policy.blocked_countries_text}"
+
+        timer.mark('reason')
+
+        log.info("%s", reason, extra={'key': 'permitted'})
 
-                                    print(reason)
         return reason, value
 
 # Setup Twisted application with upstream dns server.
 application = service.Application('dnsserver', 1, 1)
-simpledns = MapResolver(servers=[(INTERCEPTOR_UPSTREAM_DNS_IP, INTERCEPTOR_UPSTREAM_DNS_PORT)], blocked_countries_list=[_.upper() for _ in os.environ["BLOCKED_COUNTRIES_LIST"].split(",")], ip2location_bin_file_path=os.environ["IP2LOCATION_BIN_FILE_PATH"], ip2location_mode=os.environ["IP2LOCATION_MODE"], whitelist_cache_sec=int(os.environ["WHITELIST_CACHE_SEC"]))
+verdict_logger = VerdictLogger(DB_FILE_NAME, updateable_fields=['permitted', 'reason', 'last_time_seen'], max_queue_size=VERDICT_QUEUE_SIZE, batch_size=VERDICT_BATCH_SIZE, flush_interval_sec=VERDICT_FLUSH_SEC)
+simpledns = MapResolver(servers=UPSTREAM_DNS_SERVERS, blocked_countries_list=BLOCKED_COUNTRIES, ip2location_bin_file_path=os.environ["IP2LOCATION_BIN_FILE_PATH"], ip2location_mode=os.environ["IP2LOCATION_MODE"], whitelist_cache_sec=int(os.environ["WHITELIST_CACHE_SEC"]), whitelist_max_stale_sec=WHITELIST_MAX_STALE_SEC, verdict_logger=verdict_logger, verdict_cache_size=VERDICT_CACHE_SIZE, shared_geo_cache_name=SHARED_GEO_CACHE, hedge_percentile=UPSTREAM_HEDGE_PERCENTILE, upstream_transport=UPSTREAM_TRANSPORT, upstream_connections=UPSTREAM_CONNECTIONS, tls_hostname=UPSTREAM_TLS_HOSTNAME, blocked_response_mode=BLOCKED_RESPONSE, blocked_response_ttl=BLOCKED_RESPONSE_TTL, stage_profiler=StageProfiler(sample_rate=PROFILE_SAMPLE_RATE, capture_queries=PROFILE_CAPTURE_QUERIES, capture_file=PROFILE_CAPTURE_FILE), ip_allow_list=IP_ALLOW_LIST, ip_deny_list=IP_DENY_LIST)
+
+# Assess the clients of client policies under their own policy.
+if CLIENT_POLICIES_FILE and os.path.exists(CLIENT_POLICIES_FILE):
+    simpledns.client_policies = ClientPolicies(simpledns, read_client_policies(CLIENT_POLICIES_FILE), verdict_cache_size=VERDICT_CACHE_SIZE)
 
 # Create protocols.
-f = server.DNSServerFactory(caches=[cache.CacheResolver()], clients=[simpledns])
+dns_cache = TrackingCacheResolver()
+f = ClientPolicyDNSServerFactory(caches=[dns_cache], clients=[simpledns], rate_per_sec=RATE_LIMIT_QPS, burst=RATE_LIMIT_BURST, action=RATE_LIMIT_ACTION, max_outstanding=MAX_OUTSTANDING_LOOKUPS, exempt_clients=RATE_LIMIT_EXEMPT, client_policies=simpledns.client_policies, client_subnet_sources=CLIENT_SUBNET_SOURCES)
 p = dns.DNSDatagramProtocol(f)
 f.noisy = p.noisy = False
 
 # Register both TCP and UDP on port 47786.
 ret = service.MultiService()
 
+# Write log messages from a background thread. Started first and stopped
+# last, so that messages of the other services are written out.
+simpledns.async_log = AsyncLog('interceptor', level=LOG_LEVEL, rate_per_sec=LOG_RATE_PER_SEC, burst=LOG_BURST, sample_rate=LOG_SAMPLE_RATE, max_queue_size=LOG_QUEUE_SIZE)
+simpledns.async_log.setServiceParent(ret)
+
+# Restore saved caches before serving queries.
+if SNAPSHOT_FILE and SNAPSHOT_SEC > 0:
+    simpledns.warm_start_snapshot = WarmStartSnapshot(SNAPSHOT_FILE, dns_cache, simpledns, interval_sec=SNAPSHOT_SEC, started_at=STARTED_AT)
+    simpledns.warm_start_snapshot.setServiceParent(ret)
+
+# Refresh popular names before they expire.
+if PREFETCH_QPS > 0:
+    simpledns.prefetcher = Prefetcher(dns_cache, simpledns, max_queries_per_sec=PREFETCH_QPS, top_names=PREFETCH_TOP_NAMES)
+    simpledns.prefetcher.setServiceParent(ret)
+
+# Reload the country data and blocked countries when they change.
+simpledns.policy_reloader = PolicyReloader(simpledns, dns_cache, policy_file_path=BLOCKED_COUNTRIES_FILE, check_interval_sec=POLICY_CHECK_SEC)
+simpledns.policy_reloader.setServiceParent(ret)
+
 # Attach services to the parent.
-for (klass, arg) in [(internet.TCPServer, f), (internet.UDPServer, p)]:
-    s = klass(PORT, arg)
+if REUSE_PORT:
+    for (arg, udp) in [(f, False), (p, True)]:
+        s = ReusePortServer(PORT, arg, udp)
+        s.setServiceParent(ret)
+else:
+    for (klass, arg) in [(internet.TCPServer, f), (internet.UDPServer, p)]:
+        s = klass(PORT, arg)
+        s.setServiceParent(ret)
+
+# Flush pending verdicts to sqlite on shutdown.
+verdict_logger.setServiceParent(ret)
+
+# Refresh the whitelist in the background.
+simpledns.whitelist_refresher.setServiceParent(ret)
+
+# Refresh the whitelists and flush the verdict caches of client policies.
+if simpledns.client_policies is not None:
+    simpledns.client_policies.setServiceParent(ret)
+
+# Periodically log last-seen times of names answered from cached verdicts.
+simpledns.verdict_cache.setServiceParent(ret)
+
+# Time query stages and profile queries on SIGUSR2.
+simpledns.stage_profiler.setServiceParent(ret)
+
+# Serve Prometheus metrics.
+if METRICS_PORT:
+    s = internet.TCPServer(METRICS_PORT, Site(metrics.MetricsResource(lambda: simpledns.get_metrics() + f.get_metrics() + dns_cache.get_metrics())), interface=METRICS_INTERFACE)
+    s.setServiceParent(ret)
+
+# Report statistics to the supervisor.
+if STATS_FILE:
+    s = internet.TimerService(10, lambda: interceptor_supervisor.write_stats_file(STATS_FILE, dict(simpledns.get_stats(), **f.get_stats())))
     s.setServiceParent(ret)
 
 # Run as a twistd application.
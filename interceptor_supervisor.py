@@ -0,0 +1,207 @@
+"""
+Runs several interceptor.py worker processes that all serve INTERCEPTOR_PORT
+through SO_REUSEPORT and share IP -> country lookups through a shared memory
+table. Crashed workers are restarted, and the statistics every worker writes
+to its stats file are added up periodically. SIGHUP is passed on to the
+workers, which then reload their country data and blocked countries.
+
+Usage: python interceptor_supervisor.py <number of workers>
+"""
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+from shared_geo_cache import SharedGeoCache
+
+def write_stats_file(stats_file, stats):
+    """
+    Atomically replace `stats_file` with `stats` serialized as JSON.
+    """
+    temp_file = f"{stats_file}.tmp"
+
+    with open(temp_file, 'w') as f:
+        json.dump(stats, f)
+
+    os.replace(temp_file, stats_file)
+
+def aggregate_stats(stats_list):
+    """
+    Add up statistics of several workers. Durations and high water marks are
+    not additive, so the maximum is kept for those instead.
+    """
+    total = dict()
+
+    for stats in stats_list:
+        for key, value in stats.items():
+            if 'duration' in key or 'high_water' in key:
+                total[key] = max(total.get(key, value), value)
+            else:
+                total[key] = total.get(key, 0) + value
+
+    return total
+
+class InterceptorSupervisor(object):
+    """
+    Starts, watches, and restarts interceptor worker processes.
+    """
+    def __init__(self, workers: int, tac_file: str='interceptor.py', stats_dir: str='.interceptor_stats', stats_interval_sec: int=60, geo_cache_slots: int=1 << 18, max_restart_backoff_sec: int=60):
+        if workers <= 0:
+            raise ValueError(f"Invalid number of workers {workers}, should be greater than zero")
+
+        self.workers = workers
+        self.tac_file = tac_file
+        self.stats_dir = stats_dir
+        self.stats_interval_sec = stats_interval_sec
+        self.geo_cache_slots = geo_cache_slots
+        self.max_restart_backoff_sec = max_restart_backoff_sec
+
+        self._geo_cache = None
+        self._processes = dict()
+        self._started_at = dict()
+        self._backoff_sec = dict()
+        self._restart_at = dict()
+        self._stopping = False
+
+        self.restarts = 0
+
+    def get_stats_file(self, index):
+        return os.path.join(self.stats_dir, f"worker-{index}.json")
+
+    def start_worker(self, index):
+        env = dict(os.environ)
+        env['INTERCEPTOR_REUSE_PORT'] = '1'
+        env['INTERCEPTOR_WORKER_INDEX'] = str(index)
+        env['INTERCEPTOR_SHARED_GEO_CACHE'] = self._geo_cache.name
+        env['INTERCEPTOR_STATS_FILE'] = self.get_stats_file(index)
+
+        # Each worker needs its own pid file, so none is written.
+        self._processes[index] = subprocess.Popen([shutil.which('twistd') or 'twistd', '-ny', self.tac_file, '--pidfile', ''], env=env)
+        self._started_at[index] = time.monotonic()
+
+        print(f"Started worker {index} with pid {self._processes[index].pid}")
+
+    def check_workers(self):
+        """
+        Restart workers that exited. Workers that exit soon after starting are
+        restarted with exponential backoff.
+        """
+        now = time.monotonic()
+
+        for index in range(self.workers):
+            process = self._processes.get(index)
+
+            if process is not None:
+                return_code = process.poll()
+
+                if return_code is None:
+                    continue
+
+                del self._processes[index]
+
+                if now - self._started_at[index] < 10:
+                    self._backoff_sec[index] = min(max(1, 2 * self._backoff_sec.get(index, 0)), self.max_restart_backoff_sec)
+                else:
+                    self._backoff_sec[index] = 0
+
+                self._restart_at[index] = now + self._backoff_sec[index]
+
+                print(f"Worker {index} exited with code {return_code}, restarting in {self._backoff_sec[index]} sec")
+
+            if index in self._restart_at:
+                if now < self._restart_at[index]:
+                    continue
+
+                del self._restart_at[index]
+
+                self.restarts += 1
+
+            self.start_worker(index)
+
+    def collect_stats(self):
+        """
+        Add up the latest statistics written by each worker.
+        """
+        stats_list = []
+
+        for index in range(self.workers):
+            try:
+                with open(self.get_stats_file(index)) as f:
+                    stats_list.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+        stats = aggregate_stats(stats_list)
+        stats['supervisor_workers_reporting'] = len(stats_list)
+        stats['supervisor_worker_restarts'] = self.restarts
+
+        return stats
+
+    def stop(self, *args):
+        self._stopping = True
+
+    def reload(self, *args):
+        for process in self._processes.values():
+            process.send_signal(signal.SIGHUP)
+
+    def run(self):
+        # Workers run as the same user as the supervisor, nobody else needs
+        # to write here. Also tightens a directory left by older versions.
+        os.makedirs(self.stats_dir, mode=0o700, exist_ok=True)
+        os.chmod(self.stats_dir, 0o700)
+
+        self._geo_cache = SharedGeoCache(slots=self.geo_cache_slots, create=True)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+
+        next_stats_time = time.monotonic() + self.stats_interval_sec
+
+        try:
+            while not self._stopping:
+                self.check_workers()
+
+                if time.monotonic() >= next_stats_time:
+                    stats = self.collect_stats()
+
+                    write_stats_file(os.path.join(self.stats_dir, 'total.json'), stats)
+
+                    print(f"Interceptor stats: {stats}")
+
+                    next_stats_time += self.stats_interval_sec
+
+                time.sleep(1)
+        finally:
+            self.stop_workers()
+
+            self._geo_cache.close()
+
+    def stop_workers(self, timeout_sec=10):
+        for process in self._processes.values():
+            process.terminate()
+
+        deadline = time.monotonic() + timeout_sec
+
+        for index, process in self._processes.items():
+            try:
+                process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                print(f"Worker {index} did not stop in time, killing it")
+                process.kill()
+                process.wait()
+
+        self._processes = dict()
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+
+    InterceptorSupervisor(int(sys.argv[1]), stats_interval_sec=int(os.environ.get('INTERCEPTOR_STATS_SEC', 60))).run()
+
+if __name__ == "__main__":
+    main()
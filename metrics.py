@@ -0,0 +1,116 @@
+import bisect
+
+from twisted.web import resource
+
+# Upper bounds in seconds, for query latencies and upstream round trip times.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds in seconds, for sqlite batch writes.
+WRITE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram(object):
+    """
+    Prometheus-style histogram with fixed buckets. Observing a value is one
+    binary search and two additions on preallocated counts, without locking,
+    so each histogram must only be observed from a single thread.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+
+        # One count per bucket plus one for values above the last bucket. Not
+        # cumulative, summed up when the samples are read.
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sum += value
+
+    def get_samples(self, labels=None):
+        """
+        Returns (suffix, labels, value) samples for the _bucket, _sum and
+        _count series.
+        """
+        labels = labels or {}
+
+        samples = []
+        total = 0
+
+        for bound, count in zip(self.buckets, self._counts):
+            total += count
+            samples.append(('_bucket', dict(labels, le=repr(float(bound))), total))
+
+        total += self._counts[-1]
+
+        samples.append(('_bucket', dict(labels, le='+Inf'), total))
+        samples.append(('_sum', labels, self._sum))
+        samples.append(('_count', labels, total))
+
+        return samples
+
+def counter(name, help, samples):
+    """
+    Returns a counter metric family. `samples` is a list of (labels, value).
+    """
+    return (name, 'counter', help, [('', labels, value) for labels, value in samples])
+
+def gauge(name, help, samples):
+    """
+    Returns a gauge metric family. `samples` is a list of (labels, value).
+    """
+    return (name, 'gauge', help, [('', labels, value) for labels, value in samples])
+
+def histogram(name, help, histogram_object, labels=None):
+    """
+    Returns a histogram metric family for a Histogram.
+    """
+    return (name, 'histogram', help, histogram_object.get_samples(labels))
+
+def summary(name, help, samples):
+    """
+    Returns a summary metric family. `samples` is a list of (labels, value)
+    with a quantile label each.
+    """
+    return (name, 'summary', help, [('', labels, value) for labels, value in samples])
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_metrics(families):
+    """
+    Formats metric families in the Prometheus text exposition format.
+    """
+    lines = []
+
+    for name, metric_type, help, samples in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+        for suffix, labels, value in samples:
+            if value is None:
+                continue
+
+            if labels:
+                label_text = ','.join(f'{key}="{_escape(label_value)}"' for key, label_value in labels.items())
+                lines.append(f"{name}{suffix}{{{label_text}}} {float(value)!r}")
+            else:
+                lines.append(f"{name}{suffix} {float(value)!r}")
+
+    return '\n'.join(lines) + '\n'
+
+class MetricsResource(resource.Resource):
+    """
+    Serves the metric families returned by `collect()` in the Prometheus
+    text format. Metrics are collected on the reactor thread when scraped.
+    """
+    isLeaf = True
+
+    def __init__(self, collect):
+        resource.Resource.__init__(self)
+
+        self.collect = collect
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+
+        return format_metrics(self.collect()).encode('utf-8')
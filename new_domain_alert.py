@@ -4,7 +4,7 @@ from constants import DB_FILE_NAME
 from pi_hole_admin import PiHoleAdmin
 from unique_domains_windower import UniqueDomainsWindower
 import sqlite_utils
-import tldextract
+import registrable_domain
 
 def initialize_default_windower(url: str, file_name: str, types: list, only_domains: bool, pi_hole_password_env_var: str="PI_HOLE_PW"):
     if file_name is None:
@@ -22,12 +22,7 @@ def initialize_default_windower(url: str, file_name: str, types: list, only_doma
     return windower
 
 def get_domain_from_fqdn(fqdn, extractor):
-    result = extractor(fqdn)
-
-    if result.suffix is not None and result.suffix.strip() != '':
-        return f"{result.domain}.{result.suffix}"
-
-    return None
+    return extractor.get_domain(fqdn)
 
 def main():
     start = time.time()
@@ -47,7 +42,7 @@ def main():
  
     oldest_bound, newest_bound = windower_blacklist.get_time_interval()
 
-    extractor = tldextract.TLDExtract(cache_dir=os.environ['TLDEXTRACT_CACHE'])
+    extractor = registrable_domain.get_extractor(os.environ['TLDEXTRACT_CACHE'])
 
     sqlite_utils.log_reason(DB_FILE_NAME, [{'domain': get_domain_from_fqdn(name, extractor), 'first_time_seen': seen_time, 'last_time_seen': seen_time, 'permitted': False, "reason": "Blocked by PiHole", "name": name} for name, seen_time in previously_unseen_blocked_domain_data.items()], updateable_fields=['permitted', 'reason', 'last_time_seen'])
 
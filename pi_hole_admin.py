@@ -5,6 +5,7 @@ import math
 import re
 import bs4
 import tldextract
+from domain_list_matcher import DomainListMatcher
 
 class PiHoleAdmin(object):
     """
@@ -21,6 +22,7 @@ class PiHoleAdmin(object):
         self._black_groups_domains_token = None
         self._whitelist_entries = None
         self._blacklist_entries = None
+        self._matchers = dict()
 
         if pi_hole_password is not None:
             self._pi_hole_password = pi_hole_password
@@ -61,9 +63,39 @@ class PiHoleAdmin(object):
 
         ltype_clean = ltype.lower().strip()
 
+        entries = self.get_whitelist_or_blacklist_entries(bust_cache=bust_cache, ltype=ltype_clean, only_enabled=only_enabled, groups=groups)
+
+        return self.get_matcher(entries, ltype_clean).match(domain, wildcard=wildcard)
+
+    def get_matcher(self, entries: list, ltype: str):
+        """
+        Returns a DomainListMatcher for `entries`, compiling it only if the
+        entries changed since the last call for list type `ltype`.
+        """
+        matcher = self._matchers.get(ltype)
+
+        if matcher is None or matcher.entries is not entries:
+            matcher = DomainListMatcher(entries, ltype)
+            self._matchers[ltype] = matcher
+
+        return matcher
+
+    @staticmethod
+    def filter_entries_containing_domain(entries: list, domain: str, ltype: str, wildcard: bool=False):
+        """
+        Returns the entries of an already retrieved whitelist (ltype='white')
+        or blacklist (ltype='black') that contain the proposed domain by
+        scanning every entry. DomainListMatcher gives the same result without
+        the scan and should be preferred for repeated lookups.
+        """
+        if ltype is None or ltype.lower().strip() not in ['white', 'black']:
+            raise ValueError(f"Invalid list type: \"{ltype}\"")
+
+        ltype_clean = ltype.lower().strip()
+
         containing_entries = []
 
-        for entry in self.get_whitelist_or_blacklist_entries(bust_cache=bust_cache, ltype=ltype_clean, only_enabled=only_enabled, groups=groups):
+        for entry in entries or []:
             if ltype_clean == 'white':
                 if wildcard and entry["type"] == 2 and (re.match(f".*{entry['domain']}", domain) or domain == entry["domain"]):
                     containing_entries.append(entry)
@@ -77,6 +109,16 @@ class PiHoleAdmin(object):
 
         return containing_entries
 
+    def reset_session(self):
+        """
+        Forget the login session id and groups domains tokens so that the next
+        request logs in again. Useful after a failed request, e.g., because the
+        session expired.
+        """
+        self._php_session_id = None
+        self._white_groups_domains_token = None
+        self._black_groups_domains_token = None
+
     def get_groups_domains_token(self, ltype: str):
         """
         Retrieves groups domains token for list type. Necessary for getting data
@@ -0,0 +1,348 @@
+import re
+import signal
+import time
+import traceback
+
+import IP2Location
+
+from twisted.application import service
+from twisted.internet import reactor, task, threads
+from twisted.names import dns
+
+import answer_utils
+import file_utils
+import metrics
+from blocked_ranges import BlockedRanges, Ipv6BlockedRanges
+from geo_index import CountryIndex
+
+def read_blocked_countries(policy_file_path):
+    """
+    Returns the upper case country codes in the policy file at
+    `policy_file_path`. Codes are separated by commas or whitespace, like in
+    BLOCKED_COUNTRIES_LIST, and everything after a '#' on a line is ignored.
+    """
+    with open(policy_file_path) as f:
+        lines = f.read().splitlines()
+
+    return [code.upper() for line in lines for code in re.split(r'[,\s]+', line.split('#', 1)[0]) if code]
+
+class GeoPolicy(object):
+    """
+    Everything verdicts depend on besides the whitelist: where country codes
+    come from and which of them are blocked. It is never modified once built,
+    so a new one can be built in a thread and swapped in with one assignment.
+    """
+    def __init__(self, blocked_countries_list, country_index: CountryIndex=None, ip2location_client=None):
+        self.blocked_countries_list = list(blocked_countries_list)
+        self.blocked_countries_text = ', '.join(self.blocked_countries_list)
+        self.country_index = country_index
+        self.ip2location_client = ip2location_client
+
+        # Whether an address is blocked is then answered without its country.
+        self.blocked_ranges = None
+        self.ipv6_blocked_ranges = None
+
+        if country_index is not None:
+            self.blocked_ranges = BlockedRanges.compile(country_index, self.blocked_countries_list)
+            self.ipv6_blocked_ranges = Ipv6BlockedRanges.compile(country_index, self.blocked_countries_list, self.blocked_ranges)
+
+    @classmethod
+    def load(cls, blocked_countries_list, bin_file_path, mode):
+        """
+        Loads the IP2Location BIN file at `bin_file_path`. In COMPILED mode
+        the country data is compiled into memory and looked up without
+        IP2Location, otherwise `mode` is the IP2Location mode.
+        """
+        if mode == 'COMPILED':
+            return cls(blocked_countries_list, country_index=CountryIndex.from_bin(bin_file_path))
+
+        return cls(blocked_countries_list, ip2location_client=IP2Location.IP2Location(filename=bin_file_path, mode=mode))
+
+    def with_blocked_countries(self, blocked_countries_list):
+        """
+        Returns a policy with the same country data and other blocked
+        countries.
+        """
+        return GeoPolicy(blocked_countries_list, self.country_index, self.ip2location_client)
+
+    def get_country_short(self, address_value, ipv6=False):
+        """
+        Gets country code for the numeric value of an IPv4 (or IPv6) address.
+        """
+        if self.country_index is not None:
+            if ipv6:
+                return self.country_index.get_ipv6_country_short(address_value)
+
+            return self.country_index.get_country_short(address_value)
+
+        if ipv6:
+            return self.ip2location_client.get_country_short(answer_utils.address_value_to_ipv6(address_value))
+
+        return self.ip2location_client.get_country_short(answer_utils.address_value_to_ip(address_value))
+
+    def is_blocked(self, address_value, ipv6=False):
+        blocked_ranges = self.ipv6_blocked_ranges if ipv6 else self.blocked_ranges
+
+        if blocked_ranges is not None:
+            return blocked_ranges.is_blocked(address_value)
+
+        return self.get_country_short(address_value, ipv6) in self.blocked_countries_list
+
+    def get_first_blocked(self, address_values, ipv6=False):
+        """
+        Returns the first of `address_values` that is blocked, or None. Only
+        for compiled country data.
+        """
+        return (self.ipv6_blocked_ranges if ipv6 else self.blocked_ranges).get_first_blocked(address_values)
+
+def find_affected_entries(geo_policy, verdicts, blocked_names, dns_answers):
+    """
+    Returns the cached verdicts, blocked names and DNS answers (in the format
+    of VerdictCache.items, BlockedNameCache.items and the items of
+    CacheResolver.cache) whose outcome is different under `geo_policy`:
+    verdicts and answers with an address that is now blocked, blocked
+    verdicts without one, and blocked names that are no longer known to be
+    blocked, along with their (sinkhole) answers.
+    """
+    # key: (numeric value of ip address, True if IPv6). Value: True if
+    # blocked.
+    blocked = dict()
+
+    def any_blocked(address_values, ipv6):
+        for address_value in address_values:
+            is_blocked = blocked.get((address_value, ipv6))
+
+            if is_blocked is None:
+                is_blocked = blocked[(address_value, ipv6)] = geo_policy.is_blocked(address_value, ipv6)
+
+            if is_blocked:
+                return True
+
+        return False
+
+    affected_verdicts = []
+    still_blocked_names = set()
+
+    for key, verdict in verdicts:
+        name, type, address_values = key
+
+        now_blocked = any_blocked(address_values, type == dns.AAAA)
+
+        if now_blocked:
+            still_blocked_names.add(name)
+
+        # Whitelisted names are permitted whatever their addresses, and the IP
+        # allow and deny lists override the countries, so a few of these are
+        # assessed again for nothing.
+        if verdict.permitted == now_blocked:
+            affected_verdicts.append((key, verdict))
+
+    affected_names = [(name, verdict) for name, verdict in blocked_names if name not in still_blocked_names]
+
+    unblocked_names = {name.encode('utf-8') for name, verdict in affected_names}
+
+    affected_answers = [(query, entry) for query, entry in dns_answers if query.name.name in unblocked_names or any_blocked(answer_utils.get_a_address_values(entry[1]), False) or any_blocked(answer_utils.get_aaaa_address_values(entry[1]), True)]
+
+    return affected_verdicts, affected_names, affected_answers
+
+class PolicyReloader(service.Service):
+    """
+    Reloads MapResolver's GeoPolicy without restarting twistd when the
+    IP2Location BIN file or the blocked countries policy file changes, or
+    when the process receives `reload_signal`.
+
+    Files are checked every `check_interval_sec`, and a changed file is only
+    read once it has not been modified for `settle_sec`, so that a file being
+    copied in place is not read half written. The new policy is built in a
+    thread from the reactor's thread pool while queries keep being assessed
+    with the current one, then swapped in between two queries. The cached
+    verdicts, blocked names and DNS answers it changes are then found in a
+    thread and discarded, the rest stay cached.
+
+    A reload that fails, e.g. because the new BIN file is corrupt, keeps the
+    current policy until the files change again.
+    """
+    def __init__(self, resolver, dns_cache, policy_file_path: str=None, check_interval_sec: int=30, settle_sec: int=5, reload_signal=signal.SIGHUP):
+        self.resolver = resolver
+        self.dns_cache = dns_cache
+        self.policy_file_path = policy_file_path
+        self.check_interval_sec = check_interval_sec
+        self.settle_sec = settle_sec
+        self.reload_signal = reload_signal
+
+        # Signatures of the files the current policy was loaded from.
+        self._bin_signature = file_utils.get_file_signature(resolver.ip2location_bin_file_path)
+        self._policy_signature = file_utils.get_file_signature(policy_file_path) if policy_file_path else None
+
+        self._reloading = False
+        self._reload_pending = False
+        self._loop = None
+        self._previous_handler = None
+
+        self.stats = {
+            'reloads': 0,
+            'reload_failures': 0,
+            'discarded_verdicts': 0,
+            'discarded_blocked_names': 0,
+            'removed_dns_answers': 0,
+            'last_reload_duration_sec': 0.0,
+        }
+
+    def get_metrics(self):
+        return [
+            metrics.counter('interceptor_policy_reloads_total', 'Reloads of the country data and blocked countries by result.', [({'result': 'success'}, self.stats['reloads']), ({'result': 'failure'}, self.stats['reload_failures'])]),
+            metrics.counter('interceptor_policy_reload_discards_total', 'Cache entries discarded because a reload changed their outcome.', [({'cache': 'verdicts'}, self.stats['discarded_verdicts']), ({'cache': 'blocked_names'}, self.stats['discarded_blocked_names']), ({'cache': 'dns_answers'}, self.stats['removed_dns_answers'])]),
+        ]
+
+    def startService(self):
+        service.Service.startService(self)
+
+        if self.check_interval_sec > 0:
+            self._loop = task.LoopingCall(self.check_files)
+            self._loop.start(self.check_interval_sec, now=False)
+
+        if self.reload_signal is not None:
+            self._previous_handler = signal.signal(self.reload_signal, self._signal_received)
+
+    def stopService(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+        self._loop = None
+
+        if self.reload_signal is not None and self._previous_handler is not None:
+            signal.signal(self.reload_signal, self._previous_handler)
+
+        self._previous_handler = None
+
+        return service.Service.stopService(self)
+
+    def _signal_received(self, signum, frame):
+        # Only schedule the reload, the reactor may be in the middle of
+        # anything.
+        reactor.callFromThread(self.reload, True)
+
+    def _has_settled_change(self, signature, loaded_signature):
+        return signature is not None and signature != loaded_signature and time.time() - signature[1] / 1e9 >= self.settle_sec
+
+    def check_files(self):
+        """
+        Reloads if the BIN file or the policy file changed and has settled.
+        """
+        bin_changed = self._has_settled_change(file_utils.get_file_signature(self.resolver.ip2location_bin_file_path), self._bin_signature)
+        policy_changed = self.policy_file_path is not None and self._has_settled_change(file_utils.get_file_signature(self.policy_file_path), self._policy_signature)
+
+        if bin_changed or policy_changed:
+            return self.reload()
+
+        return None
+
+    def reload(self, force=False):
+        """
+        Starts a background reload, of the BIN file only if it changed unless
+        `force` is set. A reload asked for while one is running starts once
+        it is done. Returns the deferred for the reload, or None.
+        """
+        if self._reloading:
+            self._reload_pending = True
+            return None
+
+        self._reloading = True
+
+        start = time.monotonic()
+
+        bin_signature = file_utils.get_file_signature(self.resolver.ip2location_bin_file_path)
+        policy_signature = file_utils.get_file_signature(self.policy_file_path) if self.policy_file_path else None
+
+        reload_bin = force or bin_signature != self._bin_signature
+
+        print(f"Reloading {'country data and ' if reload_bin else ''}blocked countries")
+
+        d = threads.deferToThread(self._build, self.resolver.geo_policy, reload_bin, policy_signature is not None)
+        d.addCallback(self._swap, reload_bin, bin_signature, policy_signature)
+        d.addCallbacks(self._reload_succeeded, self._reload_failed, callbackArgs=(start,), errbackArgs=(start, bin_signature, policy_signature))
+
+        return d
+
+    def _build(self, geo_policy, reload_bin, read_policy_file):
+        # Runs in a thread. A missing policy file keeps the blocked countries.
+        blocked_countries_list = read_blocked_countries(self.policy_file_path) if read_policy_file else geo_policy.blocked_countries_list
+
+        if reload_bin:
+            return GeoPolicy.load(blocked_countries_list, self.resolver.ip2location_bin_file_path, self.resolver.ip2location_mode)
+
+        return geo_policy.with_blocked_countries(blocked_countries_list)
+
+    def _swap(self, geo_policy, reload_bin, bin_signature, policy_signature):
+        self.resolver.swap_geo_policy(geo_policy, reload_bin)
+
+        self._bin_signature = bin_signature
+        self._policy_signature = policy_signature
+
+        # Verdicts cached from now on are assessed with the new policy, so
+        # only what is cached now needs checking.
+        d = threads.deferToThread(self._find_affected, geo_policy, self.resolver.verdict_cache.items(), self.resolver.blocked_names.items(), list(self.dns_cache.cache.items()))
+        d.addCallback(self._discard)
+
+        return d
+
+    def _find_affected(self, geo_policy, verdicts, blocked_names, dns_answers):
+        # Runs in a thread. IP2Location clients are not thread safe, so the
+        # one the reactor now uses is not shared.
+        if geo_policy.country_index is None:
+            geo_policy = GeoPolicy.load(geo_policy.blocked_countries_list, self.resolver.ip2location_bin_file_path, self.resolver.ip2location_mode)
+
+        return find_affected_entries(geo_policy, verdicts, blocked_names, dns_answers)
+
+    def _discard(self, affected):
+        affected_verdicts, affected_names, affected_answers = affected
+
+        for key, verdict in affected_verdicts:
+            self.resolver.verdict_cache.discard(key, verdict)
+
+        for name, verdict in affected_names:
+            self.resolver.blocked_names.discard(name, verdict)
+
+        for query, entry in affected_answers:
+            # Unless it was cached again since.
+            if self.dns_cache.cache.get(query) is entry:
+                self.dns_cache.remove(query)
+
+        self.stats['discarded_verdicts'] += len(affected_verdicts)
+        self.stats['discarded_blocked_names'] += len(affected_names)
+        self.stats['removed_dns_answers'] += len(affected_answers)
+
+        return affected
+
+    def _reload_succeeded(self, affected, start):
+        self._reloading = False
+
+        self.stats['reloads'] += 1
+        self.stats['last_reload_duration_sec'] = time.monotonic() - start
+
+        affected_verdicts, affected_names, affected_answers = affected
+
+        print(f"Reloaded policy blocking {self.resolver.geo_policy.blocked_countries_text} in {self.stats['last_reload_duration_sec']:.3f} sec, discarded {len(affected_verdicts)} cached verdicts, {len(affected_names)} blocked names and {len(affected_answers)} DNS answers")
+
+        self._run_pending()
+
+    def _reload_failed(self, failure, start, bin_signature, policy_signature):
+        self._reloading = False
+
+        # Not retried until the files change again.
+        self._bin_signature = bin_signature
+        self._policy_signature = policy_signature
+
+        self.stats['reload_failures'] += 1
+        self.stats['last_reload_duration_sec'] = time.monotonic() - start
+
+        print(f"Could not reload policy, keeping the current one, due to exception '{failure.getErrorMessage()}'")
+        traceback.print_exception(failure.type, failure.value, failure.getTracebackObject())
+
+        self._run_pending()
+
+    def _run_pending(self):
+        if self._reload_pending:
+            self._reload_pending = False
+
+            self.reload()
@@ -0,0 +1,214 @@
+import heapq
+import time
+
+from twisted.application import service
+from twisted.internet import task
+from twisted.names import cache
+
+import metrics
+from blocked_response import BlockedQueryError
+
+class TrackingCacheResolver(cache.CacheResolver):
+    """
+    CacheResolver that counts hits and misses and reports every query it is
+    asked about to `hit_callback`, so that popular names can be found.
+    """
+    hit_callback = None
+
+    def __init__(self, *args, **kwargs):
+        cache.CacheResolver.__init__(self, *args, **kwargs)
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def query(self, query, timeout=None):
+        if self.hit_callback is not None:
+            self.hit_callback(query)
+
+        # Expired entries are removed by CacheResolver, so anything cached
+        # is a hit.
+        if query in self.cache:
+            self.stats['hits'] += 1
+        else:
+            self.stats['misses'] += 1
+
+        return cache.CacheResolver.query(self, query, timeout)
+
+    def remove(self, query):
+        """
+        Removes the cached answer to `query`, if any.
+        """
+        if query in self.cache:
+            self.cancel[query].cancel()
+            self.clearEntry(query)
+
+    def get_metrics(self):
+        return [
+            metrics.counter('interceptor_dns_cache_lookups_total', 'DNS answer cache lookups by result.', [({'result': 'hit'}, self.stats['hits']), ({'result': 'miss'}, self.stats['misses'])]),
+            metrics.gauge('interceptor_dns_cache_entries', 'Answers in the DNS answer cache.', [({}, len(self.cache))]),
+        ]
+
+class Prefetcher(service.Service):
+    """
+    Refreshes the answers of the most queried names shortly before they
+    expire from `dns_cache`, so that clients of popular names never wait for
+    an upstream query and assessment.
+
+    Query counts are halved every `decay_interval_sec`, and the `top_names`
+    queries asked at least `min_hits` times are refreshed once less than
+    `refresh_ahead_fraction` of their TTL is left. Answers with a TTL below
+    `min_ttl_sec` are not refreshed. Refreshes go through `resolver` like any
+    other query, so the new answer is assessed again: if it is now blocked,
+    the cached answer is removed, or replaced by the sinkhole answer.
+
+    At most `max_queries_per_sec` refreshes are sent per second, the most
+    queried names first.
+    """
+    def __init__(self, dns_cache: TrackingCacheResolver, resolver, max_queries_per_sec: float=5, top_names: int=1000, min_hits: int=2, refresh_ahead_fraction: float=0.1, min_ttl_sec: int=10, decay_interval_sec: int=60):
+        if max_queries_per_sec <= 0:
+            raise ValueError(f"Invalid prefetch budget {max_queries_per_sec}, should be greater than zero")
+
+        self.dns_cache = dns_cache
+        self.resolver = resolver
+        self.max_queries_per_sec = max_queries_per_sec
+        self.top_names = top_names
+        self.min_hits = min_hits
+        self.refresh_ahead_fraction = refresh_ahead_fraction
+        self.min_ttl_sec = min_ttl_sec
+        self.decay_interval_sec = decay_interval_sec
+
+        # key: dns.Query. Value: (decayed) number of times it was asked.
+        self._hits = dict()
+
+        # Queries that are currently the most popular, most popular first.
+        self._top = []
+
+        self._in_flight = set()
+        self._tokens = 0.0
+        self._last_tick = None
+        self._loops = []
+
+        self.stats = {
+            'prefetches': 0,
+            'prefetch_failures': 0,
+            'prefetches_blocked': 0,
+            'prefetches_over_budget': 0,
+            'tracked_names': 0,
+        }
+
+    def startService(self):
+        service.Service.startService(self)
+
+        self.dns_cache.hit_callback = self.record_hit
+
+        self._loops = [task.LoopingCall(self.decay), task.LoopingCall(self.tick)]
+        self._loops[0].start(self.decay_interval_sec, now=False)
+        self._loops[1].start(1, now=False)
+
+    def stopService(self):
+        for loop in self._loops:
+            if loop.running:
+                loop.stop()
+
+        self._loops = []
+
+        self.dns_cache.hit_callback = None
+
+        return service.Service.stopService(self)
+
+    def record_hit(self, query):
+        self._hits[query] = self._hits.get(query, 0) + 1
+
+    def decay(self):
+        """
+        Picks the current top names, then halves every count so that names
+        that stop being queried drop out.
+        """
+        self._top = [query for query in heapq.nlargest(self.top_names, self._hits, key=self._hits.get) if self._hits[query] >= self.min_hits]
+
+        self._hits = {query: hits // 2 for query, hits in self._hits.items() if hits > 1}
+
+        self.stats['tracked_names'] = len(self._hits)
+
+    def get_remaining_ttl(self, query, now):
+        """
+        Returns (remaining, original) smallest TTL of the cached answer for
+        `query`, or None if it is not cached.
+        """
+        entry = self.dns_cache.cache.get(query)
+
+        if entry is None:
+            return None
+
+        when, payload = entry
+
+        ttls = [r.ttl for section in payload for r in section]
+
+        if not ttls:
+            return None
+
+        ttl = min(ttls)
+
+        return when + ttl - now, ttl
+
+    def tick(self):
+        now = self.dns_cache._reactor.seconds()
+        monotonic_now = time.monotonic()
+
+        if self._last_tick is not None:
+            self._tokens = min(self.max_queries_per_sec, self._tokens + (monotonic_now - self._last_tick) * self.max_queries_per_sec)
+
+        self._last_tick = monotonic_now
+
+        for query in self._top:
+            if query in self._in_flight:
+                continue
+
+            ttls = self.get_remaining_ttl(query, now)
+
+            if ttls is None:
+                continue
+
+            remaining, ttl = ttls
+
+            if ttl < self.min_ttl_sec or remaining > ttl * self.refresh_ahead_fraction:
+                continue
+
+            if self._tokens < 1:
+                self.stats['prefetches_over_budget'] += 1
+                continue
+
+            self._tokens -= 1
+
+            self.prefetch(query)
+
+    def prefetch(self, query):
+        self._in_flight.add(query)
+
+        self.stats['prefetches'] += 1
+
+        d = self.resolver.query(query)
+        d.addCallbacks(self._prefetch_succeeded, self._prefetch_failed, callbackArgs=(query,), errbackArgs=(query,))
+
+        return d
+
+    def _prefetch_succeeded(self, response, query):
+        self._in_flight.discard(query)
+
+        # A sinkhole answer for a blocked name replaces the cached answer too.
+        self.dns_cache.cacheResult(query, response)
+
+    def _prefetch_failed(self, failure, query):
+        self._in_flight.discard(query)
+
+        if failure.check(BlockedQueryError):
+            self.stats['prefetches_blocked'] += 1
+
+            self.dns_cache.remove(query)
+
+            return
+
+        # The cached answer simply expires.
+        self.stats['prefetch_failures'] += 1
@@ -0,0 +1,237 @@
+import idna
+import pylru
+import tldextract
+
+# Flags of a trie node marking a public suffix rule ("co.uk"), an exception
+# rule ("!www.ck") and a wildcard rule ("*.ck") ending at it. Kept apart from
+# the child labels, as names may have any label, "*" and "!" included.
+SUFFIX = '.'
+EXCEPTION = '!'
+WILDCARD = '*'
+
+_MISSING = object()
+
+class PublicSuffixTrie(object):
+    """
+    Public suffix list rules compiled into a trie of reversed labels, so that
+    finding the public suffix of a name costs one dict lookup per label. It
+    returns the same suffix as tldextract for the same rules.
+
+    Node: (dict of child label to node, set of flags).
+    """
+    def __init__(self, rules):
+        self._root = (dict(), set())
+
+        for rule in rules:
+            if rule.startswith('!'):
+                labels, flag = rule[1:].split('.'), EXCEPTION
+            elif rule.startswith('*.'):
+                labels, flag = rule[2:].split('.'), WILDCARD
+            else:
+                labels, flag = rule.split('.'), SUFFIX
+
+            node = self._root
+
+            for label in reversed(labels):
+                children = node[0]
+
+                if label not in children:
+                    children[label] = (dict(), set())
+
+                node = children[label]
+
+            node[1].add(flag)
+
+        self.rule_count = len(rules)
+
+    @classmethod
+    def from_tldextract(cls, cache_dir):
+        """
+        Compiles the public suffix list that tldextract would use with
+        `cache_dir`: its cached copy, a fresh download or the snapshot bundled
+        with tldextract, in that order.
+        """
+        return cls(tldextract.TLDExtract(cache_dir=cache_dir).tlds)
+
+    def suffix_index(self, labels):
+        """
+        Returns the index of the first label of the public suffix of the
+        lowercase `labels`, or len(labels) if there is none.
+        """
+        index = len(labels)
+        children, flags = self._root
+
+        for i in range(len(labels) - 1, -1, -1):
+            child = children.get(labels[i])
+
+            if child is None:
+                if WILDCARD in flags:
+                    index = i
+
+                break
+
+            child_children, child_flags = child
+
+            if EXCEPTION in child_flags:
+                index = i + 1
+            elif SUFFIX in child_flags or WILDCARD in flags:
+                index = i
+
+            children, flags = child_children, child_flags
+
+        return index
+
+def _decode_label(label):
+    lowered = label.lower()
+
+    if lowered.startswith('xn--'):
+        try:
+            return idna.decode(lowered.encode('ascii')).lower()
+        except (UnicodeError, IndexError):
+            pass
+
+    return lowered
+
+class RegistrableDomainExtractor(object):
+    """
+    Gets the registrable domain of a name, e.g., "example.co.uk" for
+    "www.example.co.uk", like tldextract's f"{domain}.{suffix}". Results for
+    the `memo_size` most recently asked names are memoized.
+    """
+    def __init__(self, trie: PublicSuffixTrie, memo_size: int=10000):
+        self.trie = trie
+
+        # key: fqdn. Value: registrable domain or None.
+        self._memo = pylru.lrucache(memo_size)
+
+        self.stats = {
+            'memo_hits': 0,
+            'memo_misses': 0,
+        }
+
+    def get_domain(self, fqdn):
+        """
+        Returns the registrable domain of `fqdn`, or None if it has no public
+        suffix.
+        """
+        domain = self._memo.get(fqdn, _MISSING)
+
+        if domain is not _MISSING:
+            self.stats['memo_hits'] += 1
+
+            return domain
+
+        self.stats['memo_misses'] += 1
+
+        domain = self._memo[fqdn] = self.extract(fqdn)
+
+        return domain
+
+    def extract(self, fqdn):
+        labels = fqdn.strip().rstrip('.').split('.')
+
+        suffix_index = self.trie.suffix_index([_decode_label(label) for label in labels])
+
+        if suffix_index >= len(labels):
+            return None
+
+        domain = labels[suffix_index - 1] if suffix_index else ''
+
+        return f"{domain}.{'.'.join(labels[suffix_index:])}"
+
+# key: tldextract cache directory. Value: RegistrableDomainExtractor.
+_extractors = dict()
+
+def get_extractor(cache_dir, memo_size: int=10000):
+    """
+    Returns the RegistrableDomainExtractor for `cache_dir`, compiling the
+    public suffix list the first time it is asked for in this process.
+    """
+    extractor = _extractors.get(cache_dir)
+
+    if extractor is None:
+        extractor = _extractors[cache_dir] = RegistrableDomainExtractor(PublicSuffixTrie.from_tldextract(cache_dir), memo_size)
+
+    return extractor
+
+def _benchmark_names(count):
+    """
+    Names shaped like a home network's DNS traffic: a few popular names
+    asked over and over, CDN and tracker hosts with long random labels,
+    multi-label public suffixes, wildcard and exception rules, punycode and
+    names without a public suffix.
+    """
+    import random
+
+    rng = random.Random(17)
+
+    popular = ["www.google.com", "clients4.google.com", "i.ytimg.com", "graph.facebook.com", "api.amazon.co.uk", "www.bbc.co.uk", "s3.amazonaws.com", "github.io", "user.github.io", "www.city.kawasaki.jp", "foo.kawasaki.jp", "xn--bcher-kva.example.de", "printer.local", "localhost", "news.yahoo.co.jp", "edge-chat.facebook.com"]
+
+    suffixes = ["com", "net", "org", "co.uk", "com.au", "de", "io", "jp", "ck", "www.ck", "com.br", "gov.uk"]
+
+    names = []
+
+    for i in range(count):
+        if rng.random() < 0.6:
+            names.append(popular[min(len(popular) - 1, int(rng.paretovariate(1.2)) - 1)])
+        else:
+            host = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(rng.randint(3, 20)))
+            names.append(f"{host}.cdn{rng.randint(0, 200)}.{rng.choice(['edge', 'static', 'tracker'])}{rng.randint(0, 50)}.{rng.choice(suffixes)}")
+
+    return names
+
+def main():
+    """
+    Compares tldextract with the compiled trie, with and without the memo,
+    on the same names, after checking that they agree on every name.
+    """
+    import os
+    import tempfile
+    import time
+
+    cache_dir = os.environ.get('TLDEXTRACT_CACHE') or tempfile.mkdtemp()
+
+    start = time.perf_counter()
+    extractor = tldextract.TLDExtract(cache_dir=cache_dir)
+    extractor('warm.up.example.com')
+    tldextract_load_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    trie = PublicSuffixTrie(extractor.tlds)
+    compile_ms = (time.perf_counter() - start) * 1000
+
+    def tldextract_domain(fqdn):
+        result = extractor(fqdn)
+
+        if result.suffix is not None and result.suffix.strip() != '':
+            return f"{result.domain}.{result.suffix}"
+
+        return None
+
+    names = _benchmark_names(200000)
+
+    uncached = RegistrableDomainExtractor(trie)
+
+    # Labels that look like the markers of wildcard and exception rules.
+    odd_names = ["*.ck", "a.*.ck", "a.!.www.ck", "!.www.ck", "a.*.com", "*.com", "!.com", "*", "!", "a.b.*.kawasaki.jp", "!.city.kawasaki.jp"]
+
+    for name in set(names) | set(odd_names):
+        if uncached.extract(name) != tldextract_domain(name):
+            raise AssertionError(f"Mismatch for {name}: {uncached.extract(name)} != {tldextract_domain(name)}")
+
+    print(f"tldextract load: {tldextract_load_ms:.1f} ms, trie compile: {compile_ms:.1f} ms for {trie.rule_count} rules, {len(set(names))} distinct names agree")
+
+    memoized = RegistrableDomainExtractor(trie, memo_size=10000)
+
+    for name, function in [('tldextract', tldextract_domain), ('Trie', uncached.extract), ('Trie with memo', memoized.get_domain)]:
+        start = time.perf_counter()
+
+        for fqdn in names:
+            function(fqdn)
+
+        print(f"{name}: {(time.perf_counter() - start) * 1e6 / len(names):.2f} us/name")
+
+    print(f"Memo: {memoized.stats}")
+
+if __name__ == "__main__":
+    main()
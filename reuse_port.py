@@ -0,0 +1,60 @@
+import socket
+
+from twisted.application import service
+from twisted.internet import reactor
+
+def _bound_socket(port, interface, sock_type):
+    sock = socket.socket(socket.AF_INET, sock_type)
+
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+
+        if sock_type == socket.SOCK_STREAM:
+            sock.listen(50)
+
+        sock.setblocking(False)
+    except BaseException:
+        sock.close()
+        raise
+
+    return sock
+
+class ReusePortServer(service.Service):
+    """
+    Listens for UDP datagrams (`udp=True`) or TCP connections (`udp=False`)
+    on a port bound with SO_REUSEPORT, so that several processes can serve the
+    same port and the kernel spreads queries across them.
+    """
+    def __init__(self, port: int, protocol_or_factory, udp: bool, interface: str=''):
+        self.port = port
+        self.protocol_or_factory = protocol_or_factory
+        self.udp = udp
+        self.interface = interface
+
+        self._listening_port = None
+
+    def startService(self):
+        service.Service.startService(self)
+
+        sock = _bound_socket(self.port, self.interface, socket.SOCK_DGRAM if self.udp else socket.SOCK_STREAM)
+
+        # The reactor duplicates the file descriptor, so our copy is closed.
+        try:
+            if self.udp:
+                self._listening_port = reactor.adoptDatagramPort(sock.fileno(), socket.AF_INET, self.protocol_or_factory)
+            else:
+                self._listening_port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, self.protocol_or_factory)
+        finally:
+            sock.close()
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+        if self._listening_port is not None:
+            d = self._listening_port.stopListening()
+            self._listening_port = None
+            return d
+
+        return None
@@ -0,0 +1,114 @@
+from multiprocessing import resource_tracker, shared_memory
+
+# Each slot is one 64-bit word: bits 0-15 hold the two ASCII bytes of the
+# country code, bits 16-47 the IPv4 address and bits 48-63 a checksum of both,
+# so a reader never trusts a word that another process only half wrote.
+SLOT_SIZE = 8
+
+# Number of consecutive slots an address may occupy.
+PROBES = 2
+
+def _checksum(address_value, code):
+    return ((address_value ^ (address_value >> 16) ^ code) * 0x9E37 + 1) & 0xFFFF
+
+class SharedGeoCache(object):
+    """
+    Fixed-size IPv4 address -> country code table in shared memory, so that
+    several interceptor processes share geolocation lookups. Supports the
+    subset of the dict interface MapResolver uses for cached_ip_lookups.
+    Entries are overwritten, never evicted in LRU order, and country codes
+    that are not one or two ASCII characters are not cached.
+    """
+    def __init__(self, name: str=None, slots: int=1 << 18, create: bool=False):
+        if slots <= 0 or slots & (slots - 1) or slots > 1 << 32:
+            raise ValueError(f"Invalid number of slots {slots}, should be a power of two up to 2^32")
+
+        if create:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=slots * SLOT_SIZE)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+
+            # Only the creating process may unlink the segment.
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+
+        self.name = self._shm.name
+        self._owner = create
+        self._slots = self._shm.buf.cast('Q')
+        self._mask = (len(self._slots)) - 1
+
+        # Multiplicative hashing: the top bits of the 32-bit product depend on
+        # every bit of the address, the low bits only on its low bits.
+        self._shift = 32 - (len(self._slots).bit_length() - 1)
+
+    def _get_slot(self, address_value):
+        return ((address_value * 2654435761) & 0xFFFFFFFF) >> self._shift
+
+    def _find(self, address_value):
+        slot = self._get_slot(address_value)
+
+        for probe in range(PROBES):
+            word = self._slots[(slot + probe) & self._mask]
+
+            code = word & 0xFFFF
+
+            if code and (word >> 16) & 0xFFFFFFFF == address_value and word >> 48 == _checksum(address_value, code):
+                return code
+
+        return None
+
+    def __contains__(self, address_value):
+        return self._find(address_value) is not None
+
+    def __getitem__(self, address_value):
+        code = self._find(address_value)
+
+        if code is None:
+            raise KeyError(address_value)
+
+        return code.to_bytes(2, 'big').lstrip(b'\0').decode('ascii')
+
+    def get(self, address_value, default=None):
+        try:
+            return self[address_value]
+        except KeyError:
+            return default
+
+    def __setitem__(self, address_value, country_code):
+        try:
+            code = int.from_bytes(country_code.encode('ascii'), 'big')
+        except (AttributeError, UnicodeEncodeError):
+            return
+
+        if not code or code > 0xFFFF:
+            return
+
+        word = (_checksum(address_value, code) << 48) | (address_value << 16) | code
+
+        slot = self._get_slot(address_value)
+
+        for probe in range(PROBES):
+            index = (slot + probe) & self._mask
+
+            existing = self._slots[index]
+
+            if not existing & 0xFFFF or (existing >> 16) & 0xFFFFFFFF == address_value:
+                self._slots[index] = word
+                return
+
+        self._slots[slot] = word
+
+    def clear(self):
+        """
+        Empties the table for every process sharing it.
+        """
+        self._shm.buf[:len(self._slots) * SLOT_SIZE] = bytes(len(self._slots) * SLOT_SIZE)
+
+    def __len__(self):
+        return sum(1 for word in self._slots if word & 0xFFFF)
+
+    def close(self):
+        self._slots.release()
+        self._shm.close()
+
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,58 @@
+from twisted.internet import defer
+from twisted.python import failure
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key: while a call for a key is in
+    flight, later calls for that key do not start their own work but wait for
+    the first call's result (or failure) instead.
+    """
+    def __init__(self):
+        # key: in-flight key. Value: list of deferreds waiting on that key.
+        self._waiting = dict()
+
+        self.stats = {
+            'calls': 0,
+            'coalesced': 0,
+        }
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def run(self, key, function, *args, **kwargs):
+        """
+        Returns deferred firing with the result of `function(*args, **kwargs)`,
+        which must return a deferred, calling `function` only if no call for
+        `key` is already in flight.
+        """
+        self.stats['calls'] += 1
+
+        waiters = self._waiting.get(key)
+
+        if waiters is not None:
+            self.stats['coalesced'] += 1
+
+            d = defer.Deferred()
+            waiters.append(d)
+
+            return d
+
+        self._waiting[key] = []
+
+        try:
+            d = function(*args, **kwargs)
+        except BaseException:
+            d = defer.fail(failure.Failure())
+
+        d.addBoth(self._finished, key)
+
+        return d
+
+    def _finished(self, result, key):
+        for waiter in self._waiting.pop(key, []):
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+        return result
@@ -43,11 +43,53 @@ def notify_of_new_domains_in_interval(domain_data_db_file, oldest_timestamp, new
     else:
         print('No alert method enabled')
 
+DOMAIN_ACTIONS_FIELDS = ['domain', 'name', 'first_time_seen', 'last_time_seen', 'permitted', 'reason']
+
+def create_domain_actions_table(cursor):
+    """
+    Create the domain_actions table if it does not exist yet.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS domain_actions 
+                    (name TEXT PRIMARY KEY, 
+                    domain TEXT, 
+                    first_time_seen TIMESTAMP WITH TIME ZONE,
+                    last_time_seen TIMESTAMP WITH TIME ZONE,
+                    permitted BOOLEAN,
+                    reason TEXT)''')
+
+def get_log_reason_command(updateable_fields=None):
+    """
+    Build the upsert statement used for logging reasons to domain_actions.
+    """
+    required_fields = DOMAIN_ACTIONS_FIELDS
+
+    if updateable_fields:
+        for updateable_field in updateable_fields:
+            if updateable_field not in required_fields:
+                raise ValueError(f"Updateable field {updateable_field} is not in required fields {required_fields}")
+
+        return 'INSERT INTO domain_actions (' + (', '.join(required_fields)) + ') VALUES (' + (', '.join(['?' for _ in required_fields])) + ') ON CONFLICT (name) DO UPDATE SET ' + (", ".join([f"{field} = CASE WHEN domain_actions.last_time_seen < EXCLUDED.last_time_seen THEN EXCLUDED.{field} ELSE domain_actions.{field} END" for field in updateable_fields]))
+
+    return 'INSERT INTO domain_actions (' + (', '.join(required_fields)) + ') VALUES (' + (', '.join(['?' for _ in required_fields])) + ') ON CONFLICT DO NOTHING'
+
+def log_reasons_batch(connection, values_dicts, updateable_fields=None):
+    """
+    Log a batch of reasons with a single executemany upsert on an already open
+    connection and commit it. Unlike `log_reason`, this does not create the
+    table or print each record, so it is suitable for frequent writers that
+    keep their connection open.
+    """
+    command = get_log_reason_command(updateable_fields)
+
+    connection.executemany(command, [tuple([values_dict[field] for field in DOMAIN_ACTIONS_FIELDS]) for values_dict in values_dicts])
+
+    connection.commit()
+
 def log_reason(domain_data_db_file, values_dicts, updateable_fields=None):
     """
     Log reason for blocking/allowing a domain
     """
-    required_fields = ['domain', 'name', 'first_time_seen', 'last_time_seen', 'permitted', 'reason']
+    required_fields = DOMAIN_ACTIONS_FIELDS
 
     # Sanity checks
     for values_dict in values_dicts:
@@ -55,24 +97,10 @@ def log_reason(domain_data_db_file, values_dicts, updateable_fields=None):
             if field not in values_dict:
                 raise ValueError(f"Missing field \"{field}\" from record {values_dict}")
 
-    if updateable_fields:
-        for updateable_field in updateable_fields:
-            if updateable_field not in required_fields:
-                raise ValueError(f"Updateable field {updateable_field} is not in required fields {required_fields}")
+    command = get_log_reason_command(updateable_fields)
 
     with sqlite3.connect(domain_data_db_file) as cursor:
-        cursor.execute('''CREATE TABLE IF NOT EXISTS domain_actions 
-                        (name TEXT PRIMARY KEY, 
-                        domain TEXT, 
-                        first_time_seen TIMESTAMP WITH TIME ZONE,
-                        last_time_seen TIMESTAMP WITH TIME ZONE,
-                        permitted BOOLEAN,
-                        reason TEXT)''')
-
-        if updateable_fields:
-            command = 'INSERT INTO domain_actions (' + (', '.join(required_fields)) + ') VALUES (' + (', '.join(['?' for _ in required_fields])) + ') ON CONFLICT (name) DO UPDATE SET ' + (", ".join([f"{field} = CASE WHEN domain_actions.last_time_seen < EXCLUDED.last_time_seen THEN EXCLUDED.{field} ELSE domain_actions.{field} END" for field in updateable_fields]))
-        else:
-            command = 'INSERT INTO domain_actions (' + (', '.join(required_fields)) + ') VALUES (' + (', '.join(['?' for _ in required_fields])) + ') ON CONFLICT DO NOTHING'
+        create_domain_actions_table(cursor)
 
         print(f"Running command \"{command}\"")
 
@@ -0,0 +1,186 @@
+import collections
+import cProfile
+import io
+import pstats
+import random
+import signal
+import time
+
+from twisted.application import service
+from twisted.internet import reactor
+
+import metrics
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+class _NullTimer(object):
+    """
+    Timer handed out for queries that are not sampled. Does nothing.
+    """
+    __slots__ = ()
+
+    def mark(self, stage):
+        pass
+
+    def finish(self):
+        pass
+
+NULL_TIMER = _NullTimer()
+
+class StageTimer(object):
+    """
+    Times the stages of one query. `mark(stage)` charges the time since the
+    previous mark to `stage`; marking the same stage several times adds up.
+    """
+    __slots__ = ('profiler', 'last', 'totals', 'profile')
+
+    def __init__(self, profiler, profile=None):
+        self.profiler = profiler
+        self.totals = dict()
+        self.profile = profile
+        self.last = time.monotonic()
+
+    def mark(self, stage):
+        now = time.monotonic()
+
+        self.totals[stage] = self.totals.get(stage, 0.0) + now - self.last
+
+        self.last = now
+
+    def finish(self):
+        self.profiler._finished(self)
+
+class StageProfiler(service.Service):
+    """
+    Opt-in timing of the stages of assessing a query. A `sample_rate`
+    fraction of queries is timed stage by stage with time.monotonic(), and the
+    last `window` timings of each stage are kept for percentile summaries.
+
+    Sending `capture_signal` to the process profiles the next
+    `capture_queries` queries with cProfile, without restarting twistd, and
+    writes the pstats capture to `capture_file` and a summary to stdout.
+    """
+    def __init__(self, sample_rate: float=0.0, window: int=1024, capture_queries: int=100, capture_file: str='.interceptor_profile.pstats', capture_signal=signal.SIGUSR2):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"Invalid sample rate {sample_rate}, should be between 0 and 1")
+
+        self.sample_rate = sample_rate
+        self.window = window
+        self.capture_queries = capture_queries
+        self.capture_file = capture_file
+        self.capture_signal = capture_signal
+
+        # key: stage. Value: most recent durations in seconds.
+        self._durations = dict()
+
+        self._capture_remaining = 0
+        self._profile = None
+        self._previous_handler = None
+
+        self.stats = {
+            'sampled_queries': 0,
+            'captures': 0,
+        }
+
+    def startService(self):
+        service.Service.startService(self)
+
+        if self.capture_signal is not None:
+            self._previous_handler = signal.signal(self.capture_signal, self._signal_received)
+
+    def stopService(self):
+        if self.capture_signal is not None and self._previous_handler is not None:
+            signal.signal(self.capture_signal, self._previous_handler)
+
+        self._previous_handler = None
+
+        return service.Service.stopService(self)
+
+    def _signal_received(self, signum, frame):
+        # Only schedule the capture, the reactor may be in the middle of
+        # anything.
+        reactor.callFromThread(self.capture, self.capture_queries)
+
+    def capture(self, queries):
+        """
+        Profiles the next `queries` queries with cProfile.
+        """
+        if self._profile is not None:
+            print("A profile capture is already running")
+            return
+
+        print(f"Profiling the next {queries} queries")
+
+        self._profile = cProfile.Profile()
+        self._capture_remaining = queries
+
+    def start(self):
+        """
+        Returns a timer for a new query.
+        """
+        if self._profile is not None:
+            self._profile.enable()
+
+            return StageTimer(self, self._profile)
+
+        if self.sample_rate and random.random() < self.sample_rate:
+            return StageTimer(self)
+
+        return NULL_TIMER
+
+    def _finished(self, timer):
+        if timer.profile is not None:
+            timer.profile.disable()
+
+        self.stats['sampled_queries'] += 1
+
+        for stage, duration in timer.totals.items():
+            durations = self._durations.get(stage)
+
+            if durations is None:
+                durations = self._durations[stage] = collections.deque(maxlen=self.window)
+
+            durations.append(duration)
+
+        if timer.profile is not None and timer.profile is self._profile:
+            self._capture_remaining -= 1
+
+            if self._capture_remaining <= 0:
+                self._write_capture()
+
+    def _write_capture(self):
+        profile, self._profile = self._profile, None
+
+        self.stats['captures'] += 1
+
+        try:
+            profile.dump_stats(self.capture_file)
+
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(30)
+
+            print(f"Wrote profile of {self.capture_queries} queries to {self.capture_file}\n{output.getvalue()}")
+        except OSError as e:
+            print(f"Could not write profile to {self.capture_file} due to exception '{e}'")
+
+        for stage, summary in self.get_summary().items():
+            print(f"Stage {stage}: {summary}")
+
+    def get_summary(self):
+        """
+        Returns count and percentiles (in seconds) of the recent durations of
+        every stage.
+        """
+        summary = dict()
+
+        for stage, durations in self._durations.items():
+            ordered = sorted(durations)
+
+            summary[stage] = dict({f"p{int(quantile * 100)}": ordered[min(len(ordered) - 1, int(len(ordered) * quantile))] for quantile in QUANTILES}, count=len(ordered))
+
+        return summary
+
+    def get_metrics(self):
+        samples = [({'stage': stage, 'quantile': str(quantile)}, summary[f"p{int(quantile * 100)}"]) for stage, summary in self.get_summary().items() for quantile in QUANTILES]
+
+        return [metrics.summary('interceptor_stage_duration_seconds', 'Duration of each stage of assessing a sampled query, over recent samples.', samples)]
@@ -1,7 +1,7 @@
 #! /bin/bash
 
 # Don't restart if we don't need it.
-if [ "$(ps -ef | grep 'twistd -ny ' | grep 'interceptor.py' | grep -v 'grep')" != "" ]; then
+if [ "$(ps -ef | grep -e 'twistd -ny ' -e 'interceptor_supervisor.py' | grep 'interceptor' | grep -v 'grep')" != "" ]; then
     exit 0
 fi
 
@@ -36,7 +36,7 @@ if [ "$IP2LOCATION_BIN_FILE_PATH" == "" ]; then
 fi
 
 if [ "$IP2LOCATION_MODE" == "" ]; then
-        export IP2LOCATION_MODE='SHARED_MEMORY'
+        export IP2LOCATION_MODE='COMPILED'
 fi
 
 if [ "$BLOCKED_COUNTRIES_LIST" == "" ]; then
@@ -85,6 +85,14 @@ if [ "$GROUP_IDS" == "" ]; then
         export GROUP_IDS='0'
 fi
 
-nohup twistd -ny ./interceptor.py > ./start_interceptor.sh.stdout.log 2> ./start_interceptor.sh.stderr.log &
+if [ "$INTERCEPTOR_WORKERS" == "" ]; then
+        export INTERCEPTOR_WORKERS=1
+fi
+
+if [ $INTERCEPTOR_WORKERS -gt 1 ]; then
+        nohup python interceptor_supervisor.py "$INTERCEPTOR_WORKERS" > ./start_interceptor.sh.stdout.log 2> ./start_interceptor.sh.stderr.log &
+else
+        nohup twistd -ny ./interceptor.py > ./start_interceptor.sh.stdout.log 2> ./start_interceptor.sh.stderr.log &
+fi
 
 popd
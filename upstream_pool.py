@@ -0,0 +1,352 @@
+import collections
+import ipaddress
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+import metrics
+
+class UpstreamServer(object):
+    """
+    Latency and failure statistics for one upstream DNS server.
+    """
+    def __init__(self, address, alpha, max_samples):
+        self.address = address
+        self.alpha = alpha
+
+        # Exponentially weighted moving averages. rtt is None until the first
+        # response arrives.
+        self.rtt = None
+        self.failure_rate = 0.0
+
+        self.last_failure_time = None
+
+        self.samples = collections.deque(maxlen=max_samples)
+
+        self.stats = {
+            'queries': 0,
+            'responses': 0,
+            'failures': 0,
+        }
+
+    def record_success(self, rtt):
+        self.rtt = rtt if self.rtt is None else (1 - self.alpha) * self.rtt + self.alpha * rtt
+        self.failure_rate = (1 - self.alpha) * self.failure_rate
+
+        self.samples.append(rtt)
+
+        self.stats['responses'] += 1
+
+    def record_failure(self):
+        self.failure_rate = (1 - self.alpha) * self.failure_rate + self.alpha
+
+        self.last_failure_time = time.monotonic()
+
+        self.stats['failures'] += 1
+
+    def get_rtt_percentile(self, percentile):
+        """
+        Returns the `percentile` percentile of recent round trip times, or
+        None if there are not enough samples yet.
+        """
+        if len(self.samples) < 10:
+            return None
+
+        ordered = sorted(self.samples)
+
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+class UpstreamPool(object):
+    """
+    Chooses among several upstream DNS servers by tracking each server's
+    round trip time and failure rate as exponentially weighted moving averages.
+    Queries go to the fastest healthy server first and move down the ranking
+    on timeouts, the same way client.Resolver.queryUDP cycles through its
+    servers. If `hedge_percentile` is set, a query that has not been answered
+    after that percentile of the first server's recent round trip times is
+    also sent to the next server, and whichever answers first wins.
+
+    Servers are ranked by their expected latency: the average round trip time
+    plus the failure rate times `failure_penalty_sec`, which approximates the
+    time lost waiting for a timeout.
+
+    A server is unhealthy while its failure rate exceeds
+    `max_failure_rate`. Unhealthy servers are ranked last, but are tried
+    again `retry_unhealthy_sec` after their last failure so they can recover.
+    """
+    def __init__(self, addresses: list, alpha: float=0.2, max_failure_rate: float=0.5, retry_unhealthy_sec: int=30, failure_penalty_sec: float=1.0, hedge_percentile: float=None, min_hedge_delay_sec: float=0.01, default_hedge_delay_sec: float=0.25, max_samples: int=200, clock=None):
+        if not addresses:
+            raise ValueError("At least one upstream server is required")
+
+        if hedge_percentile is not None and not 0 < hedge_percentile <= 100:
+            raise ValueError(f"Invalid hedge percentile {hedge_percentile}, should be in (0, 100]")
+
+        self.servers = [UpstreamServer(tuple(address), alpha, max_samples) for address in addresses]
+        self.max_failure_rate = max_failure_rate
+        self.retry_unhealthy_sec = retry_unhealthy_sec
+        self.failure_penalty_sec = failure_penalty_sec
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay_sec = min_hedge_delay_sec
+        self.default_hedge_delay_sec = default_hedge_delay_sec
+
+        self._clock = clock if clock is not None else reactor
+
+        self.stats = {
+            'queries': 0,
+            'hedges_sent': 0,
+            'hedge_wins': 0,
+            'failed_queries': 0,
+        }
+
+        self.rtt_histogram = metrics.Histogram(metrics.LATENCY_BUCKETS)
+
+    def is_healthy(self, server):
+        if server.failure_rate <= self.max_failure_rate:
+            return True
+
+        return time.monotonic() - server.last_failure_time >= self.retry_unhealthy_sec
+
+    def get_expected_latency(self, server):
+        return (server.rtt if server.rtt is not None else 0.0) + server.failure_rate * self.failure_penalty_sec
+
+    def ranked(self):
+        """
+        Returns servers ordered from most to least preferable: healthy before
+        unhealthy, then lowest expected latency first. Servers without any
+        response yet are tried early so that their latency gets measured.
+        """
+        return sorted(self.servers, key=lambda server: (not self.is_healthy(server), self.get_expected_latency(server)))
+
+    def pick_address(self):
+        return self.ranked()[0].address
+
+    def get_hedge_delay(self, server):
+        delay = server.get_rtt_percentile(self.hedge_percentile)
+
+        if delay is None:
+            return self.default_hedge_delay_sec
+
+        return max(self.min_hedge_delay_sec, delay)
+
+    def query(self, send, queries, timeouts):
+        """
+        Sends `queries` through `send(address, queries, timeout)`, which must
+        return a deferred (e.g., client.Resolver._query). Returns a deferred
+        firing with the first response, or failing once every server failed
+        for every timeout in `timeouts`: with defer.TimeoutError if the last
+        attempt timed out, and otherwise with the failure of the last attempt
+        (e.g., ConnectionRefusedError).
+        """
+        self.stats['queries'] += 1
+
+        ranked = self.ranked()
+
+        attempts = collections.deque([(server, timeout) for timeout in timeouts for server in ranked])
+
+        result = defer.Deferred()
+
+        state = {'outstanding': 0, 'hedge_call': None}
+
+        def finished():
+            return result.called
+
+        def cancel_hedge():
+            if state['hedge_call'] is not None and state['hedge_call'].active():
+                state['hedge_call'].cancel()
+
+            state['hedge_call'] = None
+
+        def attempt(hedged=False):
+            server, timeout = attempts.popleft()
+
+            server.stats['queries'] += 1
+            state['outstanding'] += 1
+
+            start = time.monotonic()
+
+            try:
+                d = send(server.address, queries, timeout)
+            except BaseException:
+                d = defer.fail(failure.Failure())
+
+            d.addCallbacks(succeeded, failed, callbackArgs=(server, start, hedged), errbackArgs=(server,))
+
+        def succeeded(message, server, start, hedged):
+            state['outstanding'] -= 1
+
+            rtt = time.monotonic() - start
+
+            server.record_success(rtt)
+
+            self.rtt_histogram.observe(rtt)
+
+            if finished():
+                return
+
+            cancel_hedge()
+
+            if hedged:
+                self.stats['hedge_wins'] += 1
+
+            result.callback(message)
+
+        def failed(reason, server):
+            state['outstanding'] -= 1
+
+            server.record_failure()
+
+            if finished():
+                return
+
+            if attempts:
+                cancel_hedge()
+                attempt()
+            elif not state['outstanding']:
+                self.stats['failed_queries'] += 1
+
+                # Like client.Resolver: a timeout of the last attempt is
+                # reported as defer.TimeoutError of the queries, any other
+                # failure as it is.
+                if reason.check(defer.TimeoutError):
+                    result.errback(failure.Failure(defer.TimeoutError(queries)))
+                else:
+                    result.errback(reason)
+
+        def hedge():
+            state['hedge_call'] = None
+
+            if finished() or not attempts:
+                return
+
+            self.stats['hedges_sent'] += 1
+
+            attempt(hedged=True)
+
+        if self.hedge_percentile is not None and len(self.servers) > 1:
+            state['hedge_call'] = self._clock.callLater(self.get_hedge_delay(ranked[0]), hedge)
+
+        attempt()
+
+        return result
+
+    def get_server_stats(self):
+        """
+        Statistics of every upstream server keyed by "ip:port".
+        """
+        return {f"{server.address[0]}:{server.address[1]}": dict(server.stats, rtt_sec=server.rtt, failure_rate=server.failure_rate, healthy=self.is_healthy(server)) for server in self.servers}
+
+    def get_metrics(self):
+        servers = [(f"{server.address[0]}:{server.address[1]}", server) for server in self.servers]
+
+        return [
+            metrics.histogram('interceptor_upstream_rtt_seconds', 'Round trip time of answered upstream queries.', self.rtt_histogram),
+            metrics.gauge('interceptor_upstream_rtt_ewma_seconds', 'Moving average of the round trip time per upstream server.', [({'server': address}, server.rtt) for address, server in servers]),
+            metrics.gauge('interceptor_upstream_failure_rate', 'Moving average of the failure rate per upstream server.', [({'server': address}, server.failure_rate) for address, server in servers]),
+            metrics.counter('interceptor_upstream_queries_total', 'Queries sent per upstream server.', [({'server': address}, server.stats['queries']) for address, server in servers]),
+            metrics.counter('interceptor_upstream_failures_total', 'Queries per upstream server that timed out or failed.', [({'server': address}, server.stats['failures']) for address, server in servers]),
+            metrics.counter('interceptor_upstream_hedges_total', 'Hedged upstream queries by whether they answered first.', [({'won': 'true'}, self.stats['hedge_wins']), ({'won': 'false'}, self.stats['hedges_sent'] - self.stats['hedge_wins'])]),
+        ]
+
+def parse_upstream_servers(servers: str):
+    """
+    Parses a comma separated list of "ip:port", "[ipv6]:port" or "ip" (port
+    53) entries.
+    """
+    addresses = []
+
+    for server in servers.split(','):
+        server = server.strip()
+
+        if not server:
+            continue
+
+        if server.startswith('['):
+            ip, separator, port = server[1:].partition(']:')
+
+            if not separator:
+                raise ValueError(f"Invalid upstream server '{server}', should be '[ipv6]:port'")
+        elif server.count(':') == 1:
+            ip, port = server.split(':')
+        else:
+            ip, port = server, '53'
+
+        try:
+            ipaddress.ip_address(ip)
+            port = int(port)
+        except ValueError:
+            raise ValueError(f"Invalid upstream server '{server}', should be 'ip:port', '[ipv6]:port' or 'ip'") from None
+
+        if not 0 < port < 65536:
+            raise ValueError(f"Invalid upstream server port in '{server}', should be from 1 to 65535")
+
+        addresses.append((ip, port))
+
+    return addresses
+
+def main():
+    """
+    Sends queries through a pool of three local stub servers: a fast one that
+    drops 30% of queries, a slow one, and one with a heavy latency tail.
+    """
+    import random
+
+    from twisted.names import client, common, dns, server
+
+    class StubResolver(common.ResolverBase):
+        def __init__(self, delay_function):
+            common.ResolverBase.__init__(self)
+            self.delay_function = delay_function
+
+        def _lookup(self, name, cls, type, timeout):
+            d = defer.Deferred()
+            reactor.callLater(self.delay_function(), d.callback, ([dns.RRHeader(name, dns.A, dns.IN, 60, dns.Record_A('192.0.2.1', 60))], [], []))
+            return d
+
+    class LossyDatagramProtocol(dns.DNSDatagramProtocol):
+        loss = 0.0
+
+        def datagramReceived(self, data, addr):
+            if random.random() >= self.loss:
+                dns.DNSDatagramProtocol.datagramReceived(self, data, addr)
+
+    addresses = []
+
+    for delay_function, loss in [(lambda: 0.005, 0.3), (lambda: 0.05, 0.0), (lambda: 0.01 if random.random() < 0.8 else 0.4, 0.0)]:
+        protocol = LossyDatagramProtocol(server.DNSServerFactory(authorities=[StubResolver(delay_function)]))
+        protocol.loss = loss
+        port = reactor.listenUDP(0, protocol, interface='127.0.0.1')
+        addresses.append(('127.0.0.1', port.getHost().port))
+
+    resolver = client.Resolver(servers=addresses)
+    pool = UpstreamPool(addresses, hedge_percentile=90)
+
+    latencies = []
+
+    @defer.inlineCallbacks
+    def run():
+        for i in range(300):
+            start = time.monotonic()
+
+            try:
+                yield pool.query(resolver._query, [dns.Query(f"host{i}.example".encode('utf-8'))], (1, 3))
+            except defer.TimeoutError:
+                pass
+
+            latencies.append(time.monotonic() - start)
+
+        latencies.sort()
+
+        print(f"p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+        print(pool.stats)
+
+        for address, stats in pool.get_server_stats().items():
+            print(address, stats)
+
+        reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+from twisted.internet import defer, protocol, reactor
+from twisted.names import dns
+
+TRANSPORTS = ['udp', 'tcp', 'tls']
+
+class PipelinedDNSProtocol(dns.DNSProtocol):
+    """
+    DNS over TCP (or TLS) protocol that remembers the queries it sent by
+    message ID, so that queries still waiting for an answer when the
+    connection is lost can be sent again on another connection.
+    """
+    def connectionMade(self):
+        self.sentQueries = {}
+
+        dns.DNSProtocol.connectionMade(self)
+
+    def query(self, queries, timeout=60, retry=False):
+        id = self.pickID()
+
+        d = self._query(queries, timeout, id, self.writeMessage)
+
+        if id in self.liveMessages:
+            self.sentQueries[id] = (queries, timeout, retry)
+            d.addBoth(self._forget, id)
+
+        return d
+
+    def _forget(self, result, id):
+        self.sentQueries.pop(id, None)
+
+        return result
+
+    def get_outstanding(self):
+        return len(self.liveMessages)
+
+class _ConnectionFactory(protocol.ClientFactory):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def buildProtocol(self, addr):
+        p = PipelinedDNSProtocol(self.pool, self.pool._reactor)
+        p.factory = self
+        return p
+
+    def clientConnectionFailed(self, connector, reason):
+        self.pool._connection_failed(reason)
+
+class UpstreamConnectionPool(object):
+    """
+    Up to `size` long-lived TCP connections to one upstream DNS server, or
+    DNS over TLS (RFC 7858) connections if `tls` is set. Queries are
+    pipelined: each goes out right away on the connected connection with the
+    fewest outstanding queries and is matched to its answer by message ID.
+    Another connection is opened whenever every open one has outstanding
+    queries.
+
+    Connections are opened on demand, so one that the server closed is
+    replaced by the next query. Queries that were waiting for an answer on a
+    lost connection are sent once more on another connection.
+
+    With `tls`, the server certificate is checked against `tls_hostname`
+    unless `tls_verify` is False, which is only meant for testing. TLS needs
+    pyOpenSSL and service_identity (pip install twisted[tls]).
+    """
+    def __init__(self, address, size: int=2, tls: bool=False, tls_hostname: str=None, tls_verify: bool=True, clock=None):
+        if size <= 0:
+            raise ValueError(f"Invalid connection pool size {size}, should be greater than zero")
+
+        self.address = tuple(address)
+        self.size = size
+        self.tls = tls
+
+        self._reactor = clock if clock is not None else reactor
+        self._factory = _ConnectionFactory(self)
+        self._tls_options = self._get_tls_options(tls_hostname or self.address[0], tls_verify) if tls else None
+
+        self._connections = []
+        self._connecting = 0
+
+        # (deferred, queries, timeout, retry) waiting for a connection.
+        self._pending = []
+
+        self.stats = {
+            'queries': 0,
+            'connections_opened': 0,
+            'connection_failures': 0,
+            'connections_lost': 0,
+            'queries_resent': 0,
+        }
+
+    @staticmethod
+    def _get_tls_options(hostname, verify):
+        from twisted.internet import ssl
+
+        if not verify:
+            return ssl.CertificateOptions(verify=False)
+
+        return ssl.optionsForClientTLS(hostname)
+
+    def __len__(self):
+        return len(self._connections)
+
+    def _connect(self):
+        self._connecting += 1
+
+        host, port = self.address
+
+        if self.tls:
+            self._reactor.connectSSL(host, port, self._factory, self._tls_options)
+        else:
+            self._reactor.connectTCP(host, port, self._factory)
+
+    def query(self, queries, timeout=10, retry=True):
+        """
+        Returns a deferred firing with the answer message to `queries`.
+        """
+        self.stats['queries'] += 1
+
+        if self._connections:
+            connection = min(self._connections, key=PipelinedDNSProtocol.get_outstanding)
+
+            if connection.get_outstanding() and len(self._connections) + self._connecting < self.size:
+                self._connect()
+
+            return connection.query(queries, timeout, retry)
+
+        d = defer.Deferred()
+
+        self._pending.append((d, queries, timeout, retry))
+
+        if not self._connecting:
+            self._connect()
+
+        return d
+
+    # Called by PipelinedDNSProtocol.
+    def connectionMade(self, connection):
+        self._connecting -= 1
+
+        self._connections.append(connection)
+
+        self.stats['connections_opened'] += 1
+
+        pending, self._pending = self._pending, []
+
+        for d, queries, timeout, retry in pending:
+            connection.query(queries, timeout, retry).chainDeferred(d)
+
+    # Called by PipelinedDNSProtocol.
+    def connectionLost(self, connection):
+        if connection in self._connections:
+            self._connections.remove(connection)
+
+        self.stats['connections_lost'] += 1
+
+        live, connection.liveMessages = connection.liveMessages, {}
+
+        for id, (d, canceller) in live.items():
+            canceller.cancel()
+
+            queries, timeout, retry = connection.sentQueries.pop(id, (None, None, False))
+
+            if retry:
+                self.stats['queries_resent'] += 1
+
+                self.query(queries, timeout, retry=False).chainDeferred(d)
+            else:
+                d.errback(dns.DNSQueryTimeoutError(id))
+
+    # Called by PipelinedDNSProtocol for answers nobody waits for any more.
+    def messageReceived(self, message, connection, address=None):
+        pass
+
+    def _connection_failed(self, reason):
+        self._connecting -= 1
+
+        self.stats['connection_failures'] += 1
+
+        if self._connecting or self._connections:
+            return
+
+        pending, self._pending = self._pending, []
+
+        for d, queries, timeout, retry in pending:
+            d.errback(reason)
+
+    def close(self):
+        for connection in list(self._connections):
+            connection.transport.loseConnection()
+
+def main():
+    """
+    Sends queries to a local DNS over TLS stub server through a pool of
+    persistent connections, dropping the server side of every connection
+    halfway through, and compares that with client.Resolver.queryTCP opening
+    a new connection per query.
+    """
+    import datetime
+    import time
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from twisted.internet import ssl
+    from twisted.names import client, common, server
+
+    class StubResolver(common.ResolverBase):
+        def _lookup(self, name, cls, type, timeout):
+            return defer.succeed(([dns.RRHeader(name, dns.A, dns.IN, 60, dns.Record_A('192.0.2.1', 60))], [], []))
+
+    server_factory = server.DNSServerFactory(authorities=[StubResolver()])
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    certificate = x509.CertificateBuilder().subject_name(subject).issuer_name(subject).public_key(key.public_key()).serial_number(1).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256())
+    certificate = ssl.PrivateCertificate.loadPEM(certificate.public_bytes(serialization.Encoding.PEM) + key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    tls_port = reactor.listenSSL(0, server_factory, certificate.options(), interface='127.0.0.1')
+    tcp_port = reactor.listenTCP(0, server_factory, interface='127.0.0.1')
+
+    tls_address = ('127.0.0.1', tls_port.getHost().port)
+    tcp_address = ('127.0.0.1', tcp_port.getHost().port)
+
+    count = 2000
+
+    @defer.inlineCallbacks
+    def run():
+        pool = UpstreamConnectionPool(tls_address, size=2, tls=True, tls_verify=False)
+
+        start = time.monotonic()
+
+        deferreds = [pool.query([dns.Query(f"host{i}.example".encode('utf-8'))]) for i in range(count // 2)]
+
+        yield defer.gatherResults(deferreds)
+
+        for connection in list(server_factory.connections):
+            connection.transport.loseConnection()
+
+        deferreds = [pool.query([dns.Query(f"host{i}.example".encode('utf-8'))]) for i in range(count // 2)]
+
+        answers = yield defer.gatherResults(deferreds)
+
+        print(f"Pooled DNS over TLS: {count} queries in {time.monotonic() - start:.3f} sec, {len(answers)} answers after reconnecting, {pool.stats}")
+
+        pool.close()
+
+        pool = UpstreamConnectionPool(tcp_address, size=2)
+        resolver = client.Resolver(servers=[tcp_address])
+
+        for name, send in [('Pooled TCP connections', lambda queries: pool.query(queries)), ('New TCP connection per query', lambda queries: resolver.queryTCP(queries))]:
+            start = time.monotonic()
+
+            for i in range(count // 10):
+                resolver.connections = []
+
+                yield send([dns.Query(f"host{i}.example".encode('utf-8'))])
+
+            print(f"{name}: {count // 10} queries one at a time in {time.monotonic() - start:.3f} sec")
+
+        for connection in list(server_factory.connections):
+            connection.transport.loseConnection()
+
+        reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
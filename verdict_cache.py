@@ -0,0 +1,164 @@
+import datetime
+import time
+
+import pylru
+
+from twisted.application import service
+from twisted.internet import task
+from twisted.names import dns
+
+class Verdict(object):
+    """
+    Cached outcome of assessing an answer for a name.
+    """
+    __slots__ = ('domain', 'reason', 'permitted', 'logged', 'expires_at')
+
+    def __init__(self, domain, reason, permitted, logged, expires_at):
+        self.domain = domain
+        self.reason = reason
+        self.permitted = permitted
+        self.logged = logged
+        self.expires_at = expires_at
+
+class VerdictCache(service.Service):
+    """
+    Bounded cache of allow/block verdicts keyed by FQDN, query type (A or
+    AAAA) and the set of addresses in the upstream answer. An entry lives no longer than the
+    smallest TTL in the answer it was computed from. A hit only bumps the
+    name's last-seen time, and the bumped names are handed to `log_function`
+    every `flush_interval_sec` so domain_actions.last_time_seen stays
+    accurate without a write per query.
+
+    The cache is cleared whenever the policy key passed to `get` changes, e.g.
+    because the whitelist snapshot or the blocked country list changed.
+    """
+    def __init__(self, log_function, max_size=10000, flush_interval_sec=10.0):
+        self.log_function = log_function
+        self.flush_interval_sec = flush_interval_sec
+
+        # key: (fqdn, query type, frozenset of address values). Value: Verdict
+        self._verdicts = pylru.lrucache(max_size)
+
+        # key: fqdn. Value: (Verdict, last seen time)
+        self._seen = dict()
+
+        self._policy_key = None
+        self._loop = None
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'expirations': 0,
+            'invalidations': 0,
+            'discards': 0,
+            'last_seen_flushed': 0,
+        }
+
+    def startService(self):
+        service.Service.startService(self)
+
+        self._loop = task.LoopingCall(self.flush_last_seen)
+        self._loop.start(self.flush_interval_sec, now=False)
+
+    def stopService(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+        self._loop = None
+
+        self.flush_last_seen()
+
+        return service.Service.stopService(self)
+
+    def __len__(self):
+        return len(self._verdicts)
+
+    def clear(self):
+        self._verdicts.clear()
+
+        self.stats['invalidations'] += 1
+
+    def items(self):
+        """
+        Returns a list of ((name, query type, address values), Verdict) for
+        every cached verdict.
+        """
+        return list(self._verdicts.items())
+
+    def discard(self, key, verdict):
+        """
+        Removes the verdict cached under `key` if it is still `verdict`, so
+        that a verdict computed since `verdict` was read is kept.
+        """
+        if self._verdicts.get(key) is verdict:
+            del self._verdicts[key]
+
+            self.stats['discards'] += 1
+
+    def get(self, name, address_values, policy_key, type=dns.A):
+        """
+        Returns the cached Verdict for a `type` query for `name` resolving to
+        `address_values` under policy `policy_key`, or None.
+        """
+        if policy_key != self._policy_key:
+            if self._policy_key is not None:
+                self.clear()
+
+            self._policy_key = policy_key
+
+        key = (name, type, address_values)
+
+        verdict = self._verdicts.get(key)
+
+        if verdict is None:
+            self.stats['misses'] += 1
+            return None
+
+        if verdict.expires_at <= time.monotonic():
+            del self._verdicts[key]
+
+            self.stats['expirations'] += 1
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+
+        self.mark_seen(name, verdict)
+
+        return verdict
+
+    def mark_seen(self, name, verdict):
+        """
+        Records that `name` was answered again based on `verdict`.
+        """
+        if verdict.logged:
+            self._seen[name] = verdict
+
+    def put(self, name, address_values, ttl, domain, reason, permitted, logged, type=dns.A):
+        """
+        Returns a new Verdict, cached for `ttl` seconds. Verdicts with no TTL
+        are not cached.
+        """
+        verdict = Verdict(domain, reason, permitted, logged, time.monotonic() + (ttl or 0))
+
+        if ttl is not None and ttl > 0:
+            self._verdicts[(name, type, address_values)] = verdict
+
+        return verdict
+
+    def flush_last_seen(self):
+        """
+        Logs the last-seen time of every name with a cache hit since the last
+        flush.
+        """
+        if not self._seen:
+            return
+
+        seen, self._seen = self._seen, dict()
+
+        right_now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+        for name, verdict in seen.items():
+            self.log_function(name, verdict.domain, verdict.reason, verdict.permitted, right_now)
+
+        self.stats['last_seen_flushed'] += len(seen)
@@ -0,0 +1,211 @@
+import sqlite3
+import threading
+import time
+import traceback
+
+from twisted.application import service
+
+import metrics
+import sqlite_utils
+
+class VerdictLogger(service.Service):
+    """
+    Write-behind logger for interceptor verdicts. Verdicts are put in a
+    bounded in-memory queue keyed by FQDN, so repeated verdicts for the same
+    name are coalesced into one row. A background thread flushes the queue
+    with a single executemany upsert whenever `batch_size` names are pending
+    or `flush_interval_sec` has passed, whichever comes first. Stopping the
+    service (e.g., when twistd shuts down) flushes whatever is still pending.
+    """
+    def __init__(self, domain_data_db_file, updateable_fields=None, max_queue_size=10000, batch_size=500, flush_interval_sec=2.0):
+        if max_queue_size <= 0:
+            raise ValueError(f"Invalid max queue size {max_queue_size}, should be greater than zero")
+
+        if batch_size <= 0:
+            raise ValueError(f"Invalid batch size {batch_size}, should be greater than zero")
+
+        self.domain_data_db_file = domain_data_db_file
+        self.updateable_fields = updateable_fields
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+
+        # key: fqdn. Value: domain_actions record dict
+        self._pending = dict()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+        self.stats = {
+            'enqueued': 0,
+            'coalesced': 0,
+            'dropped': 0,
+            'queue_high_water_mark': 0,
+            'flushed_rows': 0,
+            'flushed_batches': 0,
+            'write_errors': 0,
+            'last_flush_duration_sec': 0.0,
+        }
+
+        # Only observed by the writer thread.
+        self.write_latency = metrics.Histogram(metrics.WRITE_BUCKETS)
+
+    def log(self, name, domain, reason, permitted, seen_time):
+        """
+        Queue a verdict for `name`. Never blocks on the database. Returns
+        False if the queue was full and the verdict had to be dropped.
+        """
+        with self._condition:
+            record = self._pending.get(name)
+
+            if record is not None:
+                # Calls may arrive out of order, so only a verdict at least as
+                # recent as the queued one replaces it.
+                if seen_time >= record['last_time_seen']:
+                    record['domain'] = domain
+                    record['reason'] = reason
+                    record['permitted'] = permitted
+
+                record['first_time_seen'] = min(record['first_time_seen'], seen_time)
+                record['last_time_seen'] = max(record['last_time_seen'], seen_time)
+
+                self.stats['coalesced'] += 1
+
+                return True
+
+            if len(self._pending) >= self.max_queue_size:
+                self.stats['dropped'] += 1
+
+                return False
+
+            self._pending[name] = {'name': name, 'domain': domain, 'reason': reason, 'permitted': permitted, 'first_time_seen': seen_time, 'last_time_seen': seen_time}
+
+            self.stats['enqueued'] += 1
+
+            queue_depth = len(self._pending)
+
+            if queue_depth > self.stats['queue_high_water_mark']:
+                self.stats['queue_high_water_mark'] = queue_depth
+
+            if queue_depth >= self.batch_size:
+                self._condition.notify()
+
+        return True
+
+    def queue_depth(self):
+        """
+        Number of names waiting to be written.
+        """
+        return len(self._pending)
+
+    def get_metrics(self):
+        return [
+            metrics.gauge('interceptor_verdict_log_queue_depth', 'Verdicts waiting to be written to sqlite.', [({}, self.queue_depth())]),
+            metrics.counter('interceptor_verdict_log_rows_total', 'Verdicts written to sqlite.', [({}, self.stats['flushed_rows'])]),
+            metrics.counter('interceptor_verdict_log_dropped_total', 'Verdicts dropped because the queue was full.', [({}, self.stats['dropped'])]),
+            metrics.counter('interceptor_verdict_log_write_errors_total', 'Failed sqlite batch writes.', [({}, self.stats['write_errors'])]),
+            metrics.histogram('interceptor_verdict_log_write_duration_seconds', 'Duration of sqlite batch writes.', self.write_latency),
+        ]
+
+    def startService(self):
+        service.Service.startService(self)
+
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='verdict-logger', daemon=True)
+        self._thread.start()
+
+    def stopService(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        return service.Service.stopService(self)
+
+    def _take_batch(self):
+        batch = list(self._pending.values())
+        self._pending = dict()
+
+        return batch
+
+    def _requeue(self, batch):
+        """
+        Put back records from a failed write unless newer verdicts for the
+        same names have arrived in the meantime or the queue has filled up.
+        """
+        with self._condition:
+            for record in batch:
+                if record['name'] in self._pending:
+                    continue
+
+                if len(self._pending) >= self.max_queue_size:
+                    self.stats['dropped'] += 1
+                    continue
+
+                self._pending[record['name']] = record
+
+    def _write(self, connection, batch):
+        """
+        Writes `batch` in one transaction. Returns False if it failed and
+        should be written again.
+        """
+        start = time.monotonic()
+
+        try:
+            sqlite_utils.log_reasons_batch(connection, batch, self.updateable_fields)
+
+            self.stats['flushed_rows'] += len(batch)
+            self.stats['flushed_batches'] += 1
+
+            return True
+        except Exception as e:
+            traceback.print_exc()
+            print(f"Could not write {len(batch)} verdict(s) due to exception '{e}'")
+
+            self.stats['write_errors'] += 1
+
+            # Rows written before the error must not be committed with the
+            # next batch.
+            try:
+                connection.rollback()
+            except sqlite3.Error:
+                traceback.print_exc()
+
+            # Only errors of the database itself, like a locked database, may
+            # go away. A batch with a bad record would fail the same way again.
+            if not isinstance(e, sqlite3.OperationalError):
+                self.stats['dropped'] += len(batch)
+
+                return True
+
+            return False
+        finally:
+            self.stats['last_flush_duration_sec'] = time.monotonic() - start
+
+            self.write_latency.observe(self.stats['last_flush_duration_sec'])
+
+    def _run(self):
+        connection = sqlite3.connect(self.domain_data_db_file, check_same_thread=False)
+
+        try:
+            sqlite_utils.create_domain_actions_table(connection)
+            connection.commit()
+
+            while True:
+                with self._condition:
+                    if not self._stopping and len(self._pending) < self.batch_size:
+                        self._condition.wait(timeout=self.flush_interval_sec)
+
+                    stopping = self._stopping
+                    batch = self._take_batch()
+
+                if batch and not self._write(connection, batch) and not stopping:
+                    self._requeue(batch)
+
+                if stopping:
+                    break
+        finally:
+            connection.close()
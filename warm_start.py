@@ -0,0 +1,248 @@
+import base64
+import json
+import os
+import time
+import traceback
+
+from twisted.application import service
+from twisted.internet import task, threads
+from twisted.names import dns
+
+import file_utils
+from domain_list_matcher import DomainListMatcher
+
+SNAPSHOT_VERSION = 2
+
+def _encode_dns_entry(query, when, payload):
+    """
+    Encodes a DNS answer cache entry as [when, DNS message in wire format,
+    base64 encoded].
+    """
+    answers, authority, additional = payload
+
+    message = dns.Message()
+    message.queries = [query]
+    message.answers = answers
+    message.authority = authority
+    message.additional = additional
+
+    return [when, base64.b64encode(message.toStr()).decode('ascii')]
+
+def _decode_dns_entry(entry):
+    """
+    Returns (query, (when, payload)) of an entry encoded by _encode_dns_entry.
+    """
+    when, wire = entry
+
+    message = dns.Message()
+    message.fromStr(base64.b64decode(wire))
+
+    return message.queries[0], (when, (message.answers, message.authority, message.additional))
+
+def _write_snapshot_file(snapshot_file, state):
+    # Runs in a thread. The state only holds copies, so encoding it here does
+    # not race with the reactor. Plain JSON, so that reading a tampered file
+    # cannot run code.
+    state = dict(state, dns_cache=[_encode_dns_entry(query, when, payload) for query, (when, payload) in state['dns_cache']])
+
+    temp_file = f"{snapshot_file}.tmp"
+
+    with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump(state, f)
+
+    os.replace(temp_file, snapshot_file)
+
+class WarmStartSnapshot(service.Service):
+    """
+    Saves the DNS answer cache, MapResolver's IP -> country cache and its
+    whitelist snapshot to `snapshot_file` every `interval_sec` and on
+    shutdown, and restores them on startup so a restarted interceptor does not
+    start cold.
+
+    When restoring, answers whose TTL ran out while the interceptor was down
+    are dropped and the remaining TTLs are shortened by the downtime. Cached
+    answers are dropped entirely if the blocked country list changed, cached
+    country codes if the IP2Location BIN file changed, and the whitelist if it
+    is older than the resolver allows serving.
+
+    `started_at` is the time.monotonic() value the process started at, used
+    to report how long it took from startup until the caches were warm.
+    """
+    def __init__(self, snapshot_file: str, dns_cache, resolver, interval_sec: int=300, started_at: float=None):
+        self.snapshot_file = snapshot_file
+        self.dns_cache = dns_cache
+        self.resolver = resolver
+        self.interval_sec = interval_sec
+        self.started_at = started_at
+
+        self._loop = None
+        self._saving = False
+
+        self.stats = {
+            'saves': 0,
+            'save_failures': 0,
+            'last_save_duration_sec': 0.0,
+            'restored_dns_entries': 0,
+            'expired_dns_entries': 0,
+            'restored_ip_lookups': 0,
+            'restored_whitelist_entries': 0,
+            'load_duration_sec': 0.0,
+            'startup_to_warm_duration_sec': 0.0,
+        }
+
+    def startService(self):
+        service.Service.startService(self)
+
+        self.load()
+
+        self._loop = task.LoopingCall(self.save)
+        self._loop.start(self.interval_sec, now=False)
+
+    def stopService(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+        self._loop = None
+
+        service.Service.stopService(self)
+
+        # Written synchronously, the reactor is about to stop.
+        try:
+            _write_snapshot_file(self.snapshot_file, self.get_state())
+        except BaseException as be:
+            traceback.print_exc()
+            print(f"Could not save cache snapshot to {self.snapshot_file} due to exception '{be}'")
+
+    def get_state(self):
+        """
+        Returns copies of everything that is saved, safe to encode outside
+        the reactor thread. The records and whitelist entries in them are
+        shared, they are only ever replaced, never modified.
+        """
+        resolver = self.resolver
+
+        ip_lookups = []
+
+        # A shared memory cache outlives the worker, so there is nothing to
+        # save.
+        if hasattr(resolver.cached_ip_lookups, 'items'):
+            ip_lookups = [[address_value, country_code] for address_value, country_code in resolver.cached_ip_lookups.items()]
+
+        whitelist = resolver.whitelist_refresher.get_snapshot()
+
+        if whitelist is not None:
+            entries, matcher, age_sec = whitelist
+
+            whitelist = [list(entries), age_sec]
+
+        return {
+            'version': SNAPSHOT_VERSION,
+            'saved_at': time.time(),
+            'blocked_countries_list': list(resolver.geo_policy.blocked_countries_list),
+            'dns_cache': [(query, (when, tuple(list(section) for section in payload))) for query, (when, payload) in self.dns_cache.cache.items()],
+            'ip2location_signature': file_utils.get_file_signature(resolver.ip2location_bin_file_path),
+            'ip_lookups': ip_lookups,
+            'whitelist': whitelist,
+        }
+
+    def save(self):
+        """
+        Writes the snapshot in a thread unless a save is already running.
+        """
+        if self._saving:
+            return None
+
+        self._saving = True
+
+        start = time.monotonic()
+
+        d = threads.deferToThread(_write_snapshot_file, self.snapshot_file, self.get_state())
+        d.addCallbacks(self._save_succeeded, self._save_failed, callbackArgs=(start,), errbackArgs=(start,))
+
+        return d
+
+    def _save_succeeded(self, result, start):
+        self._saving = False
+
+        self.stats['saves'] += 1
+        self.stats['last_save_duration_sec'] = time.monotonic() - start
+
+    def _save_failed(self, failure, start):
+        self._saving = False
+
+        self.stats['save_failures'] += 1
+        self.stats['last_save_duration_sec'] = time.monotonic() - start
+
+        print(f"Could not save cache snapshot to {self.snapshot_file} due to exception '{failure.getErrorMessage()}'")
+
+    def load(self):
+        """
+        Restores the caches from the snapshot file, if there is a usable one.
+        """
+        start = time.monotonic()
+
+        try:
+            with open(self.snapshot_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            print(f"No cache snapshot at {self.snapshot_file}, starting cold")
+            return
+        except BaseException as be:
+            traceback.print_exc()
+            print(f"Could not read cache snapshot {self.snapshot_file} due to exception '{be}', starting cold")
+            return
+
+        if not isinstance(state, dict) or state.get('version') != SNAPSHOT_VERSION:
+            print(f"Ignoring cache snapshot {self.snapshot_file} with unknown version")
+            return
+
+        resolver = self.resolver
+
+        age_sec = max(0.0, time.time() - state['saved_at'])
+
+        if state['blocked_countries_list'] == resolver.geo_policy.blocked_countries_list:
+            self._restore_dns_cache([_decode_dns_entry(entry) for entry in state['dns_cache']])
+
+        ip2location_signature = state['ip2location_signature']
+
+        if ip2location_signature is not None and tuple(ip2location_signature) == file_utils.get_file_signature(resolver.ip2location_bin_file_path) and hasattr(resolver.cached_ip_lookups, 'items'):
+            # Oldest first so that the most recently used entries stay most
+            # recently used.
+            for address_value, country_code in reversed(state['ip_lookups']):
+                resolver.cached_ip_lookups[address_value] = country_code
+
+            self.stats['restored_ip_lookups'] = len(state['ip_lookups'])
+
+        if state['whitelist'] is not None:
+            entries, whitelist_age_sec = state['whitelist']
+
+            if resolver.whitelist_refresher.restore_snapshot(entries, DomainListMatcher(entries, 'white'), whitelist_age_sec + age_sec):
+                self.stats['restored_whitelist_entries'] = len(entries)
+
+        now = time.monotonic()
+
+        self.stats['load_duration_sec'] = now - start
+
+        if self.started_at is not None:
+            self.stats['startup_to_warm_duration_sec'] = now - self.started_at
+
+        print(f"Restored {self.stats['restored_dns_entries']} DNS answers ({self.stats['expired_dns_entries']} expired), {self.stats['restored_ip_lookups']} IP lookups and {self.stats['restored_whitelist_entries']} whitelist entries from a {round(age_sec)} sec old snapshot in {self.stats['load_duration_sec']:.3f} sec, {self.stats['startup_to_warm_duration_sec']:.3f} sec after startup")
+
+    def _restore_dns_cache(self, entries):
+        now = self.dns_cache._reactor.seconds()
+
+        for query, (when, payload) in entries:
+            elapsed = now - when
+
+            records = [r for section in payload for r in section]
+
+            if not records or min(r.ttl for r in records) <= elapsed:
+                self.stats['expired_dns_entries'] += 1
+                continue
+
+            # Same as CacheResolver does when answering from the cache.
+            payload = tuple([dns.RRHeader(r.name.name, r.type, r.cls, int(r.ttl - elapsed), r.payload) for r in section] for section in payload)
+
+            self.dns_cache.cacheResult(query, payload)
+
+            self.stats['restored_dns_entries'] += 1
@@ -0,0 +1,192 @@
+import time
+import traceback
+
+from twisted.application import service
+from twisted.internet import task, threads
+
+import metrics
+from domain_list_matcher import DomainListMatcher
+from pi_hole_admin import PiHoleAdmin
+
+class WhitelistRefresher(service.Service):
+    """
+    Keeps a snapshot of the PiHole whitelist fresh without blocking the
+    reactor. Every `refresh_interval_sec` the whitelist is fetched in a thread
+    from the reactor's thread pool while queries keep matching against the
+    last good snapshot. A failed refresh keeps the previous snapshot, but a
+    snapshot older than `max_staleness_sec` is no longer served, so a PiHole
+    that stays unreachable cannot keep whitelisting domains indefinitely.
+    """
+    def __init__(self, pi_hole_client: PiHoleAdmin, groups: list=None, refresh_interval_sec: int=180, max_staleness_sec: int=3600):
+        if max_staleness_sec < refresh_interval_sec:
+            raise ValueError(f"Max staleness {max_staleness_sec} sec should be at least the refresh interval {refresh_interval_sec} sec")
+
+        self.pi_hole_client = pi_hole_client
+        self.groups = groups
+        self.refresh_interval_sec = refresh_interval_sec
+        self.max_staleness_sec = max_staleness_sec
+
+        self._entries = None
+        self._matcher = None
+        self._refreshed_at = None
+        self._refreshing = False
+        self._stale_warning_printed = False
+        self._loop = None
+
+        # Incremented every time a snapshot with different entries is swapped
+        # in.
+        self.generation = 0
+
+        self.stats = {
+            'refreshes': 0,
+            'refresh_failures': 0,
+            'overlapping_refreshes_skipped': 0,
+            'stale_snapshot_expirations': 0,
+            'last_refresh_duration_sec': 0.0,
+        }
+
+        self.refresh_latency = metrics.Histogram(metrics.LATENCY_BUCKETS)
+
+    def get_metrics(self):
+        return [
+            metrics.counter('interceptor_whitelist_refreshes_total', 'Whitelist refreshes by result.', [({'result': 'success'}, self.stats['refreshes']), ({'result': 'failure'}, self.stats['refresh_failures'])]),
+            metrics.histogram('interceptor_whitelist_refresh_duration_seconds', 'Duration of whitelist refreshes.', self.refresh_latency),
+            metrics.gauge('interceptor_whitelist_entries', 'Entries in the whitelist snapshot being served.', [({}, len(self.get_entries()))]),
+        ]
+
+    def startService(self):
+        service.Service.startService(self)
+
+        self._loop = task.LoopingCall(self.refresh)
+        self._loop.start(self.refresh_interval_sec, now=True)
+
+    def stopService(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+        self._loop = None
+
+        return service.Service.stopService(self)
+
+    def is_serving_snapshot(self):
+        """
+        Returns True if there is a snapshot that is fresh enough to serve.
+        """
+        if self._entries is None:
+            return False
+
+        if time.monotonic() - self._refreshed_at > self.max_staleness_sec:
+            if not self._stale_warning_printed:
+                print(f"Whitelist snapshot is older than {self.max_staleness_sec} sec, ignoring it until a refresh succeeds")
+
+                self._stale_warning_printed = True
+                self.stats['stale_snapshot_expirations'] += 1
+
+            return False
+
+        return True
+
+    def get_entries(self):
+        """
+        Returns the current whitelist snapshot, or an empty list if there is
+        no snapshot yet or the snapshot has become too stale to serve.
+        """
+        return self._entries if self.is_serving_snapshot() else []
+
+    def get_entries_containing_domain(self, domain: str):
+        """
+        Returns the whitelist entries from the current snapshot that contain
+        `domain`, matching the same way PiHoleAdmin does for wildcard entries.
+        """
+        if not self.is_serving_snapshot():
+            return []
+
+        return self._matcher.match(domain, wildcard=True)
+
+    def get_snapshot(self):
+        """
+        Returns (entries, matcher, age in seconds) of the current snapshot, or
+        None if there is none.
+        """
+        if self._entries is None:
+            return None
+
+        return self._entries, self._matcher, time.monotonic() - self._refreshed_at
+
+    def restore_snapshot(self, entries: list, matcher: DomainListMatcher, age_sec: float):
+        """
+        Serves a previously saved snapshot until the next refresh succeeds,
+        unless it is older than `max_staleness_sec` or a newer snapshot was
+        already fetched. Returns True if the snapshot was restored.
+        """
+        if self._entries is not None or age_sec > self.max_staleness_sec:
+            return False
+
+        self._entries = entries
+        self._matcher = matcher
+        self._refreshed_at = time.monotonic() - age_sec
+
+        self.generation += 1
+
+        return True
+
+    def refresh(self):
+        """
+        Starts a background refresh unless one is already running. Returns the
+        deferred for the refresh, or None if a refresh was already running.
+        """
+        if self._refreshing:
+            self.stats['overlapping_refreshes_skipped'] += 1
+            return None
+
+        self._refreshing = True
+
+        start = time.monotonic()
+
+        print(f"Doing whitelist refresh. Last successful refresh was {None if self._refreshed_at is None else round(start - self._refreshed_at)} sec ago")
+
+        d = threads.deferToThread(self._fetch)
+        d.addCallbacks(self._refresh_succeeded, self._refresh_failed, callbackArgs=(start,), errbackArgs=(start,))
+
+        return d
+
+    def _fetch(self):
+        # Runs in a thread, so only this thread ever talks to PiHole. The
+        # matcher is compiled here too, off the reactor thread.
+        entries = list(self.pi_hole_client.get_whitelist_or_blacklist_entries(ltype='white', bust_cache=True, only_enabled=True, groups=self.groups) or [])
+
+        return entries, DomainListMatcher(entries, 'white')
+
+    def _refresh_succeeded(self, result, start):
+        self._refreshing = False
+
+        entries, matcher = result
+
+        if entries != self._entries:
+            self.generation += 1
+
+        self._entries = entries
+        self._matcher = matcher
+        self._refreshed_at = time.monotonic()
+        self._stale_warning_printed = False
+
+        self.stats['refreshes'] += 1
+        self.stats['last_refresh_duration_sec'] = self._refreshed_at - start
+
+        self.refresh_latency.observe(self.stats['last_refresh_duration_sec'])
+
+        print(f"Refreshed whitelist with {len(self._entries)} entries in {self.stats['last_refresh_duration_sec']:.3f} sec")
+
+    def _refresh_failed(self, failure, start):
+        self._refreshing = False
+
+        self.stats['refresh_failures'] += 1
+        self.stats['last_refresh_duration_sec'] = time.monotonic() - start
+
+        self.refresh_latency.observe(self.stats['last_refresh_duration_sec'])
+
+        print(f"Could not refresh whitelist, keeping previous snapshot, due to exception '{failure.getErrorMessage()}'")
+        traceback.print_exception(failure.type, failure.value, failure.getTracebackObject())
+
+        # The session may have expired, so log in again on the next refresh.
+        self.pi_hole_client.reset_session()